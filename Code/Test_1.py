@@ -67,7 +67,7 @@ async def peer_operations(peer_id, topic_names):
         messages = await peer.pull_messages(topic_name)
         if messages:
             print(f"Peer {peer.peer_id} pulled messages from {topic_name}:")
-            for index, sender, content in messages:
+            for index, sender, content, *_ in messages:
                 print(f"  [{index}] {sender}: {content}")
         else:
             print(f"Peer {peer.peer_id} pulled no new messages from {topic_name}")
@@ -0,0 +1,334 @@
+import json
+import asyncio
+import base64
+import os
+import signal
+import socket
+import sys
+import tempfile
+import zlib
+from benchmark import BenchClient, start_server_process, stop_server_process
+from columnar import encode_records
+from fanout import FanoutEngine
+from indexing_server import expanded_records
+from peer_node import PeerNode
+from profiling import RuntimeProfiler
+from message_store import TopicLog
+from protocol import EncodedFrame, compress_batch
+from scheduler import RequestScheduler
+from transport import DEFAULT_SETTINGS, start_unix_server
+
+# Load configuration from the config file
+with open('config.json') as config_file:
+    config = json.load(config_file)
+
+HOST = config['indexing_server']['ip']
+PORT = config['indexing_server']['port']
+
+failures = []
+
+def check(name, condition, detail=None):
+    print(f"{'PASS' if condition else 'FAIL'}: {name}" + ("" if condition or detail is None else f" ({detail})"))
+    if not condition:
+        failures.append(name)
+
+async def connect(peer_id):
+    client = BenchClient(peer_id)
+    await client.connect(HOST, PORT)
+    await client.request({"action": "register", "ip": "127.0.0.1", "port": 0})
+    return client
+
+# A control request pipelined behind a data request on one connection must not overtake it
+async def test_pipeline_order():
+    client = await connect("order_peer")
+    await client.request({"action": "create_topic", "topic": "order_topic"})
+    sent = client.submit({"action": "send_message", "topic": "order_topic", "content": "last words"})
+    deleted = client.submit({"action": "delete_topic", "topic": "order_topic"})
+    await client.writer.drain()
+    sent, deleted = await sent, await deleted
+    check("send_message before delete_topic is delivered", sent.get("status") == "message_sent", sent)
+    check("delete_topic after send_message succeeds", deleted.get("status") == "topic_deleted", deleted)
+    await client.close()
+
+# Compressed batches that don't decode to 'count' messages are refused at publish time
+async def test_corrupt_batches():
+    client = await connect("batch_peer")
+    await client.request({"action": "create_topic", "topic": "batch_topic"})
+    good = compress_batch("zlib", [["one", None, None], ["two", None, None]])
+    garbage = base64.b64encode(b"not zlib at all").decode()
+    not_items = base64.b64encode(zlib.compress(b'{"a": 1}')).decode()
+    sent = await client.request({"action": "send_batch", "topic": "batch_topic", "codec": "zlib", "count": 2, "data": good})
+    check("valid compressed batch is accepted", sent.get("status") == "batch_sent", sent)
+    for name, data, count in (("undecodable", garbage, 1), ("non-list", not_items, 1), ("miscounted", good, 3)):
+        response = await client.request({"action": "send_batch", "topic": "batch_topic", "codec": "zlib", "count": count, "data": data})
+        check(f"{name} compressed batch is rejected", response.get("status") == "error", response)
+    await client.close()
+
+# A columnar batch whose header matches the schema but whose columns are cut short is refused
+async def test_truncated_columnar():
+    client = await connect("columnar_peer")
+    await client.request({"action": "create_topic", "topic": "columnar_topic"})
+    fields = [{"name": "id", "type": "int64"}, {"name": "name", "type": "string"}]
+    response = await client.request({"action": "register_schema", "topic": "columnar_topic", "fields": fields})
+    schema = response["fields"]
+    payload = encode_records(schema, [{"id": i, "name": f"n{i}"} for i in range(100)], compress=False)
+    for name, data, expected in (("complete", payload, "batch_sent"), ("truncated", payload[:-40], "error"),
+                                 ("padded", payload + b"\0" * 8, "error")):
+        response = await client.request({"action": "send_batch", "topic": "columnar_topic", "codec": "columnar",
+                                         "schema_version": 1, "count": 100, "data": base64.b64encode(data).decode()})
+        check(f"{name} columnar batch gives {expected}", response.get("status") == expected, response)
+    await client.close()
+
+# Replay parameters that would never finish or make no sense are refused up front
+async def test_replay_limits():
+    client = await connect("replay_peer")
+    await client.request({"action": "create_topic", "topic": "replay_topic"})
+    await client.request({"action": "subscribe", "topic": "replay_topic"})
+    await client.request({"action": "send_message", "topic": "replay_topic", "content": "history"})
+    for name, fields in (("zero chunk_size", {"chunk_size": 0}), ("negative chunk_size", {"chunk_size": -1}),
+                         ("negative rate", {"rate": -5})):
+        response = await asyncio.wait_for(client.request({"action": "replay", "topic": "replay_topic", **fields}), 5)
+        check(f"replay with {name} is rejected", response.get("status") == "error", response)
+    await client.close()
+
+# A bad limit, visibility_timeout, cursor or offset is an error and must not move the lease position
+async def test_bad_limits():
+    client = await connect("limit_peer")
+    await client.request({"action": "create_topic", "topic": "limit_topic"})
+    await client.request({"action": "subscribe", "topic": "limit_topic"})
+    for i in range(3):
+        await client.request({"action": "send_message", "topic": "limit_topic", "content": f"m{i}"})
+    first = await client.request({"action": "lease", "topic": "limit_topic", "limit": 1})
+    for action, fields in (("lease", {"topic": "limit_topic"}), ("get_messages", {"topic": "limit_topic"}),
+                           ("fetch", {"topics": {"limit_topic": -1}}), ("view_created_topics", {})):
+        for limit in (-1, 0, "many"):
+            response = await client.request({"action": action, "limit": limit, **fields})
+            check(f"{action} with limit {limit!r} is rejected", response.get("status") == "error", response)
+    for timeout in ("inf", "nan", -1, 0, "soon"):
+        response = await client.request({"action": "lease", "topic": "limit_topic", "limit": 1, "visibility_timeout": timeout})
+        check(f"lease with visibility_timeout {timeout!r} is rejected", response.get("status") == "error", response)
+    for name, fields in (("numeric cursor", {"cursor": 5}), ("list prefix", {"prefix": ["limit"]})):
+        response = await client.request({"action": "view_created_topics", **fields})
+        check(f"view_created_topics with a {name} is rejected", response.get("status") == "error", response)
+    for last_read in ("x", -2, [1]):
+        response = await client.request({"action": "get_messages", "topic": "limit_topic", "last_read": last_read})
+        check(f"get_messages with last_read {last_read!r} is rejected", response.get("status") == "error", response)
+    second = await client.request({"action": "lease", "topic": "limit_topic", "limit": 1})
+    leased = [m[0] for m in first.get("messages", []) + second.get("messages", [])]
+    check("lease position is unchanged by rejected leases", leased == [0, 1], leased)
+    await client.close()
+
+# A heartbeat only renews peers registered over the sender's own connection
+async def test_heartbeat_peers():
+    owner = await connect("heartbeat_owner")
+    owner.peer_id = "heartbeat_child"
+    await owner.request({"action": "register", "ip": "127.0.0.1", "port": 0})
+    owner.peer_id = "heartbeat_owner"
+    shared = await owner.request({"action": "heartbeat", "peer_ids": ["heartbeat_owner", "heartbeat_child"]})
+    check("heartbeat renews peers registered over its connection", shared.get("status") == "heartbeat_ok" and shared.get("expired") == [], shared)
+    other = await connect("heartbeat_other")
+    for name, peer_ids in (("another connection's peer", ["heartbeat_child"]), ("a number", 5), ("a non-string id", ["heartbeat_other", 5])):
+        response = await other.request({"action": "heartbeat", "peer_ids": peer_ids})
+        check(f"heartbeat naming {name} is rejected", response.get("status") == "error", response)
+    for client in (owner, other):
+        await client.close()
+
+# A retried delayed publish gets the original scheduled answer back, not an appended one
+async def test_delayed_duplicate():
+    client = await connect("delayed_peer")
+    await client.request({"action": "create_topic", "topic": "delayed_topic"})
+    publish = {"action": "send_message", "topic": "delayed_topic", "content": "later", "delay_ms": 60000,
+               "producer_id": "delayed_producer", "sequence": 0}
+    first = await client.request(dict(publish))
+    retry = await client.request(dict(publish))
+    check("delayed publish is scheduled", first.get("status") == "message_scheduled", first)
+    check("retried delayed publish is answered as scheduled",
+          retry.get("status") == "message_scheduled" and retry.get("duplicate") and retry.get("deliver_at") == first.get("deliver_at"), retry)
+    batch = {"action": "send_batch", "topic": "delayed_topic", "messages": [["a", None, None], ["b", None, None]],
+             "delay_ms": 60000, "producer_id": "delayed_producer", "sequence": 1}
+    first = await client.request(dict(batch))
+    retry = await client.request(dict(batch))
+    check("retried delayed batch is answered as scheduled",
+          retry.get("status") == "batch_scheduled" and retry.get("count") == 2 and retry.get("deliver_at") == first.get("deliver_at"), retry)
+    await client.close()
+
+# Unpacking for consumers skips a corrupt stored batch instead of failing the whole fetch
+def test_corrupt_batch_expansion():
+    good = compress_batch("zlib", [["after", None, None]])
+    records = b','.join(json.dumps(record).encode() for record in (
+        [0, "p", "before", None, 1.0, None],
+        {"base": 1, "count": 2, "sender": "p", "appended_at": 1.0, "codec": "zlib", "data": "AAAA"},
+        {"base": 3, "count": 1, "sender": "p", "appended_at": 1.0, "codec": "zlib", "data": good},
+    ))
+    (encoded,), skipped = expanded_records(records, -1)
+    messages = json.loads(b'[' + encoded + b']')
+    check("corrupt batch is skipped and reported", skipped == [(1, 2)], skipped)
+    check("messages around a corrupt batch are kept", [m[2] for m in messages] == ["before", "after"], messages)
+
+# Two peers started with the same base_port must end up listening on different ports
+async def test_peer_ports():
+    first, second = PeerNode(config), PeerNode(config)
+    first.bind_listener()
+    second.bind_listener(first.peer_port)
+    check("second peer binds a different port", first.peer_port != second.peer_port, (first.peer_port, second.peer_port))
+    for peer in (first, second):
+        await peer.start_server()
+    check("both peers listen", all(peer.server_socket.is_serving() for peer in (first, second)))
+    for peer in (first, second):
+        peer.server_socket.close()
+
+# Socket listeners are opt-in, and a socket path in use by another server is never taken over
+async def test_unix_listeners():
+    check("no socket paths are set by default", not DEFAULT_SETTINGS["unix_path"] and not DEFAULT_SETTINGS["shm_path"])
+    check("config.json sets no socket paths", not config["transport"].get("unix_path") and not config["transport"].get("shm_path"))
+    async def accept(reader, writer):
+        writer.close()
+    with tempfile.TemporaryDirectory() as directory:
+        stale = os.path.join(directory, "stale.sock")
+        leftover = socket.socket(socket.AF_UNIX)
+        leftover.bind(stale)
+        leftover.close()
+        server = await start_unix_server(accept, stale)
+        check("stale socket file is replaced", server.is_serving())
+        try:
+            await start_unix_server(accept, stale)
+            check("socket in use is refused", False)
+        except OSError:
+            check("socket in use is refused", server.is_serving())
+        server.close()
+        await server.wait_closed()
+        plain = os.path.join(directory, "plain.txt")
+        with open(plain, "w") as f:
+            f.write("keep me")
+        try:
+            await start_unix_server(accept, plain)
+            check("non-socket path is refused", False)
+        except OSError:
+            check("non-socket path is refused", os.path.isfile(plain))
+
+# Peers with tiny weights still get their turn without the scheduler spinning, and bad weights are refused
+async def test_scheduler_weights():
+    scheduler = RequestScheduler(None, weights={"slow": 1e-9, "quarter": 0.25})
+    for peer_id in ("slow", "quarter", "slow", "quarter"):
+        scheduler.submit("send_message", {}, peer_id)
+    order = []
+    job = scheduler.next_job()
+    while job is not None:
+        order.append(job[2])
+        job = scheduler.next_job()
+    check("fractional weights get every queued request served", sorted(order) == ["quarter", "quarter", "slow", "slow"], order)
+    for weight in (0, -1, float("nan"), "heavy"):
+        try:
+            RequestScheduler(None, weights={"peer": weight})
+            check(f"peer weight {weight!r} is refused", False)
+        except ValueError:
+            check(f"peer weight {weight!r} is refused", True)
+
+# A profiler start that fails leaves no timer, signal handler or callbacks behind
+async def test_profiler_start():
+    profiler = RuntimeProfiler()
+    handler = signal.getsignal(signal.SIGPROF)
+    for name, seconds, interval in (("NaN interval", 1, float("nan")), ("negative interval", 1, -1),
+                                    ("infinite seconds", float("inf"), 0.005), ("interval too large for the timer", 1, 1e300)):
+        try:
+            profiler.start(asyncio.get_running_loop(), seconds, interval)
+            check(f"profiler start with {name} fails", False)
+            profiler.stop()
+        except (ValueError, OverflowError):
+            check(f"profiler start with {name} leaves it stopped", not profiler.active and signal.getsignal(signal.SIGPROF) == handler
+                  and signal.getitimer(signal.ITIMER_PROF) == (0.0, 0.0) and profiler.tick_handle is None)
+
+class PushWriter:
+    # Collects what the fanout engine writes to a subscriber
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.transport = self
+
+    def writelines(self, chunks):
+        self.chunks.extend(chunks)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+class PushServer:
+    # Just enough of the indexing server for FanoutEngine; encoding fails for topic "broken"
+    def __init__(self):
+        self.messages = {"broken": TopicLog(), "healthy": TopicLog()}
+        self.peer_subscriptions = {"bad": {"broken"}, "good": {"healthy"}}
+
+    def messages_frame(self, topic, peer_id, start, end, fields, cold=None):
+        if topic == "broken":
+            raise ValueError("corrupt record")
+        return EncodedFrame([b'{}'])
+
+# A delivery error drops only the affected channel and leaves the fanout worker running
+async def test_fanout_isolation():
+    server = PushServer()
+    engine = FanoutEngine(server)
+    bad, good = PushWriter(), PushWriter()
+    engine.attach("bad", bad, {})
+    engine.attach("good", good, {})
+    for topic in ("broken", "healthy"):
+        server.messages[topic].append("publisher", "payload", 0.0, 0.0)
+        engine.appended(topic)
+    await asyncio.sleep(0.05)
+    check("failing push channel is detached", bad.closed and "bad" not in engine.peer_channels)
+    check("other subscribers still receive pushes", good.chunks and not good.closed)
+    check("fanout worker keeps running", not engine.worker.done())
+    engine.worker.cancel()
+
+class StalledWriter(PushWriter):
+    # A subscriber that never reads: its buffer stays over the high-water mark
+    def get_write_buffer_size(self):
+        return 1 << 30
+
+    async def drain(self):
+        await asyncio.Event().wait()
+
+# A channel blocked on a full buffer keeps its drain task, which is cancelled when the channel goes
+async def test_fanout_drain_task():
+    server = PushServer()
+    engine = FanoutEngine(server)
+    channel = engine.attach("good", StalledWriter(), {})
+    server.messages["healthy"].append("publisher", "payload", 0.0, 0.0)
+    engine.appended("healthy")
+    await asyncio.sleep(0.05)
+    task = channel.drain_task
+    check("blocked channel keeps its drain task", channel.blocked and task is not None and not task.done())
+    engine.detach(channel)
+    await asyncio.sleep(0)
+    check("detaching cancels the drain task", task is not None and task.cancelled() and channel.drain_task is None)
+    engine.worker.cancel()
+
+async def main():
+    await test_fanout_isolation()
+    await test_fanout_drain_task()
+    await test_scheduler_weights()
+    await test_profiler_start()
+    test_corrupt_batch_expansion()
+    await test_peer_ports()
+    await test_unix_listeners()
+    server_process = await start_server_process(HOST, PORT, 'indexing_server.log')
+    try:
+        await test_pipeline_order()
+        await test_corrupt_batches()
+        await test_truncated_columnar()
+        await test_replay_limits()
+        await test_bad_limits()
+        await test_delayed_duplicate()
+        await test_heartbeat_peers()
+        # Left open so the server has a live connection to close when it shuts down
+        await connect("lingering_peer")
+    finally:
+        stop_server_process(server_process)
+    with open('indexing_server.log') as log:
+        check("server shuts down without tracebacks", "Traceback" not in log.read())
+    print(f"{len(failures)} check(s) failed" if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
+
+# Run the main test function
+asyncio.run(main())
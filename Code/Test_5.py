@@ -0,0 +1,241 @@
+import json
+import asyncio
+import base64
+import os
+import sys
+import tempfile
+from benchmark import BenchClient, start_server_process, stop_server_process
+from columnar import COLUMNAR, decode_columns, encode_records, to_records
+from delivery import TimerWheel
+from fetch_cache import FetchCache
+from peer_state import PeerStateStore
+from protocol import encode_frame, expand_messages, read_frame
+
+# Load configuration from the config file
+with open('config.json') as config_file:
+    config = json.load(config_file)
+
+HOST = config['indexing_server']['ip']
+PORT = config['indexing_server']['port']
+MAX_DELIVERIES = config['indexing_server'].get('max_deliveries', 5)
+DEAD_LETTER_SUFFIX = config['indexing_server'].get('dead_letter_suffix', '.dlq')
+
+failures = []
+
+def check(name, condition, detail=None):
+    print(f"{'PASS' if condition else 'FAIL'}: {name}" + ("" if condition or detail is None else f" ({detail})"))
+    if not condition:
+        failures.append(name)
+
+async def connect(peer_id, compression=None):
+    client = BenchClient(peer_id)
+    await client.connect(HOST, PORT)
+    await client.request({"action": "register", "ip": "127.0.0.1", "port": 0, "compression": compression or []})
+    return client
+
+async def topic_with_messages(client, topic, count):
+    # Creates topic, subscribes the client and publishes count messages; returns the send responses
+    await client.request({"action": "create_topic", "topic": topic})
+    await client.request({"action": "subscribe", "topic": topic})
+    return [await client.request({"action": "send_message", "topic": topic, "content": f"m{i}"}) for i in range(count)]
+
+# Timers fire once their tick has passed, from every level of the wheel and from the overflow list
+def test_timer_wheel():
+    wheel = TimerWheel(tick=0.1, slots=8, levels=2, now=0.0)
+    for deadline in (0.25, 3.0, 20.0):
+        wheel.schedule(deadline, deadline)
+    fired = [wheel.advance(now) for now in (0.2, 0.35, 2.9, 3.05, 19.9, 20.05)]
+    check("timer wheel fires each timer once, on time", fired == [[], [0.25], [], [3.0], [], [20.0]], fired)
+    check("timer wheel is empty afterwards", len(wheel) == 0, len(wheel))
+
+# Concurrent misses on one key share a single load; an append drops entries at the old tail
+async def test_fetch_cache():
+    cache = FetchCache(1024 * 1024)
+    loads = []
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.05)
+        return [b'"records"']
+    results = await asyncio.gather(*(cache.get(("topic", 0, 10), load, True) for _ in range(5)))
+    check("concurrent misses share one load", len(loads) == 1 and all(r == [b'"records"'] for r in results), len(loads))
+    await cache.get(("topic", 0, 10), load, True)
+    check("cached range is served without loading", len(loads) == 1 and cache.stats()["misses"] == 1, cache.stats())
+    cache.appended("topic")
+    await cache.get(("topic", 0, 10), load, True)
+    check("append invalidates the tail range", len(loads) == 2, len(loads))
+
+# Leased messages stay out until acked; unacked ones come back, and go to the DLQ after max_deliveries
+async def test_lease_ack_dlq():
+    client = await connect("lease_peer")
+    await topic_with_messages(client, "lease_topic", 3)
+    lease = {"action": "lease", "topic": "lease_topic", "visibility_timeout": 0.3}
+    first = await client.request(dict(lease, limit=3))
+    check("lease hands out messages in order", [m[0] for m in first["messages"]] == [0, 1, 2] and first["deliveries"] == [1, 1, 1], first)
+    await client.request({"action": "ack", "topic": "lease_topic", "indices": [0]})
+    acked = await client.request({"action": "ack", "topic": "lease_topic", "up_to": 1})
+    check("acks move the committed offset", acked.get("committed") == 1, acked)
+    again = await client.request(dict(lease))
+    check("nothing is redelivered before the timeout", again["messages"] == [], again)
+    deliveries = 1
+    while deliveries < MAX_DELIVERIES:
+        await asyncio.sleep(0.5)
+        again = await client.request(dict(lease))
+        if [m[0] for m in again["messages"]] != [2]:
+            break
+        deliveries = again["deliveries"][0]
+    check("unacked message is redelivered until max_deliveries", deliveries == MAX_DELIVERIES, again)
+    await asyncio.sleep(0.5)
+    dead_topic = "lease_topic" + DEAD_LETTER_SUFFIX
+    await client.request({"action": "subscribe", "topic": dead_topic})
+    dead = await client.request({"action": "get_messages", "topic": dead_topic})
+    check("message goes to the dead-letter topic", [m[2] for m in dead.get("messages", [])] == ["m2"], dead)
+    last = await client.request(dict(lease))
+    check("dead-lettered message is not leased again", last["messages"] == [], last)
+    await client.close()
+
+# A repeated sequence is answered with the original index and not appended again
+async def test_dedup():
+    client = await connect("dedup_peer")
+    await topic_with_messages(client, "dedup_topic", 0)
+    publish = {"action": "send_message", "topic": "dedup_topic", "content": "once", "producer_id": "dedup_producer"}
+    first = await client.request(dict(publish, sequence=0))
+    retry = await client.request(dict(publish, sequence=0))
+    check("duplicate sequence returns the original index", retry.get("duplicate") and retry.get("index") == first.get("index"), retry)
+    skipped = await client.request(dict(publish, sequence=2))
+    check("sequence gap is refused", skipped.get("status") == "out_of_order_sequence" and skipped.get("expected_sequence") == 1, skipped)
+    await client.request(dict(publish, sequence=1, content="twice"))
+    stored = await client.request({"action": "get_messages", "topic": "dedup_topic"})
+    check("each sequence is stored once", [m[2] for m in stored["messages"]] == ["once", "twice"], stored)
+    await client.close()
+
+# seek finds offsets by index or time, and replay streams a range in chunks
+async def test_replay_and_seek():
+    client = await connect("replay_peer")
+    sent = await topic_with_messages(client, "history_topic", 10)
+    by_offset = await client.request({"action": "seek", "topic": "history_topic", "offset": 4})
+    check("seek by offset", by_offset.get("offset") == 4 and by_offset.get("last_read") == 3, by_offset)
+    by_time = await client.request({"action": "seek", "topic": "history_topic", "timestamp": sent[6]["appended_at"]})
+    found = by_time.get("offset", 10)
+    check("seek by timestamp finds the first message at or after it",
+          found <= 6 and sent[found]["appended_at"] == sent[6]["appended_at"] and by_time.get("end") == 10, by_time)
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    writer.write(encode_frame({"action": "replay", "peer_id": "replay_peer", "topic": "history_topic",
+                               "from_offset": 2, "to_offset": 9, "chunk_size": 3}))
+    await writer.drain()
+    chunks, indices = [], []
+    while True:
+        frame = await asyncio.wait_for(read_frame(reader), 5)
+        if frame.get("status") != "replay_chunk":
+            break
+        chunks.append((frame["from_offset"], frame["to_offset"]))
+        indices.extend(m[0] for m in expand_messages(frame["messages"]) if frame["from_offset"] <= m[0] < frame["to_offset"])
+    check("replay is sent in chunks of chunk_size", chunks == [(2, 5), (5, 8), (8, 9)], chunks)
+    check("replay covers exactly the range", indices == list(range(2, 9)), indices)
+    check("replay ends with replay_done", frame.get("status") == "replay_done" and frame.get("next_offset") == 9, frame)
+    writer.close()
+    await client.close()
+
+# Columnar batches reach columnar-capable consumers as sent and everyone else as JSON records
+async def test_columnar_roundtrip():
+    producer = await connect("columnar_producer")
+    await producer.request({"action": "create_topic", "topic": "metrics"})
+    fields = [{"name": "id", "type": "int64"}, {"name": "host", "type": "string"},
+              {"name": "load", "type": "float64"}, {"name": "up", "type": "bool"}]
+    schema = (await producer.request({"action": "register_schema", "topic": "metrics", "fields": fields}))["fields"]
+    records = [{"id": i, "host": f"h{i % 3}", "load": i / 4, "up": i % 2 == 0} for i in range(50)]
+    sent = await producer.request({"action": "send_batch", "topic": "metrics", "codec": COLUMNAR, "schema_version": 1,
+                                   "count": len(records), "data": base64.b64encode(encode_records(schema, records)).decode()})
+    check("columnar batch is accepted", sent.get("status") == "batch_sent", sent)
+    columnar = await connect("columnar_consumer", [COLUMNAR])
+    plain = await connect("plain_consumer")
+    for consumer in (columnar, plain):
+        await consumer.request({"action": "subscribe", "topic": "metrics"})
+    raw = (await columnar.request({"action": "get_messages", "topic": "metrics"}))["messages"]
+    decoded = []
+    if len(raw) == 1 and isinstance(raw[0], dict):
+        got_fields, count, _, columns = decode_columns(base64.b64decode(raw[0]["data"]))
+        decoded = to_records(got_fields, columns, count)
+    check("columnar consumer gets the batch as sent", decoded == records, raw[:1])
+    unpacked = (await plain.request({"action": "get_messages", "topic": "metrics"}))["messages"]
+    check("other consumers get the same records as JSON", [json.loads(m[2]) for m in unpacked] == records, unpacked[:2])
+    for client in (producer, columnar, plain):
+        await client.close()
+
+# resume subscribes in one request and returns where to continue each topic
+async def test_resume():
+    client = await connect("resume_peer")
+    await topic_with_messages(client, "resume_saved", 5)
+    await topic_with_messages(client, "resume_committed", 5)
+    await client.request({"action": "commit_offsets", "offsets": {"resume_committed": 2}})
+    catalog_version = (await client.request({"action": "view_created_topics", "since_version": 0}))["version"]
+    await client.request({"action": "create_topic", "topic": "resume_new"})
+    await client.close()
+
+    restarted = await connect("resume_peer")
+    resumed = await restarted.request({"action": "resume", "topics": {"resume_saved": 3, "resume_committed": None,
+                                                                      "resume_new": 99, "resume_missing": None},
+                                       "catalog_version": catalog_version})
+    positions = resumed.get("topics", {})
+    check("saved position is kept", positions.get("resume_saved", {}).get("last_read") == 3, positions)
+    check("committed offset is used when nothing was saved", positions.get("resume_committed", {}).get("last_read") == 2, positions)
+    check("position past the end is moved back", positions.get("resume_new", {}).get("last_read") == -1, positions)
+    check("unknown topic is reported", "resume_missing" in resumed.get("errors", {}), resumed.get("errors"))
+    changes = [change[2] for change in resumed.get("catalog", {}).get("changes", [])]
+    check("catalog changes since the saved version come back", changes == ["resume_new"], resumed.get("catalog"))
+    fetched = await restarted.request({"action": "get_messages", "topic": "resume_new"})
+    check("resume subscribes the peer", fetched.get("status") == "messages_retrieved", fetched)
+    await restarted.close()
+    with tempfile.TemporaryDirectory() as directory:
+        store = PeerStateStore(directory, "resume/peer")
+        check("missing checkpoint loads as empty", store.load() == {})
+        store.save(json.dumps({"topics": {"resume_saved": 3}}).encode())
+        check("checkpoint round-trips", PeerStateStore(directory, "resume/peer").load() == {"topics": {"resume_saved": 3}})
+
+# Delayed publishes on disk survive a server restart and are delivered when due
+async def test_delayed_recovery(directory):
+    server_config = json.loads(json.dumps(config))
+    server_config['indexing_server'].update(delayed_dir=os.path.join(directory, 'delayed'),
+                                            metadata_wal=os.path.join(directory, 'metadata.wal'), admin_port=None)
+    config_path = os.path.join(directory, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(server_config, f)
+    server_process = await start_server_process(HOST, PORT, 'indexing_server.log', config_path)
+    try:
+        client = await connect("delayed_peer")
+        await topic_with_messages(client, "delayed_topic", 0)
+        scheduled = await client.request({"action": "send_message", "topic": "delayed_topic", "content": "later", "delay_ms": 1500})
+        check("publish is scheduled", scheduled.get("status") == "message_scheduled", scheduled)
+        await client.close()
+    finally:
+        stop_server_process(server_process)
+    server_process = await start_server_process(HOST, PORT, 'indexing_server.log', config_path)
+    try:
+        client = await connect("delayed_peer")
+        early = await client.request({"action": "get_messages", "topic": "delayed_topic"})
+        check("delayed publish is not visible early", early.get("messages") == [], early)
+        await asyncio.sleep(2)
+        late = await client.request({"action": "get_messages", "topic": "delayed_topic"})
+        check("delayed publish is delivered after a restart", [m[2] for m in late.get("messages", [])] == ["later"], late)
+        await client.close()
+    finally:
+        stop_server_process(server_process)
+
+async def main():
+    test_timer_wheel()
+    await test_fetch_cache()
+    server_process = await start_server_process(HOST, PORT, 'indexing_server.log')
+    try:
+        await test_lease_ack_dlq()
+        await test_dedup()
+        await test_replay_and_seek()
+        await test_columnar_roundtrip()
+        await test_resume()
+    finally:
+        stop_server_process(server_process)
+    with tempfile.TemporaryDirectory() as directory:
+        await test_delayed_recovery(directory)
+    print(f"{len(failures)} check(s) failed" if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
+
+# Run the main test function
+asyncio.run(main())
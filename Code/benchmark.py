@@ -0,0 +1,511 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from protocol import CODECS, compress_batch, encode_frame, expand_messages, read_frame
+from transport import TRANSPORTS, open_connection, transport_settings
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_config(config_file='config.json'):
+    with open(os.path.join(SCRIPT_DIR, config_file), 'r') as f:
+        return json.load(f)
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = []
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        samples = sorted(self.samples)
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+        return {
+            "count": len(samples),
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": percentile(50),
+            "p90_ms": percentile(90),
+            "p99_ms": percentile(99),
+            "p999_ms": percentile(99.9),
+            "max_ms": samples[-1] * 1000,
+        }
+
+class ServerResources:
+    # Reads CPU time and memory of the server process from /proc (Linux only)
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.start_cpu = None
+        self.start_time = None
+        self.peak_rss = 0
+
+    def available(self):
+        return self.pid is not None and os.path.exists(f'/proc/{self.pid}/stat')
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def rss_bytes(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def start(self):
+        if self.available():
+            self.start_cpu = self.cpu_seconds()
+            self.start_time = time.perf_counter()
+
+    def sample(self):
+        if self.available():
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+
+    def summary(self):
+        if self.start_cpu is None or not self.available():
+            return {}
+        cpu = self.cpu_seconds() - self.start_cpu
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            "server_cpu_seconds": cpu,
+            "server_cpu_percent": cpu / elapsed * 100 if elapsed > 0 else 0,
+            "server_rss_bytes": self.rss_bytes(),
+            "server_peak_rss_bytes": self.peak_rss,
+        }
+
+class BenchClient:
+    # Minimal framed client. Requests may be pipelined; responses come back in order.
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.reader = None
+        self.writer = None
+        self.pending = deque()
+        self.reader_task = None
+
+    async def connect(self, host, port, transport=None):
+        # transport: settings as returned by transport.transport_settings; plain TCP by default
+        self.reader, self.writer = await open_connection(transport or {"type": "tcp"}, host, port)
+        self.reader_task = asyncio.create_task(self.read_responses())
+
+    async def read_responses(self):
+        while True:
+            response = await read_frame(self.reader)
+            if response is None:
+                break
+            self.pending.popleft().set_result(response)
+
+    def submit(self, message):
+        message["peer_id"] = self.peer_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(encode_frame(message))
+        return future
+
+    async def request(self, message):
+        future = self.submit(message)
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+async def start_server_process(host, port, log_file, config_file=None, overrides=None):
+    # config_file: path of the server's config (absolute, or relative to this directory); config.json by default.
+    # overrides: indexing_server settings to change for this run only.
+    # The server runs in a temporary working directory, so the files it writes there
+    # (registered_peers.json, relative data directories) don't end up in the source tree.
+    log = open(log_file, 'w')
+    workdir = tempfile.mkdtemp(prefix='indexing_server_')
+    if overrides:
+        config = load_config(config_file or 'config.json')
+        config['indexing_server'].update(overrides)
+        config_file = os.path.join(workdir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(config, f)
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'indexing_server.py')] + ([config_file] if config_file else [])
+    process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    process.workdir = workdir
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            await writer.wait_closed()
+            return process
+        except OSError:
+            await asyncio.sleep(0.05)
+    stop_server_process(process)
+    raise RuntimeError(f"Indexing server did not start listening on {host}:{port}")
+
+def stop_server_process(process):
+    process.terminate()
+    process.wait()
+    shutil.rmtree(process.workdir, ignore_errors=True)
+
+class Workload:
+    def __init__(self, host, port, publishers=1, subscribers=1, topics=1, fanout=1, message_size=100,
+                 duration=10.0, mode='closed', rate=1000.0, fetch_interval=0.0, warmup=1.0, batch_size=1, compression=None,
+                 transport=None):
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.publishers = publishers
+        self.subscribers = subscribers
+        self.topics = [f"bench-{i}" for i in range(topics)]
+        self.fanout = min(fanout, topics)
+        self.message_size = message_size
+        self.duration = duration
+        self.mode = mode
+        self.rate = rate
+        self.fetch_interval = fetch_interval
+        self.warmup = warmup
+        self.batch_size = batch_size
+        self.compression = compression
+        self.publish_latency = LatencyRecorder()
+        self.fetch_latency = LatencyRecorder()
+        self.end_to_end_latency = LatencyRecorder()
+        self.published = 0
+        self.published_bytes = 0
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.errors = 0
+        self.measuring = False
+
+    def params(self):
+        return {
+            "publishers": self.publishers, "subscribers": self.subscribers, "topics": len(self.topics),
+            "fanout": self.fanout, "message_size": self.message_size, "duration": self.duration,
+            "mode": self.mode, "rate": self.rate if self.mode == 'open' else None,
+            "batch_size": self.batch_size, "compression": self.compression,
+            "transport": self.transport["type"] if self.transport else "tcp",
+        }
+
+    async def client(self, peer_id):
+        client = BenchClient(peer_id)
+        await client.connect(self.host, self.port, self.transport)
+        await client.request({"action": "register", "ip": "127.0.0.1", "port": 0, "compression": list(CODECS)})
+        return client
+
+    def publish_request(self, topic, payload):
+        if self.batch_size == 1:
+            return {"action": "send_message", "topic": topic, "content": payload, "produced_at": time.time()}
+        items = [[payload, time.time(), None]] * self.batch_size
+        if self.compression:
+            return {"action": "send_batch", "topic": topic, "codec": self.compression, "count": self.batch_size,
+                    "data": compress_batch(self.compression, items)}
+        return {"action": "send_batch", "topic": topic, "messages": items}
+
+    async def setup(self):
+        admin = await self.client("bench-admin")
+        await admin.request({"action": "bulk_create_topics", "topics": self.topics})
+        return admin
+
+    async def teardown(self, admin):
+        await admin.request({"action": "bulk_delete_topics", "topics": self.topics})
+
+    async def run_closed_publisher(self, client, index, stop_at):
+        payload = 'x' * self.message_size
+        n = index
+        while time.perf_counter() < stop_at:
+            topic = self.topics[n % len(self.topics)]
+            n += self.publishers
+            start = time.perf_counter()
+            response = await client.request(self.publish_request(topic, payload))
+            self.record_publish(response, time.perf_counter() - start)
+
+    async def run_open_publisher(self, client, index, stop_at):
+        # Sends on a fixed schedule regardless of responses; latency is measured from the
+        # scheduled send time so a stalled server is not hidden by coordinated omission.
+        payload = 'x' * self.message_size
+        interval = self.publishers * self.batch_size / self.rate
+        n = index
+        next_send = time.perf_counter()
+        outstanding = []
+        while next_send < stop_at:
+            now = time.perf_counter()
+            if next_send > now:
+                await asyncio.sleep(next_send - now)
+            topic = self.topics[n % len(self.topics)]
+            n += self.publishers
+            future = client.submit(self.publish_request(topic, payload))
+            scheduled = next_send
+            future.add_done_callback(lambda f, s=scheduled: self.record_publish(f.result(), time.perf_counter() - s))
+            outstanding.append(future)
+            next_send += interval
+            if len(outstanding) >= 1000:
+                await client.writer.drain()
+                outstanding = [f for f in outstanding if not f.done()]
+        await client.writer.drain()
+        if outstanding:
+            await asyncio.wait(outstanding, timeout=5)
+
+    def record_publish(self, response, latency):
+        if not self.measuring:
+            return
+        if response.get("status") not in ("message_sent", "batch_sent"):
+            self.errors += 1
+            return
+        self.publish_latency.record(latency)
+        self.published += self.batch_size
+        self.published_bytes += self.message_size * self.batch_size
+
+    async def run_subscriber(self, client, index, stop_at):
+        topics = [self.topics[(index + i) % len(self.topics)] for i in range(self.fanout)]
+        last_read = {}
+        for topic in topics:
+            await client.request({"action": "subscribe", "topic": topic})
+            response = await client.request({"action": "get_messages", "topic": topic, "last_read": -1})
+            messages = expand_messages(response.get("messages", []))
+            last_read[topic] = messages[-1][0] if messages else -1
+        n = 0
+        while time.perf_counter() < stop_at:
+            topic = topics[n % len(topics)]
+            n += 1
+            start = time.perf_counter()
+            response = await client.request({"action": "get_messages", "topic": topic, "last_read": last_read[topic]})
+            latency = time.perf_counter() - start
+            messages = expand_messages(response.get("messages", []), last_read[topic])
+            if messages:
+                last_read[topic] = messages[-1][0]
+            if self.measuring:
+                self.fetch_latency.record(latency)
+                received_at = time.time()
+                for m in messages:
+                    if m[3]:
+                        self.end_to_end_latency.record(received_at - m[3])
+                self.delivered += len(messages)
+                self.delivered_bytes += sum(len(m[2]) for m in messages)
+            if self.fetch_interval:
+                await asyncio.sleep(self.fetch_interval)
+
+    async def run(self, resources=None):
+        admin = await self.setup()
+        publishers = [await self.client(f"bench-pub-{i}") for i in range(self.publishers)]
+        subscribers = [await self.client(f"bench-sub-{i}") for i in range(self.subscribers)]
+        start = time.perf_counter()
+        stop_at = start + self.warmup + self.duration
+        publish = self.run_open_publisher if self.mode == 'open' else self.run_closed_publisher
+        tasks = [asyncio.create_task(publish(c, i, stop_at)) for i, c in enumerate(publishers)]
+        tasks += [asyncio.create_task(self.run_subscriber(c, i, stop_at)) for i, c in enumerate(subscribers)]
+        await asyncio.sleep(self.warmup)
+        self.measuring = True
+        if resources:
+            resources.start()
+        measure_start = time.perf_counter()
+        while time.perf_counter() < stop_at and not all(t.done() for t in tasks):
+            if resources:
+                resources.sample()
+            await asyncio.sleep(min(0.5, max(0, stop_at - time.perf_counter())))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - measure_start
+        self.measuring = False
+        result = self.report(elapsed)
+        if resources:
+            result.update(resources.summary())
+        await self.teardown(admin)
+        for client in [admin] + publishers + subscribers:
+            await client.close()
+        return result
+
+    def report(self, elapsed):
+        return {
+            "params": self.params(),
+            "elapsed_seconds": elapsed,
+            "published": self.published,
+            "delivered": self.delivered,
+            "errors": self.errors,
+            "publish_msgs_per_sec": self.published / elapsed,
+            "publish_bytes_per_sec": self.published_bytes / elapsed,
+            "delivered_msgs_per_sec": self.delivered / elapsed,
+            "delivered_bytes_per_sec": self.delivered_bytes / elapsed,
+            "publish_latency": self.publish_latency.summary(),
+            "fetch_latency": self.fetch_latency.summary(),
+            "end_to_end_latency": self.end_to_end_latency.summary(),
+        }
+
+async def benchmark_api_operations(host, port, peers=1, duration=2.0, transport=None):
+    # Sustained closed-loop latency and throughput of each API, with `peers` clients calling it concurrently
+    clients = []
+    for i in range(peers):
+        client = BenchClient(f"bench-api-{i}")
+        await client.connect(host, port, transport)
+        clients.append(client)
+
+    def operations(i):
+        topic = f"bench-api-topic-{i}"
+        return {
+            "register": [{"action": "register", "ip": "127.0.0.1", "port": 0}],
+            "create_delete_topic": [{"action": "create_topic", "topic": topic + "-tmp"}, {"action": "delete_topic", "topic": topic + "-tmp"}],
+            "bulk_create_delete_100_topics": [{"action": "bulk_create_topics", "topics": [f"{topic}-tmp-{n}" for n in range(100)]},
+                                              {"action": "bulk_delete_topics", "topics": [f"{topic}-tmp-{n}" for n in range(100)]}],
+            "subscribe": [{"action": "subscribe", "topic": topic}],
+            "send_message": [{"action": "send_message", "topic": topic, "content": f"Message from peer {i}"}],
+            "get_messages": [{"action": "get_messages", "topic": topic, "last_read": -1}],
+            "view_created_topics": [{"action": "view_created_topics"}],
+        }
+
+    for i, client in enumerate(clients):
+        await client.request({"action": "register", "ip": "127.0.0.1", "port": 0})
+        await client.request({"action": "create_topic", "topic": f"bench-api-topic-{i}"})
+        await client.request({"action": "subscribe", "topic": f"bench-api-topic-{i}"})
+
+    async def drive(client, requests, recorder, stop_at):
+        count = 0
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            for message in requests:
+                await client.request(dict(message))
+            recorder.record(time.perf_counter() - start)
+            count += 1
+        return count
+
+    results = {}
+    for name in operations(0):
+        recorder = LatencyRecorder()
+        start = time.perf_counter()
+        stop_at = start + duration
+        counts = await asyncio.gather(*(drive(c, operations(i)[name], recorder, stop_at) for i, c in enumerate(clients)))
+        elapsed = time.perf_counter() - start
+        results[name] = {"ops_per_sec": sum(counts) / elapsed, "latency": recorder.summary()}
+
+    for i, client in enumerate(clients):
+        await client.request({"action": "delete_topic", "topic": f"bench-api-topic-{i}"})
+        await client.close()
+    return results
+
+async def save_profile(admin, path):
+    # Stops the server's profiler, writes the collapsed stacks to path and returns the rest of the report
+    report = await admin.request({"action": "profile_stop"})
+    with open(path, 'w') as f:
+        f.write(report['collapsed'] + '\n')
+    return {"samples": report['samples'], "spans": report['spans'], "slow_callbacks": report['slow_callbacks']}
+
+def flatten(result, prefix=''):
+    row = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            row.update(flatten(value, f"{prefix}{key}."))
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(results, json_path=None, csv_path=None):
+    # JSON gets the full nested results; CSV appends one flattened row per result for comparing runs
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if csv_path:
+        rows = [flatten(r) for r in results]
+        fields = sorted({k for row in rows for k in row})
+        exists = os.path.exists(csv_path)
+        if exists:
+            with open(csv_path, newline='') as f:
+                existing = next(csv.reader(f), [])
+            fields = existing + [k for k in fields if k not in existing]
+        with open(csv_path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            if not exists:
+                writer.writeheader()
+            writer.writerows(rows)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the indexing server.")
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help="closed: publishers wait for each response; open: publish at a fixed --rate")
+    parser.add_argument('--publishers', type=int, default=4)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=1, help="number of topics each subscriber follows")
+    parser.add_argument('--message-size', type=int, default=100, help="payload size in bytes")
+    parser.add_argument('--batch-size', type=int, default=1, help="messages per publish request (uses send_batch when > 1)")
+    parser.add_argument('--compression', choices=sorted(CODECS), help="compress publish batches with this codec")
+    parser.add_argument('--rate', type=float, default=1000.0, help="total publish rate for open-loop mode (msgs/sec)")
+    parser.add_argument('--duration', type=float, default=10.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=1.0, help="seconds of load before measuring")
+    parser.add_argument('--fetch-interval', type=float, default=0.0, help="seconds each subscriber waits between fetches")
+    parser.add_argument('--transport', choices=TRANSPORTS, default='tcp', help="how clients connect (socket paths come from config.json)")
+    parser.add_argument('--profile', metavar='FILE', help="profile the server through its admin port and write collapsed stacks to FILE")
+    parser.add_argument('--admin-port', type=int, help="admin port for --profile (default: admin_port from config.json, else port + 1)")
+    parser.add_argument('--api', action='store_true', help="benchmark each API operation instead of the publish/subscribe workload")
+    parser.add_argument('--external', action='store_true', help="use an already running indexing server")
+    parser.add_argument('--server-pid', type=int, help="pid of an external server, for CPU and memory stats")
+    parser.add_argument('--label', default='', help="free-form label stored with the results")
+    parser.add_argument('--json', help="write results to this JSON file")
+    parser.add_argument('--csv', help="append results to this CSV file")
+    return parser.parse_args(argv)
+
+async def main(argv=None):
+    args = parse_args(argv)
+    config = load_config()
+    host = config['indexing_server']['ip']
+    port = config['indexing_server']['port']
+    transport = dict(transport_settings(config), type=args.transport)
+    admin_port = args.admin_port or config['indexing_server'].get('admin_port')
+    process = None
+    pid = args.server_pid
+    if not args.external:
+        # The admin port is off in config.json; open it for this run only when profiling
+        overrides = None
+        if args.profile:
+            admin_port = admin_port or port + 1
+            overrides = {"admin_port": admin_port}
+        process = await start_server_process(host, port, 'indexing_server.log', overrides=overrides)
+        pid = process.pid
+    elif args.profile and not admin_port:
+        raise SystemExit("--profile with --external needs the server's admin port: set --admin-port or admin_port in config.json")
+    admin = None
+    try:
+        if args.profile:
+            admin = BenchClient('admin')
+            await admin.connect(config['indexing_server'].get('admin_ip', '127.0.0.1'), admin_port)
+            await admin.request({"action": "profile_start", "seconds": args.warmup + args.duration + 60})
+        resources = ServerResources(pid)
+        if args.api:
+            resources.start()
+            result = {"params": {"peers": args.publishers, "duration": args.duration, "transport": args.transport},
+                      "operations": await benchmark_api_operations(host, port, args.publishers, args.duration, transport)}
+            result.update(resources.summary())
+        else:
+            workload = Workload(host, port, args.publishers, args.subscribers, args.topics, args.fanout,
+                                args.message_size, args.duration, args.mode, args.rate, args.fetch_interval, args.warmup,
+                                args.batch_size, args.compression, transport)
+            result = await workload.run(resources)
+        if admin:
+            result["profile"] = await save_profile(admin, args.profile)
+    finally:
+        if admin:
+            await admin.close()
+        if process:
+            stop_server_process(process)
+    result.update({"label": args.label, "commit": git_commit(), "timestamp": time.time()})
+    write_results([result], args.json, args.csv)
+    print(json.dumps(result, indent=2))
+    return result
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+import json
+import math
+import struct
+import sys
+import zlib
+from array import array
+
+# Batch codec name for column-encoded batches of structured records. Unlike the CODECS in
+# protocol.py it is never negotiated for plain batches; peers list it at register to say they
+# can decode it, and the server unpacks it into JSON records for peers that don't.
+COLUMNAR = "columnar"
+
+# Field types and the array typecode their column is packed as; strings are dictionary encoded
+TYPES = {"int64": 'q', "float64": 'd', "bool": 'B', "string": None}
+TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+TYPE_NAMES = list(TYPES)
+
+# Payload: header, then one (type, name) entry per field, then the columns in field order,
+# zlib-compressed as a whole when the flag is set. All integers are little-endian.
+HEADER = struct.Struct('<4sIBdH')  # magic, record count, flags, produced_at (NaN if unset), field count
+FIELD = struct.Struct('<BH')  # type code, name length in bytes
+MAGIC = b'COL1'
+COMPRESSED = 1
+
+def check_schema(fields):
+    # Normalizes a schema given as [{"name": ..., "type": ...}, ...] to [[name, type], ...];
+    # raises ValueError if it is malformed
+    if not isinstance(fields, list) or not fields:
+        raise ValueError("A schema must be a non-empty list of fields.")
+    normalized, names = [], set()
+    for field in fields:
+        name, kind = (field.get("name"), field.get("type")) if isinstance(field, dict) else (None, None)
+        if not isinstance(name, str) or not name or name in names:
+            raise ValueError("Every field needs a unique, non-empty 'name'.")
+        if kind not in TYPES:
+            raise ValueError(f"Field '{name}' has unknown type {kind!r}; expected one of {', '.join(TYPES)}.")
+        names.add(name)
+        normalized.append([name, kind])
+    return normalized
+
+def little_endian(column):
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+def encode_columns(fields, columns, produced_at=None, compress=True):
+    # fields as returned by check_schema; columns maps each field name to a sequence of values,
+    # all of the same length
+    count = len(columns[fields[0][0]]) if fields else 0
+    head = [HEADER.pack(MAGIC, count, COMPRESSED if compress else 0, math.nan if produced_at is None else produced_at, len(fields))]
+    body = []
+    for name, kind in fields:
+        values = columns[name]
+        if len(values) != count:
+            raise ValueError(f"Column '{name}' has {len(values)} values, expected {count}.")
+        encoded = name.encode()
+        head.append(FIELD.pack(TYPE_CODES[kind], len(encoded)) + encoded)
+        if kind == "string":
+            codes = {}
+            for value in values:
+                codes.setdefault(value, len(codes))
+            words = [value.encode() for value in codes]
+            body.append(struct.pack('<I', len(words)))
+            body.append(little_endian(array('I', map(len, words))).tobytes())
+            body.append(b''.join(words))
+            body.append(little_endian(array('I', map(codes.__getitem__, values))).tobytes())
+        else:
+            body.append(little_endian(array(TYPES[kind], values)).tobytes())
+    body = b''.join(body)
+    return b''.join(head) + (zlib.compress(body) if compress else body)
+
+def encode_records(fields, records, produced_at=None, compress=True):
+    return encode_columns(fields, {name: [record[name] for record in records] for name, _ in fields}, produced_at, compress)
+
+def read_header(payload):
+    # Returns (fields, count, produced_at, flags, body offset); raises ValueError if malformed
+    try:
+        magic, count, flags, produced_at, field_count = HEADER.unpack_from(payload, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a columnar batch.")
+        offset = HEADER.size
+        fields = []
+        for _ in range(field_count):
+            code, length = FIELD.unpack_from(payload, offset)
+            offset += FIELD.size
+            fields.append([bytes(payload[offset:offset + length]).decode(), TYPE_NAMES[code]])
+            offset += length
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError("Malformed columnar batch header.")
+    return fields, count, None if math.isnan(produced_at) else produced_at, flags, offset
+
+def decode_columns(payload):
+    # Returns (fields, count, produced_at, columns). Numeric and bool columns are arrays built
+    # straight from the packed bytes; string columns are lists. Raises ValueError if any column
+    # is short of count values or the body doesn't end with the last column.
+    fields, count, produced_at, flags, offset = read_header(payload)
+    try:
+        body = memoryview(zlib.decompress(payload[offset:]) if flags & COMPRESSED else payload[offset:])
+        columns = {}
+        position = 0
+        for name, kind in fields:
+            if kind == "string":
+                (size,) = struct.unpack_from('<I', body, position)
+                position += 4
+                lengths = take(body, position, 'I', size, name)
+                position += 4 * size
+                words, start = [], position
+                for length in lengths:
+                    words.append(bytes(body[start:start + length]).decode())
+                    start += length
+                if start > len(body):
+                    raise ValueError(f"Column '{name}' is truncated.")
+                position = start
+                codes = take(body, position, 'I', count, name)
+                position += 4 * count
+                columns[name] = [words[code] for code in codes]
+            else:
+                columns[name] = take(body, position, TYPES[kind], count, name)
+                position += columns[name].itemsize * count
+    except (zlib.error, struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed columnar batch: {e}")
+    if position != len(body):
+        raise ValueError(f"Columnar batch has {len(body) - position} bytes after its last column.")
+    return fields, count, produced_at, columns
+
+def take(body, position, typecode, count, name):
+    # The next count values of a column, or ValueError if the body ends first
+    column = unpack_array(typecode, body[position:position + array(typecode).itemsize * count])
+    if len(column) != count:
+        raise ValueError(f"Column '{name}' has {len(column)} values, expected {count}.")
+    return column
+
+def unpack_array(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+def to_records(fields, columns, count):
+    # Row view of decoded columns, for consumers that want one dict per record
+    names = [name for name, _ in fields]
+    bools = {name for name, kind in fields if kind == "bool"}
+    return [{name: bool(columns[name][i]) if name in bools else columns[name][i] for name in names} for i in range(count)]
+
+def json_items(payload):
+    # The batch as send_batch items [content, produced_at, trace_id], with each record as JSON text
+    fields, count, produced_at, columns = decode_columns(payload)
+    return [[json.dumps(record), produced_at, None] for record in to_records(fields, columns, count)]
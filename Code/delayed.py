@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+class DelayedStore:
+    # Publishes waiting for their delivery time, grouped in buckets of bucket_seconds by due time.
+    # Every bucket is also an append-only file <bucket>.jsonl in directory (when one is given),
+    # deleted once the bucket has been delivered, so pending entries survive a restart. Only the
+    # earliest bucket is kept ordered, as a heap; later buckets are plain lists until they come
+    # up. Adding an entry and taking a due one therefore cost O(log n) in the size of one bucket,
+    # and nothing is scanned while waiting.
+    def __init__(self, directory=None, bucket_seconds=1.0, fsync=False):
+        self.directory = directory
+        self.bucket_seconds = bucket_seconds
+        self.fsync = fsync
+        self.buckets = {}  # bucket: list of entries, for every bucket except the head
+        self.bucket_ids = []  # min-heap of the keys of self.buckets
+        self.head_id = None
+        self.head = []  # heap of (deliver_at, seq, entry) for bucket head_id
+        self.seq = itertools.count()
+        self.count = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return self.count
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.directory, f'{bucket}.jsonl')
+
+    def add(self, entries):
+        # entries are dicts with at least "deliver_at"; all entries of a bucket are written in one go
+        grouped = {}
+        for entry in entries:
+            grouped.setdefault(math.floor(entry['deliver_at'] / self.bucket_seconds), []).append(entry)
+        for bucket, group in grouped.items():
+            if self.directory:
+                with open(self.bucket_path(bucket), 'ab') as f:
+                    f.write(b''.join(json.dumps(entry).encode() + b'\n' for entry in group))
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+            self.insert(bucket, group)
+
+    def insert(self, bucket, group):
+        if self.head_id is not None and bucket < self.head_id:
+            # Earlier than the bucket being delivered; put that one back so the order is recomputed
+            self.buckets[self.head_id] = [entry for _, _, entry in self.head]
+            heapq.heappush(self.bucket_ids, self.head_id)
+            self.head_id = None
+            self.head = []
+        if bucket == self.head_id:
+            for entry in group:
+                heapq.heappush(self.head, (entry['deliver_at'], next(self.seq), entry))
+        else:
+            if bucket not in self.buckets:
+                self.buckets[bucket] = []
+                heapq.heappush(self.bucket_ids, bucket)
+            self.buckets[bucket].extend(group)
+        self.count += len(group)
+
+    def load_head(self):
+        if self.head_id is None and self.bucket_ids:
+            self.head_id = heapq.heappop(self.bucket_ids)
+            self.head = [(entry['deliver_at'], next(self.seq), entry) for entry in self.buckets.pop(self.head_id)]
+            heapq.heapify(self.head)
+
+    def next_due(self):
+        # deliver_at of the earliest entry, or None if nothing is pending
+        self.load_head()
+        return self.head[0][0] if self.head else None
+
+    def pop_due(self, now, limit=None):
+        # Removes and returns the entries due at or before now (at most limit), earliest first
+        due = []
+        while limit is None or len(due) < limit:
+            self.load_head()
+            if not self.head or self.head[0][0] > now:
+                return due
+            due.append(heapq.heappop(self.head)[2])
+            self.count -= 1
+            if not self.head:
+                if self.directory:
+                    try:
+                        os.unlink(self.bucket_path(self.head_id))
+                    except FileNotFoundError:
+                        pass
+                self.head_id = None
+        return due
+
+    def recover(self):
+        # Loads the bucket files left by an earlier run; returns the number of entries found
+        if not self.directory:
+            return 0
+        before = self.count
+        for name in os.listdir(self.directory):
+            bucket, ext = os.path.splitext(name)
+            if ext != '.jsonl' or not bucket.lstrip('-').isdigit():
+                continue
+            group = []
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                for line in f:
+                    try:
+                        group.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning("Ignoring incomplete record at the end of %s", name)
+                        break
+            if group:
+                self.insert(int(bucket), group)
+        return self.count - before
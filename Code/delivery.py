@@ -0,0 +1,107 @@
+import heapq
+import math
+import time
+from collections import deque
+
+class TimerWheel:
+    # Hierarchical timing wheel. Level 0 has `slots` slots of `tick` seconds each, and each
+    # level above covers `slots` times the span of the one below. A timer goes into the coarsest
+    # level it fits and moves down a level whenever its slot comes round, so scheduling is O(1)
+    # and each timer is touched at most once per level. Timers are never removed; callers
+    # ignore the ones that fire after they stopped caring.
+    def __init__(self, tick=0.1, slots=256, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.origin = time.monotonic() if now is None else now
+        self.current = 0  # ticks since origin processed so far
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []  # (due tick, item) beyond the top level's span
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, item):
+        due = max(math.ceil((deadline - self.origin) / self.tick), self.current + 1)
+        self.place(due, item)
+        self.count += 1
+
+    def place(self, due, item):
+        delta = due - self.current
+        span = self.slots
+        for level in range(self.levels):
+            if delta < span:
+                self.wheels[level][(due // (span // self.slots)) % self.slots].append((due, item))
+                return
+            span *= self.slots
+        self.overflow.append((due, item))
+
+    def advance(self, now):
+        # Returns the items of every timer due at or before now
+        target = int((now - self.origin) / self.tick)
+        expired = []
+        if not self.count:
+            self.current = max(self.current, target)
+            return expired
+        while self.current < target and self.count:
+            self.current += 1
+            span = 1
+            for level in range(1, self.levels):
+                span *= self.slots
+                if self.current % span:
+                    break
+                self.cascade(self.wheels[level], (self.current // span) % self.slots)
+            else:
+                if self.overflow:
+                    pending, self.overflow = self.overflow, []
+                    for due, item in pending:
+                        self.place(due, item)
+            self.cascade(self.wheels[0], self.current % self.slots, expired)
+        self.current = max(self.current, target)
+        return expired
+
+    def cascade(self, wheel, slot, expired=None):
+        timers, wheel[slot] = wheel[slot], []
+        for due, item in timers:
+            if due <= self.current and expired is not None:
+                expired.append(item)
+                self.count -= 1
+            else:
+                self.place(due, item)
+
+class LeaseState:
+    # At-least-once delivery state of one consumer on one topic. Messages are leased in log
+    # order from next_index; a leased message stays unresolved until it is acked or dead-lettered,
+    # and goes back into `redeliver` if its lease runs out first. Everything below the smallest
+    # unresolved index has been processed, which is the consumer's committed offset.
+    __slots__ = ('next_index', 'unresolved', 'order', 'redeliver')
+
+    def __init__(self, next_index):
+        self.next_index = next_index
+        self.unresolved = {}  # index: number of times delivered
+        self.order = []  # min-heap of unresolved indices; resolved ones are skipped lazily
+        self.redeliver = deque()  # indices whose lease ran out, waiting to go out again
+
+    def lease(self, index):
+        deliveries = self.unresolved.get(index, 0) + 1
+        if deliveries == 1:
+            heapq.heappush(self.order, index)
+        self.unresolved[index] = deliveries
+        return deliveries
+
+    def resolve(self, index):
+        return self.unresolved.pop(index, None) is not None
+
+    def resolve_through(self, up_to):
+        # Cumulative ack: resolves every leased index up to and including up_to
+        resolved = 0
+        while self.order and self.order[0] <= up_to:
+            resolved += self.resolve(heapq.heappop(self.order))
+        return resolved
+
+    def floor(self):
+        # Last index below which every message is resolved
+        while self.order and self.order[0] not in self.unresolved:
+            heapq.heappop(self.order)
+        return (self.order[0] if self.order else self.next_index) - 1
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class PushChannel:
+    # A subscriber connection that receives messages as they are published
+    def __init__(self, peer_id, writer):
+        self.peer_id = peer_id
+        self.writer = writer
+        self.cursors = {}  # topic: index of the next message to push
+        self.out = []  # frame chunks waiting for the next flush
+        self.blocked = False  # waiting for the transport buffer to drain
+        self.deferred = set()  # topics skipped while blocked
+        self.drain_task = None  # waits for the transport buffer to drain while blocked
+        self.closed = False
+
+class FanoutEngine:
+    # Pushes newly appended messages to attached subscribers outside the publisher's request.
+    # Appends only mark (topic, channel) pairs as pending, so a subscriber that falls behind gets
+    # everything since its cursor in one frame. A single worker serves pending topics round-robin,
+    # at most `quantum` channels per topic per turn, so one huge topic can't starve the rest.
+    def __init__(self, server, quantum=64, batch_limit=1000, high_water=1024 * 1024):
+        self.server = server
+        self.quantum = quantum
+        self.batch_limit = batch_limit
+        self.high_water = high_water
+        self.topic_channels = {}  # topic: set(PushChannel)
+        self.peer_channels = {}  # peer_id: set(PushChannel)
+        self.pending = {}  # topic: set(PushChannel) that are behind on the topic
+        self.ready = deque()  # topics with pending channels, in service order
+        self.wakeup = asyncio.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.run())
+            self.worker.add_done_callback(self.worker_done)
+
+    def worker_done(self, task):
+        # The worker only returns on an unexpected error; restart it so pushes don't stop for good
+        if task.cancelled():
+            return
+        logger.error("Fanout worker exited, restarting", exc_info=task.exception())
+        self.worker = None
+        self.start()
+        self.wakeup.set()
+
+    def attach(self, peer_id, writer, cursors):
+        # cursors maps topic -> last index the subscriber has already seen; other subscribed
+        # topics are pushed from their current end
+        channel = PushChannel(peer_id, writer)
+        self.peer_channels.setdefault(peer_id, set()).add(channel)
+        for topic in self.server.peer_subscriptions.get(peer_id, ()):
+            self.follow(channel, topic, cursors.get(topic))
+        self.start()
+        return channel
+
+    def detach(self, channel):
+        channel.closed = True
+        if channel.drain_task is not None:
+            channel.drain_task.cancel()
+            channel.drain_task = None
+        for topic in channel.cursors:
+            self.topic_channels.get(topic, set()).discard(channel)
+            self.pending.get(topic, set()).discard(channel)
+        channel.cursors.clear()
+        channels = self.peer_channels.get(channel.peer_id)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.peer_channels[channel.peer_id]
+
+    def follow(self, channel, topic, last_read=None):
+        log = self.server.messages[topic]
+        channel.cursors[topic] = len(log) if last_read is None else last_read + 1
+        self.topic_channels.setdefault(topic, set()).add(channel)
+        if channel.cursors[topic] < len(log):
+            self.mark(topic, [channel])
+
+    def subscribed(self, peer_id, topic):
+        for channel in self.peer_channels.get(peer_id, ()):
+            if topic not in channel.cursors:
+                self.follow(channel, topic)
+
+    def unsubscribed(self, peer_id, topic):
+        for channel in self.peer_channels.get(peer_id, ()):
+            channel.cursors.pop(topic, None)
+            self.topic_channels.get(topic, set()).discard(channel)
+            self.pending.get(topic, set()).discard(channel)
+
+    def topic_removed(self, topic):
+        for channel in self.topic_channels.pop(topic, ()):
+            channel.cursors.pop(topic, None)
+        self.pending.pop(topic, None)
+
+    def peer_removed(self, peer_id):
+        for channel in list(self.peer_channels.get(peer_id, ())):
+            self.detach(channel)
+            channel.writer.close()
+
+    def appended(self, topic):
+        channels = self.topic_channels.get(topic)
+        if channels:
+            self.mark(topic, channels)
+
+    def mark(self, topic, channels):
+        pending = self.pending.get(topic)
+        if pending is None:
+            pending = self.pending[topic] = set()
+        if not pending:
+            self.ready.append(topic)
+        pending.update(channels)
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.ready:
+                touched = set()
+                # One sweep: every topic that is ready now gets one turn
+                for _ in range(len(self.ready)):
+                    topic = self.ready.popleft()
+                    pending = self.pending.get(topic)
+                    if not pending:
+                        continue
+                    for _ in range(min(self.quantum, len(pending))):
+                        channel = pending.pop()
+                        try:
+                            if await self.deliver(channel, topic):
+                                touched.add(channel)
+                        except Exception:
+                            # Don't let one bad topic or channel stop pushes to everyone else
+                            logger.exception("Dropping push channel of peer %s after failing on topic %s",
+                                             channel.peer_id, topic)
+                            self.detach(channel)
+                            touched.discard(channel)
+                            channel.writer.close()
+                    if pending:
+                        self.ready.append(topic)
+                for channel in touched:
+                    self.flush(channel)
+                await asyncio.sleep(0)
+
+    async def deliver(self, channel, topic):
+        if channel.closed or topic not in channel.cursors:
+            return False
+        if channel.blocked:
+            channel.deferred.add(topic)
+            return False
+        log = self.server.messages.get(topic)
+        if log is None:
+            return False
+        start, end = log.bounds(channel.cursors[topic], self.batch_limit)
+        if end <= start:
+            return False
+        cold = None
+        if log.cold:
+            # A subscriber far behind may need archived segments, which are read off the event loop
+            cold = await self.server.load_archived(log, [(start, end)])
+            if channel.closed or channel.cursors.get(topic) != start or self.server.messages.get(topic) is not log:
+                # Detached, unsubscribed or deleted while waiting; a new subscription marks itself
+                return False
+        frame = self.server.messages_frame(topic, channel.peer_id, start, end, {"type": "push", "topic": topic}, cold)
+        channel.out.extend(frame.chunks)
+        channel.cursors[topic] = end
+        if end < len(log):
+            # More than batch_limit behind: come back to this channel on the topic's next turn
+            self.mark(topic, [channel])
+        return True
+
+    def flush(self, channel):
+        if channel.closed or not channel.out:
+            return
+        try:
+            channel.writer.writelines(channel.out)
+        except Exception as e:
+            logger.warning("Dropping push channel of peer %s: %s", channel.peer_id, e)
+            self.detach(channel)
+            return
+        finally:
+            channel.out = []
+        if channel.writer.transport.get_write_buffer_size() > self.high_water:
+            channel.blocked = True
+            channel.drain_task = asyncio.create_task(self.wait_for_drain(channel))
+
+    async def wait_for_drain(self, channel):
+        try:
+            await channel.writer.drain()
+        except Exception:
+            channel.drain_task = None
+            self.detach(channel)
+            return
+        channel.drain_task = None
+        channel.blocked = False
+        for topic in channel.deferred:
+            if topic in channel.cursors:
+                self.mark(topic, [channel])
+        channel.deferred.clear()
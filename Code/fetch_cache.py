@@ -0,0 +1,101 @@
+import asyncio
+from collections import OrderedDict
+
+class FetchCache:
+    # Size-bounded LRU of encoded fetch results keyed by (topic, start, end). Concurrent misses on
+    # the same key share one computation. An append only drops the entries that ended at the old
+    # tail of the topic; entries for full ranges stay valid until the topic goes away.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (records, size), least recently used first
+        self.tails = {}  # topic: set of keys whose range ended at the topic's last message
+        self.topic_keys = {}  # topic: set of keys
+        self.loading = {}  # key: Future of records being computed
+        self.epochs = {}  # topic: bumped on every append or removal, so stale loads aren't stored
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def get_now(self, key, load, tail):
+        # get() for callers that can't wait; load is a plain function
+        records = self.lookup(key)
+        if records is None:
+            self.misses += 1
+            records = load()
+            self.put(key, records, tail)
+        return records
+
+    async def get(self, key, load, tail):
+        # load is a coroutine function computing the records; tail says whether the range ends
+        # at the topic's last message
+        records = self.lookup(key)
+        if records is not None:
+            return records
+        future = self.loading.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        epoch = self.epochs.get(key[0], 0)
+        future = self.loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            records = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # waiters get the error; don't warn if there are none
+            raise
+        finally:
+            del self.loading[key]
+        future.set_result(records)
+        if self.epochs.get(key[0], 0) == epoch:
+            self.put(key, records, tail)
+        return records
+
+    def put(self, key, records, tail):
+        if self.max_bytes <= 0:
+            return
+        size = sum(len(chunk) for chunk in records)
+        if size > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = (records, size)
+        self.size += size
+        self.topic_keys.setdefault(key[0], set()).add(key)
+        if tail:
+            self.tails.setdefault(key[0], set()).add(key)
+        while self.size > self.max_bytes:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        records, size = self.entries.pop(key)
+        self.size -= size
+        topic = key[0]
+        keys = self.topic_keys[topic]
+        keys.discard(key)
+        if not keys:
+            del self.topic_keys[topic]
+        tails = self.tails.get(topic)
+        if tails is not None:
+            tails.discard(key)
+            if not tails:
+                del self.tails[topic]
+
+    def appended(self, topic):
+        self.epochs[topic] = self.epochs.get(topic, 0) + 1
+        for key in list(self.tails.get(topic, ())):
+            self.drop(key)
+
+    def topic_removed(self, topic):
+        self.epochs[topic] = self.epochs.get(topic, 0) + 1
+        for key in list(self.topic_keys.get(topic, ())):
+            self.drop(key)
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
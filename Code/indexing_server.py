@@ -1,103 +1,580 @@
 import asyncio
+import base64
+import bisect
+import concurrent.futures
+import heapq
 import json
+from collections import OrderedDict, deque
 import logging
+import logging.handlers
+import math
 import os
+import queue
 import signal
 import sys
+import time
+from columnar import COLUMNAR, check_schema, read_header
+from delayed import DelayedStore
+from delivery import LeaseState, TimerWheel
+from fanout import FanoutEngine
+from fetch_cache import FetchCache
+from message_store import ColdSegment, TopicLog
+from metadata_log import MetadataLog
+from profiling import RuntimeProfiler
+from scheduler import Connection, RequestScheduler
+from segment_archive import SegmentArchive
+from transport import start_servers, transport_settings
+from protocol import (CODECS, check_batch, compress_batch, encode_frame, encode_grouped_records_frame,
+                      encode_records_frame, expand_messages, negotiate_codec, read_frame)
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+# Per-request events (connects, fetches, publishes) go through this child logger so they can be rate limited
+request_logger = logging.getLogger(__name__ + '.requests')
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the record on the calling thread; hand it over untouched so
+    # formatting happens on the listener thread instead of the event loop.
+    def prepare(self, record):
+        return record
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket: lets through at most `rate` records per second, with bursts up to `rate`
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        if self.rate <= 0:
+            self.dropped += 1
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+class LagHistogram:
+    # Log-scale latency histogram: 4 buckets per power of two microseconds, fixed memory
+    BUCKETS = 4 * 40
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = min(int(math.log2(micros) * 4), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        target = p / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                # Upper bound of the bucket, in milliseconds
+                return 2 ** ((bucket + 1) / 4) / 1000
+        return self.max * 1000
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max * 1000,
+        }
+
+class ProducerWindow:
+    # Sequence state of one producer on one topic: the last accepted sequence number and the
+    # (index, count, deliver_at) of each of the most recent `size` sequences. index is None and
+    # deliver_at set for a publish that was scheduled for later delivery.
+    def __init__(self, size):
+        self.last_sequence = None
+        self.appended = deque(maxlen=size)
+
+    def lookup(self, sequence):
+        # Returns the (index, count, deliver_at) of an already accepted sequence, or None if it fell out of the window
+        position = sequence - self.last_sequence + len(self.appended) - 1
+        if 0 <= position < len(self.appended):
+            return self.appended[position]
+        return None
+
+    def accept(self, sequence, index, count, deliver_at=None):
+        self.last_sequence = sequence
+        self.appended.append((index, count, deliver_at))
+
+def make_executor(config):
+    # Worker pool for CPU-heavy request work; "thread" or "process", or None to do everything inline
+    kind = config['indexing_server'].get('executor', 'thread')
+    workers = config['indexing_server'].get('executor_workers')
+    if kind == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    if kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='indexing-worker')
+    return None
+
+def response_size_hint(response):
+    # Rough size of a response: the number of items in its list and dict fields
+    return sum(len(v) for v in response.values() if isinstance(v, (list, dict)))
+
+def request_limit(message, maximum):
+    # The request's "limit" capped at maximum, or maximum if it has none; raises ValueError
+    # unless it is a whole number of at least 1
+    limit = message.get("limit")
+    if limit is None:
+        return maximum
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if limit < 1:
+        raise ValueError("'limit' must be a positive integer.")
+    return min(limit, maximum)
+
+def request_last_read(message):
+    # The request's "last_read" offset, or -1 (read from the start) if it has none; raises
+    # ValueError unless it is a whole number of at least -1
+    last_read = message.get("last_read")
+    if last_read is None:
+        return -1
+    try:
+        last_read = int(last_read)
+    except (TypeError, ValueError):
+        last_read = -2
+    if last_read < -1:
+        raise ValueError("'last_read' must be an integer of at least -1.")
+    return last_read
+
+def expanded_records(records, last_read):
+    # Unpacks every compressed batch in records (comma-separated encoded records from the log)
+    # and returns the messages after last_read as pre-encoded records, plus the (base, count)
+    # of any batch that couldn't be decoded and was left out
+    skipped = []
+    messages = expand_messages(json.loads(b'[' + records + b']'), last_read, skipped)
+    return [json.dumps(messages)[1:-1].encode()], skipped
+
+def leased_messages(runs):
+    # runs are (start, end, records) with records the comma-separated encoded log records covering
+    # messages [start, end); returns exactly those messages, with compressed batches unpacked,
+    # and the batches skipped as in expanded_records
+    messages, skipped = [], []
+    for start, end, records in runs:
+        messages.extend(m for m in expand_messages(json.loads(b'[' + records + b']'), start - 1, skipped) if m[0] < end)
+    return messages, skipped
+
+def setup_logging(config):
+    log_config = config.get('logging', {})
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root = logging.getLogger()
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    root.setLevel(log_config.get('level', 'INFO'))
+    request_logger.addFilter(RateLimitFilter(log_config.get('request_log_rate', 50)))
+    listener.start()
+    return listener
 
 class IndexingServer:
     def __init__(self, config):
         self.host = config['indexing_server']['ip']
         self.port = config['indexing_server']['port']
+        # Admin requests (profiling) are served on their own port, off the request scheduler
+        self.admin_ip = config['indexing_server'].get('admin_ip', '127.0.0.1')
+        self.admin_port = config['indexing_server'].get('admin_port')
+        self.profiler = RuntimeProfiler()
+        self.transport = transport_settings(config)
         self.peers = {}  # peer_id: (ip, port)
         self.topics = {}  # topic_name: {host_peer: peer_id, subscribers: set(peer_ids)}
-        self.messages = {}  # topic_name: [(index, peer_id, content)]
+        self.hosted_topics = {}  # peer_id: set(topic_names) the peer hosts
+        self.peer_subscriptions = {}  # peer_id: set(topic_names) the peer is subscribed to
+        # A peer's session starts when it registers and lasts lease_seconds past its last request or heartbeat
+        self.lease_seconds = config['indexing_server'].get('session_lease_seconds', 30)
+        self.sessions = {}  # peer_id: time.monotonic() at which the lease runs out
+        self.lease_heap = []  # (expiry, peer_id), one entry per peer in lease_queued
+        self.lease_queued = set()
+        self.reaper = None
+        self.messages = {}  # topic_name: TopicLog
+        self.peer_codecs = {}  # peer_id: set of compression codecs the peer can decode
+        # Uncompressed batches at least this large are compressed with batch_compression before they are stored
+        self.batch_compression = config['indexing_server'].get('batch_compression')
+        self.compression_min_bytes = config['indexing_server'].get('compression_min_bytes', 1024)
+        self.producer_windows = {}  # topic_name: OrderedDict(producer_id: ProducerWindow), least recently used first
+        self.dedup_window = config['indexing_server'].get('dedup_window', 1000)
+        self.max_producers_per_topic = config['indexing_server'].get('max_producers_per_topic', 10000)
+        self.fanout = FanoutEngine(self, config['indexing_server'].get('fanout_quantum', 64),
+                                   config['indexing_server'].get('push_batch_limit', 1000),
+                                   config['indexing_server'].get('push_high_water', 1024 * 1024))
+        self.max_in_flight = config['indexing_server'].get('max_in_flight_per_connection', 32)
+        self.max_fetch_messages = config['indexing_server'].get('max_fetch_messages', 10000)
+        self.max_bulk_items = config['indexing_server'].get('max_bulk_items', 10000)
+        self.replay_chunk_size = config['indexing_server'].get('replay_chunk_size', 500)
+        self.scheduler = RequestScheduler(self.process_action, config['indexing_server'].get('scheduler_workers', 4),
+                                          config['indexing_server'].get('peer_weights', {}))
+        # Request bodies, responses and batches at least this big are decoded, encoded or
+        # (de)compressed on the executor instead of the event loop
+        self.executor = make_executor(config)
+        self.offload_min_bytes = config['indexing_server'].get('offload_min_bytes', 64 * 1024)
+        self.offload_min_items = config['indexing_server'].get('offload_min_items', 2000)
+        self.topic_lag = {}  # topic_name: LagHistogram of append-to-fetch lag
+        self.consumer_lag = {}  # topic_name: {peer_id: LagHistogram}
+        # Consumers that can't decode a topic's batches get them unpacked; the result is cached for
+        # everyone reading the same range
+        self.fetch_cache = FetchCache(config['indexing_server'].get('fetch_cache_bytes', 64 * 1024 * 1024))
+        self.committed_offsets = {}  # topic_name: {peer_id: last message index the consumer has processed}
+        self.schemas = {}  # topic_name: [fields of schema version 1, 2, ...], fields as [[name, type], ...]
+        # At-least-once delivery: leased messages come back after visibility_timeout seconds unless
+        # acked, and go to the topic's dead-letter topic once delivered max_deliveries times
+        self.visibility_timeout = config['indexing_server'].get('visibility_timeout', 30)
+        self.max_deliveries = config['indexing_server'].get('max_deliveries', 5)
+        self.dead_letter_suffix = config['indexing_server'].get('dead_letter_suffix', '.dlq')
+        self.lease_states = {}  # topic_name: {peer_id: LeaseState}
+        self.delivery_timers = TimerWheel(config['indexing_server'].get('delivery_timer_tick', 0.1))
+        self.timers_pending = asyncio.Event()
+        self.redelivery = None
+        # Publishes with deliver_at or delay_ms wait here, on disk under delayed_dir if set, until due
+        self.delayed = DelayedStore(config['indexing_server'].get('delayed_dir'),
+                                    config['indexing_server'].get('delayed_bucket_seconds', 1.0),
+                                    config['indexing_server'].get('delayed_fsync', False))
+        self.delayed_wakeup = asyncio.Event()
+        self.delayed_delivery = None
+        self.max_delayed_release = config['indexing_server'].get('max_delayed_release', 1000)
+        # With archive_dir set, closed segments beyond the newest hot_segments of a topic are
+        # compressed into the archive and read back on demand
+        archive_dir = config['indexing_server'].get('archive_dir')
+        self.archive = SegmentArchive(archive_dir, config['indexing_server'].get('archive_cache_bytes', 64 * 1024 * 1024),
+                                      config['indexing_server'].get('archive_compression_level', 6)) if archive_dir else None
+        self.hot_segments = config['indexing_server'].get('hot_segments', 2)
+        self.archive_read_ahead = config['indexing_server'].get('archive_read_ahead', 1)
+        self.archive_pending = deque()  # topics that may have segments to archive
+        self.archive_wakeup = asyncio.Event()
+        self.archiver = None
+        self.topic_names = []  # sorted topic names, used for cursor-based listing
+        self.topic_version = 0  # bumped on every topic create/delete
+        self.topic_changes = []  # [(version, op, topic_name)], oldest first
+        self.max_topic_changes = config['indexing_server'].get('topic_change_log_size', 100000)
+        self.topic_page_size = config['indexing_server'].get('topic_page_size', 500)
         self.registered_peers_file = 'registered_peers.json'
+        # Topic and subscription changes are persisted here when a path is configured
+        self.metadata_log = MetadataLog(config['indexing_server'].get('metadata_wal'),
+                                        config['indexing_server'].get('metadata_wal_fsync', False))
+        # Message contents are only written to the log when explicitly enabled
+        self.log_content = config.get('logging', {}).get('log_content', False)
         self.load_registered_peers()
+        self.recover_metadata()
+        recovered = self.delayed.recover()
+        if recovered:
+            logger.info("Recovered %d delayed publishes", recovered)
 
     async def start(self):
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
-        logger.info(f"Indexing server starting on {self.host}:{self.port}")
-        async with server:
-            await server.serve_forever()
+        self.start_background_tasks()
+        servers = await start_servers(self.transport, self.handle_client, self.host, self.port)
+        logger.info("Indexing server starting on %s:%s", self.host, self.port)
+        if self.admin_port:
+            servers.append(await asyncio.start_server(self.handle_admin, self.admin_ip, self.admin_port))
+            logger.info("Admin port listening on %s:%s", self.admin_ip, self.admin_port)
+        for kind in ('unix', 'shm'):
+            if self.transport.get(f'{kind}_path'):
+                logger.info("Accepting %s connections on %s", kind, self.transport[f'{kind}_path'])
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
 
     async def handle_client(self, reader, writer):
         addr = writer.get_extra_info('peername')
-        logger.info(f"New connection from {addr}")
+        request_logger.info("New connection from %s", addr)
+        self.start_background_tasks()
+        connection = Connection(writer, self.max_in_flight, self.encode_response, self.profiler)
+        registered = set()  # peers registered over this connection; only they can share a heartbeat
         try:
             while True:
-                data = await reader.read(4096)
-                if not data:
+                message = await read_frame(reader, self.decode_request)
+                if message is None:
                     break
-                message = json.loads(data.decode())
                 action = message.get("action")
                 peer_id = message.get("peer_id")
                 if not action or not peer_id:
-                    response = {"status": "error", "message": "Missing 'action' or 'peer_id'."}
+                    connection.respond({"status": "error", "message": "Missing 'action' or 'peer_id'."})
+                elif action == "attach_push":
+                    # The connection becomes a push channel for the rest of its life
+                    await connection.finish()
+                    await self.serve_push_channel(message, peer_id, reader, writer)
+                    break
+                elif action == "replay":
+                    # Answered with several frames, so it runs once every earlier response is out
+                    # and the connection reads nothing else until the replay is done
+                    await connection.finish()
+                    await self.stream_replay(message, peer_id, writer)
+                    connection = Connection(writer, self.max_in_flight, self.encode_response, self.profiler)
                 else:
-                    response = await self.process_action(action, message, peer_id)
-                writer.write(json.dumps(response).encode())
-                await writer.drain()
+                    error = self.check_heartbeat(message, peer_id, registered) if action == "heartbeat" else None
+                    if error:
+                        connection.respond(error)
+                        continue
+                    if action == "register":
+                        registered.add(peer_id)
+                    await connection.submit(self.scheduler, action, message, peer_id)
+            await connection.finish()
+        except asyncio.CancelledError:
+            # The server is shutting down; end quietly rather than as a cancelled connection callback
+            connection.abort()
         except Exception as e:
-            logger.error(f"Error handling client {addr}: {e}")
+            logger.error("Error handling client %s: %s", addr, e)
+            connection.abort()
         finally:
             writer.close()
             await writer.wait_closed()
-            logger.info(f"Connection closed for {addr}")
+            request_logger.info("Connection closed for %s", addr)
+
+    def start_background_tasks(self):
+        self.scheduler.start()
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.expire_sessions())
+        if self.redelivery is None:
+            self.redelivery = asyncio.create_task(self.expire_leases())
+        if self.delayed_delivery is None:
+            self.delayed_delivery = asyncio.create_task(self.deliver_delayed())
+        if self.archive and self.archiver is None:
+            self.archiver = asyncio.create_task(self.archive_segments())
+
+    def renew_session(self, peer_id):
+        self.sessions[peer_id] = time.monotonic() + self.lease_seconds
+        if peer_id not in self.lease_queued:
+            self.lease_queued.add(peer_id)
+            heapq.heappush(self.lease_heap, (self.sessions[peer_id], peer_id))
+
+    async def expire_sessions(self):
+        # Renewals only overwrite self.sessions; the heap entry of a renewed session is pushed back
+        # when it comes due. Each pass therefore touches the due entries only, and each live
+        # session costs one heap operation per lease period however often it heartbeats.
+        while True:
+            now = time.monotonic()
+            while self.lease_heap and self.lease_heap[0][0] <= now:
+                _, peer_id = heapq.heappop(self.lease_heap)
+                expires = self.sessions.get(peer_id)
+                if expires is not None and expires > now:
+                    heapq.heappush(self.lease_heap, (expires, peer_id))
+                    continue
+                self.lease_queued.discard(peer_id)
+                if expires is not None:
+                    logger.warning("Session of peer %s expired", peer_id)
+                    try:
+                        self.end_session(peer_id)
+                    except Exception as e:
+                        logger.error("Error expiring session of peer %s: %s", peer_id, e)
+            await asyncio.sleep(self.lease_heap[0][0] - now if self.lease_heap else self.lease_seconds)
+
+    def end_session(self, peer_id):
+        # Drops the peer's lease, push channels and subscriptions, and hands its topics to a live peer
+        self.sessions.pop(peer_id, None)
+        self.fanout.peer_removed(peer_id)
+        ops = [['unsubscribe', topic, peer_id] for topic in self.peer_subscriptions.get(peer_id, ())]
+        hosted = list(self.hosted_topics.get(peer_id, ()))
+        new_host = self.select_new_host(peer_id)
+        if new_host:
+            ops += [['host', topic, new_host] for topic in hosted]
+            logger.info("%d topics of peer %s reassigned to peer %s", len(hosted), peer_id, new_host)
+        elif hosted:
+            ops += [['delete', topic, None] for topic in hosted]
+            logger.info("%d topics of peer %s deleted due to no available hosts", len(hosted), peer_id)
+        self.commit_metadata(ops)
+        self.hosted_topics.pop(peer_id, None)
+        self.peer_subscriptions.pop(peer_id, None)
+
+    async def offload(self, size, threshold, func, *args):
+        # Runs func(*args) on the executor when size reaches threshold, inline otherwise
+        if self.executor is None or size < threshold:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def decode_request(self, body):
+        if not self.profiler.active:
+            return await self.offload(len(body), self.offload_min_bytes, json.loads, body)
+        started = time.perf_counter()
+        message = await self.offload(len(body), self.offload_min_bytes, json.loads, body)
+        self.profiler.record(message.get("action") if isinstance(message, dict) else None, 'decode', time.perf_counter() - started)
+        return message
+
+    async def encode_response(self, response):
+        return await self.offload(response_size_hint(response), self.offload_min_items, encode_frame, response)
+
+    async def serve_push_channel(self, message, peer_id, reader, writer):
+        if peer_id not in self.peers:
+            writer.write(encode_frame({"status": "error", "message": f"Peer {peer_id} is not registered."}))
+            await writer.drain()
+            return
+        cursors = message.get("cursors") or {}
+        channel = self.fanout.attach(peer_id, writer, cursors)
+        writer.write(encode_frame({"status": "push_attached", "topics": sorted(channel.cursors)}))
+        request_logger.info("Peer %s attached a push channel for %d topics", peer_id, len(channel.cursors))
+        try:
+            while await read_frame(reader) is not None:
+                pass
+        finally:
+            self.fanout.detach(channel)
 
     async def process_action(self, action, message, peer_id):
+        if peer_id in self.sessions:
+            self.renew_session(peer_id)
         actions = {
             "register": self.register_peer,
             "unregister": self.unregister_peer,
+            "heartbeat": self.heartbeat,
             "create_topic": self.create_topic,
             "delete_topic": self.delete_topic,
             "subscribe": self.subscribe_topic,
+            "bulk_create_topics": self.bulk_create_topics,
+            "bulk_delete_topics": self.bulk_delete_topics,
+            "bulk_subscribe": self.bulk_subscribe,
+            "resume": self.resume,
             "send_message": self.send_message,
+            "send_batch": self.send_batch,
             "get_messages": self.get_messages,
+            "seek": self.seek,
+            "fetch": self.fetch,
+            "commit_offsets": self.commit_offsets,
+            "lease": self.lease_messages,
+            "ack": self.ack_messages,
+            "register_schema": self.register_schema,
+            "get_schema": self.get_schema,
             "view_subscribed_topics": self.view_subscribed_topics,
             "view_created_topics": self.view_created_topics,
-            "get_topic_host": self.get_topic_host
+            "get_topic_host": self.get_topic_host,
+            "get_lag_stats": self.get_lag_stats
         }
         handler = actions.get(action)
-        if handler:
+        if not handler:
+            return {"status": "error", "message": f"Unknown action '{action}'."}
+        if not self.profiler.active:
+            return await handler(message, peer_id)
+        started = time.perf_counter()
+        try:
             return await handler(message, peer_id)
-        return {"status": "error", "message": f"Unknown action '{action}'."}
+        finally:
+            self.profiler.record(action, 'handler', time.perf_counter() - started)
+
+    async def handle_admin(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        logger.info("Admin connection from %s", addr)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                writer.write(encode_frame(await self.admin_action(message)))
+                await writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error("Error handling admin connection %s: %s", addr, e)
+        finally:
+            writer.close()
+
+    async def admin_action(self, message):
+        # profile_start runs the profiler for `seconds` (sampling every interval_ms and reporting
+        # callbacks that hold the loop for slow_callback_ms); profile_stop ends it early; both
+        # profile_stop and profile_report return what was collected by the last run
+        action = message.get("action")
+        if action == "profile_start":
+            try:
+                seconds = float(message.get("seconds") or 30)
+                interval = float(message.get("interval_ms") or 5) / 1000
+                slow_callback = float(message.get("slow_callback_ms") or 100) / 1000
+            except (TypeError, ValueError):
+                return {"status": "error", "message": "'seconds', 'interval_ms' and 'slow_callback_ms' must be numbers."}
+            try:
+                self.profiler.start(asyncio.get_running_loop(), seconds, interval, slow_callback)
+            except (ValueError, OverflowError, OSError) as e:
+                return {"status": "error", "message": f"Could not start profiling: {e}"}
+            logger.info("Profiling started for %s seconds", seconds)
+            return {"status": "profiling", "seconds": seconds}
+        if action == "profile_stop":
+            self.profiler.stop()
+            logger.info("Profiling stopped")
+            return dict(self.profiler.report(), status="profile_report")
+        if action == "profile_report":
+            return dict(self.profiler.report(), status="profile_report")
+        return {"status": "error", "message": f"Unknown admin action '{action}'."}
 
     async def register_peer(self, message, peer_id):
+        offered = message.get("compression") or []
+        self.peer_codecs[peer_id] = {codec for codec in offered if codec in CODECS or codec == COLUMNAR}
+        codec = negotiate_codec(offered)
+        address = (message.get('ip'), message.get('port'))
+        self.renew_session(peer_id)
         if peer_id in self.peers:
-            logger.info(f"Peer {peer_id} already registered. Logging in.")
-            return {"status": "logged_in", "message": f"Peer {peer_id} already registered. Logging in."}
-        self.peers[peer_id] = (message.get('ip'), message.get('port'))
+            if message.get('ip') and tuple(self.peers[peer_id]) != address:
+                # The peer came back from a different address (e.g. restarted on another port)
+                self.peers[peer_id] = address
+                self.save_registered_peers()
+                logger.info("Peer %s moved to %s", peer_id, address)
+            logger.info("Peer %s already registered. Logging in.", peer_id)
+            return {"status": "logged_in", "message": f"Peer {peer_id} already registered. Logging in.", "compression": codec,
+                    "lease_seconds": self.lease_seconds}
+        self.peers[peer_id] = address
         self.save_registered_peers()
-        logger.info(f"New user {peer_id} registered from {self.peers[peer_id]}")
-        return {"status": "registered", "message": f"New user {peer_id} registered and logged in successfully."}
+        logger.info("New user %s registered from %s", peer_id, self.peers[peer_id])
+        return {"status": "registered", "message": f"New user {peer_id} registered and logged in successfully.", "compression": codec,
+                "lease_seconds": self.lease_seconds}
 
     async def unregister_peer(self, message, peer_id):
         if peer_id not in self.peers:
             return {"status": "error", "message": f"Peer {peer_id} does not exist."}
         del self.peers[peer_id]
         self.save_registered_peers()
-        for topic, data in list(self.topics.items()):
-            if data['host_peer'] == peer_id:
-                new_host = self.select_new_host(peer_id)
-                if new_host:
-                    data['host_peer'] = new_host
-                    logger.info(f"Topic '{topic}' reassigned to peer {new_host}")
-                else:
-                    del self.topics[topic]
-                    if topic in self.messages:
-                        del self.messages[topic]
-                    logger.info(f"Topic '{topic}' deleted due to no available hosts")
-            data['subscribers'].discard(peer_id)
-        logger.info(f"Unregistered peer {peer_id}")
+        self.end_session(peer_id)
+        logger.info("Unregistered peer %s", peer_id)
         return {"status": "unregistered", "message": f"Peer {peer_id} unregistered successfully."}
 
+    def check_heartbeat(self, message, peer_id, registered):
+        # A heartbeat's peer_ids may only name the sender and peers registered over the same connection
+        peer_ids = message.get("peer_ids")
+        if peer_ids is None:
+            return None
+        if not isinstance(peer_ids, list) or not all(isinstance(p, str) for p in peer_ids):
+            return {"status": "error", "message": "'peer_ids' must be a list of peer ids."}
+        foreign = sorted(set(peer_ids) - registered - {peer_id})
+        if foreign:
+            return {"status": "error", "message": f"Peers {', '.join(foreign)} were not registered over this connection."}
+        return None
+
+    async def heartbeat(self, message, peer_id):
+        # Renews the leases of peer_ids (default: just the sender), so a process running many
+        # peers over one connection can keep them all alive with one request. handle_client has
+        # already checked peer_ids. Peers whose session is gone are reported back in "expired"
+        # and have to register again.
+        expired = []
+        for p in message.get("peer_ids") or [peer_id]:
+            if p in self.sessions:
+                self.renew_session(p)
+            else:
+                expired.append(p)
+        return {"status": "heartbeat_ok", "lease_seconds": self.lease_seconds, "expired": expired}
+
     def select_new_host(self, old_host):
-        available_peers = [p for p in self.peers if p != old_host]
-        return available_peers[0] if available_peers else None
+        # Only peers with a live session are candidates, so a topic never moves to a dead host
+        for peer_id in self.sessions:
+            if peer_id != old_host:
+                return peer_id
+        return None
 
     async def create_topic(self, message, peer_id):
         topic = message.get("topic")
@@ -105,9 +582,8 @@ class IndexingServer:
             return {"status": "error", "message": "Missing 'topic' field."}
         if topic in self.topics:
             return {"status": "error", "message": f"Topic '{topic}' already exists."}
-        self.topics[topic] = {'host_peer': peer_id, 'subscribers': set()}
-        self.messages[topic] = []
-        logger.info(f"Peer {peer_id} created topic '{topic}'")
+        self.commit_metadata([['create', topic, peer_id]])
+        request_logger.info("Peer %s created topic '%s'", peer_id, topic)
         return {"status": "topic_created", "message": f"Topic '{topic}' created successfully."}
 
     async def delete_topic(self, message, peer_id):
@@ -118,10 +594,8 @@ class IndexingServer:
             return {"status": "error", "message": f"Topic '{topic}' does not exist."}
         if self.topics[topic]['host_peer'] != peer_id:
             return {"status": "error", "message": f"Peer {peer_id} is not the host of topic '{topic}'."}
-        del self.topics[topic]
-        if topic in self.messages:
-            del self.messages[topic]
-        logger.info(f"Peer {peer_id} deleted topic '{topic}'")
+        self.commit_metadata([['delete', topic, None]])
+        request_logger.info("Peer %s deleted topic '%s'", peer_id, topic)
         return {"status": "topic_deleted", "message": f"Topic '{topic}' deleted successfully."}
 
     async def subscribe_topic(self, message, peer_id):
@@ -130,16 +604,121 @@ class IndexingServer:
             return {"status": "error", "message": "Missing 'topic' field."}
         if topic not in self.topics:
             return {"status": "error", "message": f"Topic '{topic}' does not exist."}
-        self.topics[topic]['subscribers'].add(peer_id)
+        if peer_id not in self.topics[topic]['subscribers']:
+            self.commit_metadata([['subscribe', topic, peer_id]])
         host_peer_id = self.topics[topic]['host_peer']
         host_ip, host_port = self.peers[host_peer_id]
-        logger.info(f"Peer {peer_id} subscribed to topic '{topic}'")
+        request_logger.info("Peer %s subscribed to topic '%s'", peer_id, topic)
         return {
             "status": "subscribed",
             "message": f"Subscribed to topic '{topic}' successfully.",
             "host_peer": {"id": host_peer_id, "ip": host_ip, "port": host_port}
         }
 
+    def check_bulk(self, topics):
+        if not isinstance(topics, list) or not topics:
+            return {"status": "error", "message": "'topics' must be a non-empty list."}
+        if len(topics) > self.max_bulk_items:
+            return {"status": "error", "message": f"At most {self.max_bulk_items} topics per bulk request."}
+        return None
+
+    # Bulk actions check every item against the current state, log all accepted changes in a
+    # single metadata record, then apply them. Nothing in between awaits, so no other request
+    # can interleave. The response holds one result per item, in request order.
+    async def bulk_create_topics(self, message, peer_id):
+        topics = message.get("topics")
+        error = self.check_bulk(topics)
+        if error:
+            return error
+        ops, results, planned = [], [], set()
+        for topic in topics:
+            if not topic or not isinstance(topic, str):
+                results.append({"topic": topic, "status": "error", "message": "Topic names must be non-empty strings."})
+            elif topic in self.topics or topic in planned:
+                results.append({"topic": topic, "status": "error", "message": f"Topic '{topic}' already exists."})
+            else:
+                planned.add(topic)
+                ops.append(['create', topic, peer_id])
+                results.append({"topic": topic, "status": "topic_created"})
+        self.commit_metadata(ops)
+        request_logger.info("Peer %s created %d of %d topics in bulk", peer_id, len(ops), len(topics))
+        return {"status": "bulk_result", "applied": len(ops), "results": results}
+
+    async def bulk_delete_topics(self, message, peer_id):
+        topics = message.get("topics")
+        error = self.check_bulk(topics)
+        if error:
+            return error
+        ops, results, planned = [], [], set()
+        for topic in topics:
+            if not isinstance(topic, str) or topic not in self.topics or topic in planned:
+                results.append({"topic": topic, "status": "error", "message": f"Topic '{topic}' does not exist."})
+            elif self.topics[topic]['host_peer'] != peer_id:
+                results.append({"topic": topic, "status": "error", "message": f"Peer {peer_id} is not the host of topic '{topic}'."})
+            else:
+                planned.add(topic)
+                ops.append(['delete', topic, None])
+                results.append({"topic": topic, "status": "topic_deleted"})
+        self.commit_metadata(ops)
+        request_logger.info("Peer %s deleted %d of %d topics in bulk", peer_id, len(ops), len(topics))
+        return {"status": "bulk_result", "applied": len(ops), "results": results}
+
+    async def bulk_subscribe(self, message, peer_id):
+        topics = message.get("topics")
+        error = self.check_bulk(topics)
+        if error:
+            return error
+        ops, results, planned = [], [], set()
+        for topic in topics:
+            if not isinstance(topic, str) or topic not in self.topics:
+                results.append({"topic": topic, "status": "error", "message": f"Topic '{topic}' does not exist."})
+                continue
+            if peer_id not in self.topics[topic]['subscribers'] and topic not in planned:
+                planned.add(topic)
+                ops.append(['subscribe', topic, peer_id])
+            host_peer_id = self.topics[topic]['host_peer']
+            host_ip, host_port = self.peers[host_peer_id]
+            results.append({"topic": topic, "status": "subscribed", "host_peer": {"id": host_peer_id, "ip": host_ip, "port": host_port}})
+        self.commit_metadata(ops)
+        request_logger.info("Peer %s subscribed to %d of %d topics in bulk", peer_id,
+                            sum(1 for result in results if result["status"] == "subscribed"), len(topics))
+        return {"status": "bulk_result", "applied": len(ops), "results": results}
+
+    async def resume(self, message, peer_id):
+        # Warm restart of a peer from its saved state in one request: subscribes it to every topic
+        # in `topics` (topic: saved last_read, or null) and returns where to continue reading each:
+        # the saved position, or the committed offset when there is none. A saved position past
+        # the end of the log (the server lost its messages in a restart) is moved back to the end.
+        # With catalog_version, the topic changes since that version come back under "catalog".
+        topics = message.get("topics")
+        if not isinstance(topics, dict):
+            return {"status": "error", "message": "'topics' must map topic names to saved read positions."}
+        if len(topics) > self.max_bulk_items:
+            return {"status": "error", "message": f"At most {self.max_bulk_items} topics per bulk request."}
+        ops, positions, errors = [], {}, {}
+        for topic, last_read in topics.items():
+            if topic not in self.topics:
+                errors[topic] = f"Topic '{topic}' does not exist."
+                continue
+            if last_read is not None and (not isinstance(last_read, int) or last_read < -1):
+                errors[topic] = "Saved positions must be integers of at least -1."
+                continue
+            if peer_id not in self.topics[topic]['subscribers']:
+                ops.append(['subscribe', topic, peer_id])
+            committed = self.committed_offsets.get(topic, {}).get(peer_id, -1)
+            end = len(self.messages[topic])
+            positions[topic] = {"last_read": min(committed if last_read is None else last_read, end - 1),
+                                "committed": committed, "end": end}
+        self.commit_metadata(ops)
+        response = {"status": "resumed", "topics": positions, "errors": errors}
+        if message.get("catalog_version") is not None:
+            try:
+                response["catalog"] = self.topic_changes_since(int(message["catalog_version"]), self.topic_page_size, peer_id)
+            except (TypeError, ValueError):
+                return {"status": "error", "message": "'catalog_version' must be an integer."}
+        request_logger.info("Peer %s resumed %d of %d topics", peer_id, len(positions), len(topics))
+        return response
+
     async def send_message(self, message, peer_id):
         topic = message.get("topic")
         content = message.get("content")
@@ -147,50 +726,792 @@ class IndexingServer:
         # Check if both topic and content are provided
         if not topic or not content:
             return {"status": "error", "message": "Missing 'topic' or 'content' field."}
-        
+        if not isinstance(content, str):
+            return {"status": "error", "message": "'content' must be a string."}
+
         # Check if the topic exists
         if topic not in self.topics:
             return {"status": "error", "message": f"Topic '{topic}' does not exist."}
 
         # Allow any peer to send a message to the topic (remove the host restriction)
         if topic not in self.messages:
-            self.messages[topic] = []
-        
-        index = len(self.messages[topic])
-        self.messages[topic].append((index, peer_id, content))
-        
+            self.messages[topic] = TopicLog()
+
+        try:
+            deliver_at = self.delivery_time(message)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+
+        window, duplicate = self.check_sequence(topic, message)
+        if duplicate:
+            return duplicate
+        if deliver_at:
+            self.schedule_delayed(topic, peer_id, {"messages": [[content, message.get("produced_at"), message.get("trace_id")]]}, deliver_at)
+            if window:
+                window.accept(message["sequence"], None, 1, deliver_at)
+            request_logger.info("Peer %s scheduled a message to topic '%s' for %s", peer_id, topic, deliver_at)
+            return {"status": "message_scheduled", "message": "Message scheduled successfully.", "deliver_at": deliver_at}
+
+        # produced_at is the producer's clock, appended_at is ours; both are Unix timestamps
+        appended_at = time.time()
+        index = self.messages[topic].append(peer_id, content, message.get("produced_at"), appended_at, message.get("trace_id"))
+        appended_at = self.messages[topic].appended_at[index]
+        if window:
+            window.accept(message["sequence"], index, 1)
+        self.messages_appended(topic)
+
         # Log and return success message
-        logger.info(f"Peer {peer_id} sent message to topic '{topic}': {content}")
-        return {"status": "message_sent", "message": "Message sent successfully."}
+        if self.log_content:
+            request_logger.info("Peer %s sent message to topic '%s': %s", peer_id, topic, content)
+        else:
+            request_logger.info("Peer %s sent message %d to topic '%s'", peer_id, index, topic)
+        return {"status": "message_sent", "message": "Message sent successfully.", "index": index, "appended_at": appended_at}
 
 
-    async def get_messages(self, message, peer_id):
+    async def send_batch(self, message, peer_id):
+        # Either a compressed batch ("codec", "count", "data"), stored as is, or a plain
+        # list of "messages" given as [content, produced_at, trace_id]. A columnar batch is a
+        # compressed batch with codec "columnar" and the "schema_version" it was encoded with.
         topic = message.get("topic")
-        last_read = message.get("last_read", -1)
+        if not topic:
+            return {"status": "error", "message": "Missing 'topic' field."}
+        if topic not in self.topics:
+            return {"status": "error", "message": f"Topic '{topic}' does not exist."}
+        codec = message.get("codec")
+        if codec:
+            count = message.get("count")
+            data = message.get("data")
+            if codec not in CODECS and codec != COLUMNAR:
+                return {"status": "error", "message": f"Unsupported compression codec '{codec}'."}
+            if not isinstance(count, int) or count < 1 or not isinstance(data, str):
+                return {"status": "error", "message": "Compressed batches need a positive 'count' and 'data'."}
+            if codec == COLUMNAR:
+                error = self.check_columnar(topic, message.get("schema_version"), data, count)
+                if error:
+                    return error
+            # Consumers that can't read the codec get the batch unpacked by the server, so make
+            # sure all of it decodes, every column included, before accepting it
+            try:
+                await self.offload(len(data), self.offload_min_bytes, check_batch, codec, data, count)
+            except ValueError as e:
+                return {"status": "error", "message": str(e)}
+        else:
+            items = message.get("messages")
+            if not items or not all(isinstance(item, list) and len(item) == 3 and isinstance(item[0], str) and item[0] for item in items):
+                return {"status": "error", "message": "'messages' must be a list of [content, produced_at, trace_id]."}
+            count = len(items)
+            size = sum(len(item[0]) for item in items)
+            if self.batch_compression and count > 1 and size >= self.compression_min_bytes:
+                codec = self.batch_compression
+                data = await self.offload(size, self.offload_min_bytes, compress_batch, codec, items)
+        try:
+            deliver_at = self.delivery_time(message)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        # Nothing below awaits, so the sequence check and the append happen atomically
+        window, duplicate = self.check_sequence(topic, message)
+        if duplicate:
+            return duplicate
+        if topic not in self.messages:
+            return {"status": "error", "message": f"Topic '{topic}' does not exist."}
+        if deliver_at:
+            entry = {"codec": codec, "count": count, "data": data, "schema_version": message.get("schema_version")} if codec else {"messages": items}
+            self.schedule_delayed(topic, peer_id, entry, deliver_at)
+            if window:
+                window.accept(message["sequence"], None, count, deliver_at)
+            request_logger.info("Peer %s scheduled a batch of %d messages to topic '%s' for %s", peer_id, count, topic, deliver_at)
+            return {"status": "batch_scheduled", "message": "Batch scheduled successfully.", "count": count, "deliver_at": deliver_at}
+        log = self.messages[topic]
+        appended_at = time.time()
+        if codec:
+            index = log.append_batch(peer_id, codec, data, count, appended_at, message.get("schema_version"))
+        else:
+            index = len(log)
+            for content, produced_at, trace_id in items:
+                log.append(peer_id, content, produced_at, appended_at, trace_id)
+        appended_at = log.appended_at[index]
+        if window:
+            window.accept(message["sequence"], index, count)
+        self.messages_appended(topic)
+        request_logger.info("Peer %s sent a batch of %d messages to topic '%s'", peer_id, count, topic)
+        return {"status": "batch_sent", "message": "Batch sent successfully.", "index": index, "count": count, "appended_at": appended_at}
+
+    def check_columnar(self, topic, schema_version, data, count):
+        # A columnar batch must carry a registered schema version of the topic and match it exactly.
+        # Only the header is read here; send_batch then decodes the columns with check_batch.
+        versions = self.schemas.get(topic, [])
+        if not isinstance(schema_version, int) or not 1 <= schema_version <= len(versions):
+            return {"status": "error", "message": f"Topic '{topic}' has no schema version {schema_version}."}
+        try:
+            fields, records, _, _, _ = read_header(base64.b64decode(data[:65536]))
+        except (ValueError, TypeError):
+            return {"status": "error", "message": "Malformed columnar batch."}
+        if fields != versions[schema_version - 1] or records != count:
+            return {"status": "error", "message": f"Batch does not match schema version {schema_version} of topic '{topic}' or its count."}
+        return None
+
+    async def register_schema(self, message, peer_id):
+        # Adds a schema version to the topic; registering the latest version again returns its number
+        topic = message.get("topic")
+        if not topic:
+            return {"status": "error", "message": "Missing 'topic' field."}
+        if topic not in self.topics:
+            return {"status": "error", "message": f"Topic '{topic}' does not exist."}
+        try:
+            fields = check_schema(message.get("fields"))
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        versions = self.schemas.get(topic, [])
+        if not versions or versions[-1] != fields:
+            self.commit_metadata([['schema', topic, fields]])
+            request_logger.info("Peer %s registered schema version %d of topic '%s'", peer_id, len(self.schemas[topic]), topic)
+        return {"status": "schema_registered", "topic": topic, "version": len(self.schemas[topic]), "fields": fields}
+
+    async def get_schema(self, message, peer_id):
+        topic = message.get("topic")
+        versions = self.schemas.get(topic)
+        if not versions:
+            return {"status": "error", "message": f"Topic '{topic}' has no schema."}
+        version = message.get("version") or len(versions)
+        if not isinstance(version, int) or not 1 <= version <= len(versions):
+            return {"status": "error", "message": f"Topic '{topic}' has no schema version {version}."}
+        return {"status": "schema", "topic": topic, "version": version, "fields": versions[version - 1], "latest": len(versions)}
+
+    def delivery_time(self, message):
+        # When a publish should become visible: "deliver_at" as a Unix timestamp or "delay_ms"
+        # from now. Returns None for immediate delivery; raises ValueError on bad input.
+        deliver_at = message.get("deliver_at")
+        delay_ms = message.get("delay_ms")
+        if deliver_at is None and delay_ms is None:
+            return None
+        try:
+            deliver_at = float(deliver_at) if deliver_at is not None else time.time() + float(delay_ms) / 1000
+        except (TypeError, ValueError):
+            raise ValueError("'deliver_at' and 'delay_ms' must be numbers.")
+        if not math.isfinite(deliver_at):
+            raise ValueError("'deliver_at' and 'delay_ms' must be finite.")
+        return deliver_at if deliver_at > time.time() else None
+
+    def schedule_delayed(self, topic, peer_id, entry, deliver_at):
+        entry.update(deliver_at=deliver_at, topic=topic, peer_id=peer_id)
+        next_due = self.delayed.next_due()
+        self.delayed.add([entry])
+        if next_due is None or deliver_at < next_due:
+            self.delayed_wakeup.set()
+
+    async def deliver_delayed(self):
+        # Sleeps until the earliest pending publish is due, or until an earlier one is scheduled
+        while True:
+            self.delayed_wakeup.clear()
+            due = self.delayed.next_due()
+            if due is None:
+                await self.delayed_wakeup.wait()
+                continue
+            if due > time.time():
+                try:
+                    await asyncio.wait_for(self.delayed_wakeup.wait(), due - time.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                self.release_delayed(self.delayed.pop_due(time.time(), self.max_delayed_release))
+            except Exception as e:
+                logger.error("Error delivering delayed publishes: %s", e)
+            await asyncio.sleep(0)
+
+    def messages_appended(self, topic):
+        self.fetch_cache.appended(topic)
+        self.fanout.appended(topic)
+        if self.archive and self.messages[topic].archive_candidate(self.hot_segments):
+            self.archive_pending.append(topic)
+            self.archive_wakeup.set()
+
+    async def archive_segments(self):
+        # Moves closed segments to the archive, oldest first, one at a time. The segment stays
+        # readable in memory while it is compressed and written, and is swapped for its archived
+        # stub only if the topic still has it.
+        while True:
+            if not self.archive_pending:
+                self.archive_wakeup.clear()
+                await self.archive_wakeup.wait()
+                continue
+            topic = self.archive_pending.popleft()
+            log = self.messages.get(topic)
+            segment = log.archive_candidate(self.hot_segments) if log else None
+            if segment is None:
+                continue
+            try:
+                path = await asyncio.get_running_loop().run_in_executor(
+                    self.archive.io, self.archive.store, memoryview(segment.buffer)[:segment.used])
+            except Exception as e:
+                logger.error("Error archiving a segment of topic '%s': %s", topic, e)
+                continue
+            if self.messages.get(topic) is log and log.archived(segment, ColdSegment(segment, path)):
+                self.archive_pending.append(topic)  # it may have more
+            else:
+                self.archive.remove([path])
+
+    async def load_archived(self, log, ranges):
+        # The archived segments holding the [start, end) ranges, as {path: bytes} to pass to
+        # encoded_slices, read on the archive's I/O threads. Segments archived while waiting are
+        # read as well, so the result covers the ranges until the caller next awaits. The next
+        # archive_read_ahead segments are then read into the cache for sequential readers.
+        if not self.archive:
+            return None
+        cold = {}
+        while True:
+            missing = list({segment.path for start, end in ranges for segment in log.cold_segments(start, end)} - cold.keys())
+            if not missing:
+                break
+            cold.update(zip(missing, await asyncio.gather(*map(self.archive.load, missing))))
+        if ranges:
+            for segment in log.cold_segments(ranges[-1][0], ranges[-1][1], self.archive_read_ahead):
+                self.archive.prefetch(segment.path)
+        return cold
+
+    def release_delayed(self, entries):
+        # Appends due publishes to their topics; they get the time of release as appended_at
+        appended_at = time.time()
+        touched = set()
+        for entry in entries:
+            topic = entry['topic']
+            log = self.messages.get(topic)
+            if log is None:
+                logger.warning("Dropped a delayed publish to topic '%s', which no longer exists", topic)
+                continue
+            if 'codec' in entry:
+                log.append_batch(entry['peer_id'], entry['codec'], entry['data'], entry['count'], appended_at, entry.get('schema_version'))
+            else:
+                for content, produced_at, trace_id in entry['messages']:
+                    log.append(entry['peer_id'], content, produced_at, appended_at, trace_id)
+            touched.add(topic)
+        for topic in touched:
+            self.messages_appended(topic)
+
+    def check_sequence(self, topic, message):
+        # Idempotent publishing: a request carrying producer_id and sequence is appended only if
+        # sequence is exactly one past the producer's last one on this topic. Returns the
+        # producer's window (None for non-idempotent requests) and, when the request must not
+        # be appended, the response to send instead.
+        producer_id = message.get("producer_id")
+        sequence = message.get("sequence")
+        if producer_id is None or sequence is None:
+            return None, None
+        if not isinstance(sequence, int) or sequence < 0:
+            return None, {"status": "error", "message": "'sequence' must be a non-negative integer."}
+        windows = self.producer_windows.setdefault(topic, OrderedDict())
+        window = windows.get(producer_id)
+        if window is None:
+            window = windows[producer_id] = ProducerWindow(self.dedup_window)
+            if len(windows) > self.max_producers_per_topic:
+                windows.popitem(last=False)
+        else:
+            windows.move_to_end(producer_id)
+        if window.last_sequence is None or sequence == window.last_sequence + 1:
+            return window, None
+        if sequence > window.last_sequence:
+            return None, {"status": "out_of_order_sequence", "message": f"Expected sequence {window.last_sequence + 1}, got {sequence}.",
+                          "expected_sequence": window.last_sequence + 1}
+        appended = window.lookup(sequence)
+        request_logger.info("Dropped duplicate sequence %d from producer %s on topic '%s'", sequence, producer_id, topic)
+        if appended is None:
+            return None, {"status": "duplicate", "message": f"Sequence {sequence} was already appended.", "index": None}
+        index, count, deliver_at = appended
+        batch = message.get("action") == "send_batch"
+        if deliver_at is not None:
+            # Answer as the original was answered: scheduled, not yet appended
+            status = "batch_scheduled" if batch else "message_scheduled"
+            return None, {"status": status, "message": "Duplicate of an already scheduled request.", "count": count,
+                          "deliver_at": deliver_at, "duplicate": True}
+        status = "batch_sent" if batch else "message_sent"
+        return None, {"status": status, "message": "Duplicate of an already appended request.", "index": index, "count": count, "duplicate": True}
+
+    def check_subscribed(self, topic, peer_id):
         if not topic:
             return {"status": "error", "message": "Missing 'topic' field."}
         if topic not in self.topics:
             return {"status": "error", "message": f"Topic '{topic}' does not exist."}
         if peer_id not in self.topics[topic]['subscribers']:
             return {"status": "error", "message": f"Peer {peer_id} is not subscribed to topic '{topic}'."}
-        
-        new_messages = [
-            (index, sender, content) 
-            for index, sender, content in self.messages.get(topic, []) 
-            if index > last_read
-        ]
-        logger.info(f"Peer {peer_id} retrieved messages from topic '{topic}'")
-        return {"status": "messages_retrieved", "messages": new_messages}
+        return None
+
+    def resolve_offset(self, log, offset, timestamp, default):
+        # A position in the log given as a message offset or a Unix timestamp; raises ValueError on bad input
+        try:
+            if offset is not None:
+                return min(max(int(offset), 0), len(log))
+            if timestamp is not None:
+                return log.offset_for_time(float(timestamp))
+        except (TypeError, ValueError):
+            raise ValueError("Offsets must be integers and timestamps numbers.")
+        return default
+
+    async def get_messages(self, message, peer_id):
+        topic = message.get("topic")
+        error = self.check_subscribed(topic, peer_id)
+        if error:
+            return error
+
+        # Messages are stored pre-encoded, so the response is spliced together from slices of the log
+        log = self.messages[topic]
+        try:
+            last_read = request_last_read(message)
+            limit = request_limit(message, self.max_fetch_messages)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        start, end = log.bounds(last_read + 1, limit)
+        fetched_at = time.time()
+        if end > start:
+            self.record_fetch_lag(topic, peer_id, fetched_at - log.appended_at[start])
+        request_logger.info("Peer %s retrieved %d messages from topic '%s'", peer_id, end - start, topic)
+        fields = {"status": "messages_retrieved", "fetched_at": fetched_at, "more": end < len(log)}
+        return encode_records_frame(fields, "messages", await self.message_records(topic, peer_id, start, end))
+
+    async def fetch(self, message, peer_id):
+        # get_messages for many topics at once. "topics" maps each topic to its last_read, or to
+        # null to continue after the peer's committed offset. At most `limit` messages are
+        # returned per topic and max_fetch_messages in all; topics beyond that budget come back
+        # empty with "more" set, so clients should rotate the order they list topics in.
+        cursors = message.get("topics")
+        if not isinstance(cursors, dict) or not cursors:
+            return {"status": "error", "message": "'topics' must map topic names to last_read offsets."}
+        if len(cursors) > self.max_bulk_items:
+            return {"status": "error", "message": f"At most {self.max_bulk_items} topics per fetch."}
+        try:
+            limit = request_limit(message, self.max_fetch_messages)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        budget = self.max_fetch_messages
+        fetched_at = time.time()
+        groups, errors = [], {}
+        for topic, last_read in cursors.items():
+            error = self.check_subscribed(topic, peer_id)
+            if error:
+                errors[topic] = error["message"]
+                continue
+            if last_read is None:
+                last_read = self.committed_offsets.get(topic, {}).get(peer_id, -1)
+            elif not isinstance(last_read, int):
+                errors[topic] = "'last_read' must be an integer."
+                continue
+            log = self.messages[topic]
+            start, end = log.bounds(last_read + 1, min(limit, budget))
+            budget -= end - start
+            if end > start:
+                self.record_fetch_lag(topic, peer_id, fetched_at - log.appended_at[start])
+            fields = {"last_read": last_read, "more": end < len(log)}
+            groups.append((topic, fields, await self.message_records(topic, peer_id, start, end)))
+        request_logger.info("Peer %s fetched %d messages from %d topics", peer_id, self.max_fetch_messages - budget, len(groups))
+        return encode_grouped_records_frame({"status": "messages_fetched", "fetched_at": fetched_at, "errors": errors}, "topics", groups)
+
+    async def commit_offsets(self, message, peer_id):
+        # Records how far the peer has processed each topic; fetch resumes from here for topics
+        # it passes no last_read for, e.g. after the consumer restarts
+        offsets = message.get("offsets")
+        if not isinstance(offsets, dict):
+            return {"status": "error", "message": "'offsets' must map topic names to last processed offsets."}
+        errors = {}
+        for topic, last_read in offsets.items():
+            error = self.check_subscribed(topic, peer_id)
+            if error:
+                errors[topic] = error["message"]
+            elif not isinstance(last_read, int) or last_read < -1:
+                errors[topic] = "Offsets must be integers of at least -1."
+            else:
+                self.committed_offsets.setdefault(topic, {})[peer_id] = last_read
+        return {"status": "offsets_committed", "committed": len(offsets) - len(errors), "errors": errors}
+
+    async def lease_messages(self, message, peer_id):
+        # Leases up to `limit` messages to the consumer: first any whose lease ran out, then new
+        # ones after the last leased. Each is sent with the number of times it has been delivered.
+        # A message not acked within visibility_timeout seconds is delivered again.
+        topic = message.get("topic")
+        error = self.check_subscribed(topic, peer_id)
+        if error:
+            return error
+        try:
+            limit = request_limit(message, self.max_fetch_messages)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        timeout = message.get("visibility_timeout")
+        try:
+            timeout = self.visibility_timeout if timeout is None else float(timeout)
+        except (TypeError, ValueError):
+            timeout = 0
+        # Checked before any lease is taken: an infinite or NaN deadline can't be put on the timer wheel
+        if not math.isfinite(timeout) or timeout <= 0:
+            return {"status": "error", "message": "'visibility_timeout' must be a positive number of seconds."}
+        log = self.messages[topic]
+        state = self.lease_state(topic, peer_id)
+        indices = []
+        while state.redeliver and len(indices) < limit:
+            index = state.redeliver.popleft()
+            if index in state.unresolved:
+                indices.append(index)
+        start, end = log.bounds(state.next_index, limit - len(indices))
+        state.next_index = end
+        indices.extend(range(start, end))
+        deadline = time.monotonic() + timeout
+        deliveries = []
+        for index in indices:
+            deliveries.append(state.lease(index))
+            self.delivery_timers.schedule(deadline, (topic, peer_id, index, deliveries[-1]))
+        if indices:
+            self.timers_pending.set()
+        # Group the indices into runs of consecutive messages so each run is one slice of the log
+        runs = []
+        for index in indices:
+            if runs and runs[-1][1] == index:
+                runs[-1][1] = index + 1
+            else:
+                runs.append([index, index + 1])
+        cold = await self.load_archived(log, runs)
+        runs = [(a, b, b''.join(log.encoded_slices(a, b, cold))) for a, b in runs]
+        messages, skipped = await self.offload(sum(len(run[2]) for run in runs), self.offload_min_bytes, leased_messages, runs)
+        self.report_skipped(topic, skipped)
+        request_logger.info("Peer %s leased %d messages from topic '%s'", peer_id, len(messages), topic)
+        return {"status": "messages_leased", "topic": topic, "messages": messages, "deliveries": deliveries,
+                "visibility_timeout": timeout, "more": bool(state.redeliver) or end < len(log)}
+
+    async def ack_messages(self, message, peer_id):
+        # Releases leased messages: "indices" acks them one by one, "up_to" acks every message
+        # leased so far up to that index. The committed offset moves to the last message below
+        # which everything is acked.
+        topic = message.get("topic")
+        error = self.check_subscribed(topic, peer_id)
+        if error:
+            return error
+        indices = message.get("indices") or []
+        up_to = message.get("up_to")
+        if not isinstance(indices, list) or not all(isinstance(i, int) for i in indices) or not isinstance(up_to, (int, type(None))):
+            return {"status": "error", "message": "'indices' must be a list of integers and 'up_to' an integer."}
+        state = self.lease_states.get(topic, {}).get(peer_id)
+        acked = 0
+        if state:
+            acked = sum(state.resolve(index) for index in indices)
+            if up_to is not None:
+                acked += state.resolve_through(up_to)
+            self.update_committed(topic, peer_id, state)
+        committed = self.committed_offsets.get(topic, {}).get(peer_id, -1)
+        return {"status": "acked", "topic": topic, "acked": acked, "committed": committed}
+
+    def lease_state(self, topic, peer_id):
+        states = self.lease_states.setdefault(topic, {})
+        state = states.get(peer_id)
+        if state is None:
+            state = states[peer_id] = LeaseState(self.committed_offsets.get(topic, {}).get(peer_id, -1) + 1)
+        return state
+
+    def update_committed(self, topic, peer_id, state):
+        self.committed_offsets.setdefault(topic, {})[peer_id] = state.floor()
+
+    async def expire_leases(self):
+        # Timers of acked or re-leased messages still fire; they are told apart by the delivery
+        # count they were scheduled with
+        while True:
+            if not len(self.delivery_timers):
+                self.timers_pending.clear()
+                await self.timers_pending.wait()
+            await asyncio.sleep(self.delivery_timers.tick)
+            for topic, peer_id, index, deliveries in self.delivery_timers.advance(time.monotonic()):
+                state = self.lease_states.get(topic, {}).get(peer_id)
+                if state is None or state.unresolved.get(index) != deliveries:
+                    continue
+                if deliveries < self.max_deliveries:
+                    state.redeliver.append(index)
+                    continue
+                try:
+                    await self.dead_letter(topic, peer_id, index)
+                except Exception as e:
+                    logger.error("Error dead-lettering message %d of topic '%s': %s", index, topic, e)
+                state.resolve(index)
+                self.update_committed(topic, peer_id, state)
+
+    async def dead_letter(self, topic, peer_id, index):
+        # Copies a message that was never acked to the topic's dead-letter topic, created on first use
+        log = self.messages[topic]
+        cold = await self.load_archived(log, [(index, index + 1)])
+        if self.messages.get(topic) is not log:
+            return
+        original = log.get(index, cold)
+        dead_topic = topic + self.dead_letter_suffix
+        if dead_topic not in self.topics:
+            self.commit_metadata([['create', dead_topic, self.topics[topic]['host_peer']]])
+        self.messages[dead_topic].append(original.sender, original.content, original.produced_at, time.time(), original.trace_id)
+        self.messages_appended(dead_topic)
+        logger.warning("Message %d of topic '%s' moved to '%s' after %d deliveries to peer %s",
+                       index, topic, dead_topic, self.max_deliveries, peer_id)
+
+    async def seek(self, message, peer_id):
+        # Finds the offset to resume reading from; the client passes offset - 1 as last_read
+        topic = message.get("topic")
+        error = self.check_subscribed(topic, peer_id)
+        if error:
+            return error
+        if message.get("offset") is None and message.get("timestamp") is None:
+            return {"status": "error", "message": "Missing 'offset' or 'timestamp' field."}
+        log = self.messages[topic]
+        try:
+            offset = self.resolve_offset(log, message.get("offset"), message.get("timestamp"), len(log))
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        request_logger.info("Peer %s seeked topic '%s' to offset %d", peer_id, topic, offset)
+        return {"status": "seek_result", "topic": topic, "offset": offset, "last_read": offset - 1, "end": len(log),
+                "appended_at": log.appended_at[offset] if offset < len(log) else None}
+
+    async def stream_replay(self, message, peer_id, writer):
+        # Sends messages [from, to) as replay_chunk frames of at most chunk_size messages, paced
+        # to `rate` messages per second when given, then a replay_done frame. Positions are offsets
+        # or timestamps. Each chunk is read from the log just before it is sent, and the next one
+        # waits for the transport to drain, so a slow reader holds back the replay, not the server.
+        topic = message.get("topic")
+        error = self.check_subscribed(topic, peer_id)
+        log = self.messages.get(topic)
+        if not error:
+            try:
+                start = self.resolve_offset(log, message.get("from_offset"), message.get("from_time"), 0)
+                end = self.resolve_offset(log, message.get("to_offset"), message.get("to_time"), len(log))
+                chunk_size = message.get("chunk_size")
+                chunk_size = self.replay_chunk_size if chunk_size is None else int(chunk_size)
+                rate = float(message.get("rate") or 0)
+                if chunk_size < 1 or not rate >= 0:
+                    raise ValueError("'chunk_size' must be at least 1 and 'rate' must not be negative.")
+                chunk_size = min(chunk_size, self.max_fetch_messages)
+            except (TypeError, ValueError) as e:
+                error = {"status": "error", "message": str(e)}
+        if error:
+            writer.write(encode_frame(error))
+            await writer.drain()
+            return
+        request_logger.info("Peer %s replaying messages %d-%d of topic '%s'", peer_id, start, end, topic)
+        started = time.monotonic()
+        first = start
+        while start < end:
+            stop = min(end, start + chunk_size)
+            cold = await self.load_archived(log, [(start, stop)])
+            if self.messages.get(topic) is not log:
+                writer.write(encode_frame({"status": "error", "message": f"Topic '{topic}' was deleted during the replay.", "next_offset": start}))
+                await writer.drain()
+                return
+            fields = {"status": "replay_chunk", "topic": topic, "from_offset": start, "to_offset": stop}
+            writer.writelines(self.messages_frame(topic, peer_id, start, stop, fields, cold).chunks)
+            await writer.drain()
+            start = stop
+            if peer_id in self.sessions:
+                self.renew_session(peer_id)
+            if rate:
+                delay = started + (start - first) / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        writer.write(encode_frame({"status": "replay_done", "topic": topic, "next_offset": start}))
+        await writer.drain()
+
+    def needs_expansion(self, log, peer_id):
+        # True when the topic holds batches in a codec the consumer can't decode
+        return not log.codecs_used <= self.peer_codecs.get(peer_id, set())
+
+    async def message_records(self, topic, peer_id, start, end):
+        # Encoded messages [start, end) of the topic as this consumer can read them. Unpacked
+        # ranges are computed once, off the event loop if large, and shared through the fetch
+        # cache by every consumer at the same position; plain ranges are slices of the log.
+        log = self.messages[topic]
+        if not self.needs_expansion(log, peer_id):
+            return log.encoded_slices(start, end, await self.load_archived(log, [(start, end)]))
+        async def expand():
+            records = b''.join(log.encoded_slices(start, end, await self.load_archived(log, [(start, end)])))
+            records, skipped = await self.offload(len(records), self.offload_min_bytes, expanded_records, records, start - 1)
+            self.report_skipped(topic, skipped)
+            return records
+        return await self.fetch_cache.get((topic, start, end), expand, end == len(log))
+
+    def messages_frame(self, topic, peer_id, start, end, fields, cold=None):
+        # Synchronous message_records for the push and replay paths; archived segments in the
+        # range must have been loaded into `cold` with load_archived
+        log = self.messages[topic]
+        if not self.needs_expansion(log, peer_id):
+            return encode_records_frame(fields, "messages", log.encoded_slices(start, end, cold))
+        def expand():
+            records, skipped = expanded_records(b''.join(log.encoded_slices(start, end, cold)), start - 1)
+            self.report_skipped(topic, skipped)
+            return records
+        records = self.fetch_cache.get_now((topic, start, end), expand, end == len(log))
+        return encode_records_frame(fields, "messages", records)
+
+    def report_skipped(self, topic, skipped):
+        # Batches that fail to unpack are left out of the response rather than failing it
+        for base, count in skipped:
+            logger.error("Skipped undecodable batch of %s messages at index %s of topic '%s'", count, base, topic)
+
+    def record_fetch_lag(self, topic, peer_id, lag):
+        # One sample per fetch, not per message, so the cost doesn't grow with the fetch size:
+        # the lag of the oldest message returned, which bounds the rest
+        topic_lag = self.topic_lag.get(topic)
+        if topic_lag is None:
+            topic_lag = self.topic_lag[topic] = LagHistogram()
+        consumers = self.consumer_lag.setdefault(topic, {})
+        consumer_lag = consumers.get(peer_id)
+        if consumer_lag is None:
+            consumer_lag = consumers[peer_id] = LagHistogram()
+        topic_lag.record(lag)
+        consumer_lag.record(lag)
+
+    async def get_lag_stats(self, message, peer_id):
+        topic = message.get("topic")
+        topics = [topic] if topic else list(self.topic_lag)
+        return {
+            "status": "lag_stats",
+            "topics": {t: self.topic_lag[t].summary() for t in topics if t in self.topic_lag},
+            "consumers": {t: {p: h.summary() for p, h in self.consumer_lag.get(t, {}).items()} for t in topics},
+            "fetch_cache": self.fetch_cache.stats(),
+            "delayed_pending": len(self.delayed),
+            "archive": self.archive.stats() if self.archive else None,
+        }
 
     async def view_subscribed_topics(self, message, peer_id):
-        subscribed = [topic for topic, data in self.topics.items() if peer_id in data['subscribers']]
-        logger.info(f"Peer {peer_id} viewed subscribed topics: {subscribed}")
+        subscribed = list(self.peer_subscriptions.get(peer_id, ()))
+        request_logger.info("Peer %s viewed %d subscribed topics", peer_id, len(subscribed))
         return {"status": "subscribed_topics", "topics": subscribed}
 
+    def commit_metadata(self, ops):
+        self.metadata_log.append(ops)
+        self.apply_metadata(ops)
+
+    def apply_metadata(self, ops):
+        # ops are [op, topic, peer_id] entries as written to the metadata log; for 'schema' the
+        # third element is the fields of the topic's next schema version
+        created, deleted = [], []
+        for op, topic, peer_id in ops:
+            if op == 'create':
+                self.topics[topic] = {'host_peer': peer_id, 'subscribers': set()}
+                self.hosted_topics.setdefault(peer_id, set()).add(topic)
+                self.messages[topic] = TopicLog()
+                self.record_topic_change('created', topic)
+                created.append(topic)
+            elif op == 'delete':
+                self.remove_topic(topic)
+                deleted.append(topic)
+            elif op == 'subscribe':
+                self.topics[topic]['subscribers'].add(peer_id)
+                self.peer_subscriptions.setdefault(peer_id, set()).add(topic)
+                self.fanout.subscribed(peer_id, topic)
+            elif op == 'unsubscribe':
+                self.topics[topic]['subscribers'].discard(peer_id)
+                self.peer_subscriptions.get(peer_id, set()).discard(topic)
+                self.fanout.unsubscribed(peer_id, topic)
+                self.lease_states.get(topic, {}).pop(peer_id, None)
+            elif op == 'schema':
+                self.schemas.setdefault(topic, []).append(peer_id)
+            elif op == 'host':
+                self.hosted_topics.get(self.topics[topic]['host_peer'], set()).discard(topic)
+                self.topics[topic]['host_peer'] = peer_id
+                self.hosted_topics.setdefault(peer_id, set()).add(topic)
+        if created or deleted:
+            self.update_topic_names(created, deleted)
+
+    def update_topic_names(self, created, deleted):
+        # A single change is spliced in with bisect; bulk changes rebuild the sorted list in one pass
+        if len(created) + len(deleted) == 1:
+            for topic in created:
+                bisect.insort(self.topic_names, topic)
+            for topic in deleted:
+                i = bisect.bisect_left(self.topic_names, topic)
+                if i < len(self.topic_names) and self.topic_names[i] == topic:
+                    del self.topic_names[i]
+            return
+        names = self.topic_names
+        if deleted:
+            gone = set(deleted)
+            names = [topic for topic in names if topic not in gone]
+        names.extend(created)
+        names.sort()
+        self.topic_names = names
+
+    def recover_metadata(self):
+        # Rebuilds topics and subscriptions from the metadata log and compacts it to one snapshot
+        # record. Messages are not persisted, so recovered topics start out empty. Peers that
+        # host or subscribe get one lease to come back before their topics move.
+        records = 0
+        for ops in self.metadata_log.replay():
+            self.apply_metadata(ops)
+            records += 1
+        if not records:
+            return
+        snapshot = [['create', topic, data['host_peer']] for topic, data in self.topics.items()]
+        snapshot += [['subscribe', topic, p] for topic, data in self.topics.items() for p in data['subscribers']]
+        snapshot += [['schema', topic, fields] for topic, versions in self.schemas.items() for fields in versions]
+        self.metadata_log.rewrite(snapshot)
+        for peer_id in set(self.hosted_topics) | set(self.peer_subscriptions):
+            if peer_id in self.peers:
+                self.renew_session(peer_id)
+        logger.info("Recovered %d topics from %d metadata records", len(self.topics), records)
+
+    def remove_topic(self, topic):
+        data = self.topics.pop(topic)
+        self.hosted_topics.get(data['host_peer'], set()).discard(topic)
+        for subscriber in data['subscribers']:
+            self.peer_subscriptions.get(subscriber, set()).discard(topic)
+        if topic in self.messages:
+            log = self.messages.pop(topic)
+            if self.archive and log.cold:
+                self.archive.remove([segment.path for segment in log.segments[:log.cold]])
+        self.topic_lag.pop(topic, None)
+        self.consumer_lag.pop(topic, None)
+        self.committed_offsets.pop(topic, None)
+        self.lease_states.pop(topic, None)
+        self.schemas.pop(topic, None)
+        self.producer_windows.pop(topic, None)
+        self.fanout.topic_removed(topic)
+        self.fetch_cache.topic_removed(topic)
+        self.record_topic_change('deleted', topic)
+
+    def record_topic_change(self, op, topic):
+        self.topic_version += 1
+        self.topic_changes.append((self.topic_version, op, topic))
+        # Trim in bulk once the log is twice its budget so appends stay amortized O(1)
+        if len(self.topic_changes) > 2 * self.max_topic_changes:
+            del self.topic_changes[:len(self.topic_changes) - self.max_topic_changes]
+
     async def view_created_topics(self, message, peer_id):
-        created_topics = list(self.topics.keys())
-        logger.info(f"Viewed created topics: {created_topics}")
-        return {"status": "created_topics", "topics": created_topics}
+        try:
+            limit = request_limit(message, self.topic_page_size)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        if message.get("since_version") is not None:
+            try:
+                since_version = int(message["since_version"])
+            except (TypeError, ValueError):
+                return {"status": "error", "message": "'since_version' must be an integer."}
+            return self.topic_changes_since(since_version, limit, peer_id)
+        prefix = message.get("prefix") or ""
+        cursor = message.get("cursor")
+        if not isinstance(prefix, str):
+            return {"status": "error", "message": "'prefix' must be a string."}
+        if cursor is not None and not isinstance(cursor, str):
+            return {"status": "error", "message": "'cursor' must be a topic name from 'next_cursor'."}
+        start = bisect.bisect_right(self.topic_names, cursor) if cursor is not None else 0
+        start = max(start, bisect.bisect_left(self.topic_names, prefix))
+        page = []
+        for topic in self.topic_names[start:start + limit]:
+            if not topic.startswith(prefix):
+                break
+            page.append(topic)
+        next_cursor = None
+        end = start + len(page)
+        if len(page) == limit and end < len(self.topic_names) and self.topic_names[end].startswith(prefix):
+            next_cursor = page[-1]
+        request_logger.info("Peer %s viewed %d created topics", peer_id, len(page))
+        return {"status": "created_topics", "topics": page, "next_cursor": next_cursor, "version": self.topic_version}
+
+    def topic_changes_since(self, since_version, limit, peer_id):
+        oldest = self.topic_changes[0][0] if self.topic_changes else self.topic_version + 1
+        if since_version < oldest - 1:
+            # The change log no longer reaches back that far; the client has to re-list from scratch
+            return {"status": "resync_required", "message": f"Changes since version {since_version} are no longer available.", "version": self.topic_version}
+        start = since_version - oldest + 1
+        changes = self.topic_changes[start:start + limit]
+        version = changes[-1][0] if changes else since_version
+        request_logger.info("Peer %s fetched %d topic changes since version %d", peer_id, len(changes), since_version)
+        return {"status": "topic_changes", "changes": changes, "version": version, "more": version < self.topic_version}
 
     async def get_topic_host(self, message, peer_id):
         topic = message.get("topic")
@@ -205,7 +1526,7 @@ class IndexingServer:
         try:
             with open(self.registered_peers_file, 'r') as f:
                 self.peers = json.load(f)
-            logger.info(f"Loaded {len(self.peers)} registered peers from file")
+            logger.info("Loaded %d registered peers from file", len(self.peers))
         except FileNotFoundError:
             logger.warning("Registered peers file not found. Starting with empty peer list.")
         except json.JSONDecodeError:
@@ -231,8 +1552,17 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 if __name__ == '__main__':
-    config = load_config()
+    # The Makefile passes the config file name; config.json next to this script otherwise
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else 'config.json')
+    log_listener = setup_logging(config)
     server = IndexingServer(config)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    asyncio.run(server.start())
\ No newline at end of file
+    try:
+        asyncio.run(server.start())
+    finally:
+        if server.executor:
+            server.executor.shutdown(wait=False, cancel_futures=True)
+        if server.archive:
+            server.archive.close()
+        log_listener.stop()
\ No newline at end of file
@@ -0,0 +1,187 @@
+import bisect
+import json
+from array import array
+from protocol import expand_batch
+
+SEGMENT_BYTES = 1024 * 1024
+MIN_SEGMENT_BYTES = 256
+
+class MessageView:
+    __slots__ = ('index', 'sender', 'content', 'produced_at', 'appended_at', 'trace_id')
+
+    def __init__(self, index, sender, content, produced_at, appended_at, trace_id):
+        self.index = index
+        self.sender = sender
+        self.content = content
+        self.produced_at = produced_at
+        self.appended_at = appended_at
+        self.trace_id = trace_id
+
+class Segment:
+    # A run of consecutive records in one preallocated buffer. The buffer is never resized in
+    # place (it is replaced by a bigger copy while growing), so memoryviews handed to the
+    # transport stay valid while later records are appended. A record holds one message or a
+    # compressed batch of messages.
+    __slots__ = ('base', 'next_index', 'buffer', 'used', 'offsets', 'record_bases')
+
+    def __init__(self, base, capacity):
+        self.base = base
+        self.next_index = base
+        self.buffer = bytearray(capacity)
+        self.used = 0
+        self.offsets = array('I', [0])  # record i of the segment occupies buffer[offsets[i]:offsets[i + 1]]
+        self.record_bases = array('Q')  # index of the first message in record i
+
+    def append(self, record, count, max_bytes):
+        end = self.used + len(record)
+        if end > len(self.buffer):
+            if self.used and end > max_bytes:
+                return False
+            grown = bytearray(max(end, min(2 * len(self.buffer), max_bytes)))
+            grown[:self.used] = memoryview(self.buffer)[:self.used]
+            self.buffer = grown
+        self.buffer[self.used:end] = record
+        self.used = end
+        self.offsets.append(end)
+        self.record_bases.append(self.next_index)
+        self.next_index += count
+        return True
+
+    def view(self, start, end, cold=None):
+        # Whole records covering messages [start, end); a batch is returned entire even if only partly in range
+        first = bisect.bisect_right(self.record_bases, start) - 1
+        last = bisect.bisect_left(self.record_bases, end)
+        return memoryview(self.buffer)[self.offsets[first]:self.offsets[last]]
+
+class ColdSegment:
+    # A closed segment whose buffer was moved to the archive. Only the record index stays in
+    # memory; views read from the buffer the caller loaded from the archive beforehand, passed
+    # in `cold` as {path: bytes}.
+    __slots__ = ('base', 'next_index', 'used', 'offsets', 'record_bases', 'path')
+
+    def __init__(self, segment, path):
+        self.base = segment.base
+        self.next_index = segment.next_index
+        self.used = segment.used
+        self.offsets = segment.offsets
+        self.record_bases = segment.record_bases
+        self.path = path
+
+    def view(self, start, end, cold=None):
+        first = bisect.bisect_right(self.record_bases, start) - 1
+        last = bisect.bisect_left(self.record_bases, end)
+        return memoryview(cold[self.path])[self.offsets[first]:self.offsets[last]]
+
+class TopicLog:
+    # Append-only message log for one topic. Each message is JSON-encoded once, at append time,
+    # into its wire form ",[index, sender, content, produced_at, appended_at, trace_id]" and packed
+    # into segments, so a fetch is served as memoryview slices of already-encoded bytes.
+    # Compressed batches are stored as a single ',{"base": ..., "count": ..., "codec": ..., "data": ...}'
+    # record and are never decompressed by the broker.
+    # Once archived, the oldest closed segments are ColdSegments; `cold` counts them.
+    # The sender only lives in the encoded record; per message, the log keeps just appended_at.
+    __slots__ = ('segment_bytes', 'segments', 'segment_bases', 'count', 'appended_at', 'codecs_used', 'cold')
+
+    def __init__(self, segment_bytes=SEGMENT_BYTES):
+        self.segment_bytes = segment_bytes
+        self.segments = []
+        self.segment_bases = []
+        self.count = 0  # messages appended, batches counted by their messages
+        self.appended_at = array('d')
+        self.codecs_used = set()
+        self.cold = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, peer_id, content, produced_at, appended_at, trace_id=None):
+        index = self.count
+        appended_at = self.clamp_time(appended_at)
+        record = b',' + json.dumps([index, peer_id, content, produced_at, appended_at, trace_id]).encode()
+        self.append_record(record, 1, appended_at)
+        return index
+
+    def append_batch(self, peer_id, codec, data, count, appended_at, schema_version=None):
+        # data is the base64 text of a codec-compressed JSON list of [content, produced_at, trace_id],
+        # or of a columnar payload encoded with the topic's schema schema_version
+        index = self.count
+        appended_at = self.clamp_time(appended_at)
+        batch = {"base": index, "count": count, "sender": peer_id, "appended_at": appended_at, "codec": codec, "data": data}
+        if schema_version is not None:
+            batch["schema_version"] = schema_version
+        self.append_record(b',' + json.dumps(batch).encode(), count, appended_at)
+        self.codecs_used.add(codec)
+        return index
+
+    def clamp_time(self, appended_at):
+        # Append times never go backwards within a topic, even if the wall clock does, so the
+        # appended_at array stays sorted and doubles as the time-to-offset index
+        if self.appended_at and appended_at < self.appended_at[-1]:
+            return self.appended_at[-1]
+        return appended_at
+
+    def append_record(self, record, count, appended_at):
+        index = self.count
+        if not self.segments or not self.segments[-1].append(record, count, self.segment_bytes):
+            segment = Segment(index, max(MIN_SEGMENT_BYTES, len(record)))
+            segment.append(record, count, self.segment_bytes)
+            self.segments.append(segment)
+            self.segment_bases.append(index)
+        self.count += count
+        for _ in range(count):
+            self.appended_at.append(appended_at)
+
+    def segment_for(self, index):
+        return self.segments[bisect.bisect_right(self.segment_bases, index) - 1]
+
+    def get(self, index, cold=None):
+        record = json.loads(bytes(self.segment_for(index).view(index, index + 1, cold)[1:]))
+        if isinstance(record, dict):
+            return MessageView(*expand_batch(record)[index - record["base"]])
+        return MessageView(*record)
+
+    def archive_candidate(self, hot_segments):
+        # The oldest in-memory segment, if more than hot_segments are in memory; the last segment
+        # is still being appended to and is never archived
+        if len(self.segments) - self.cold > max(hot_segments, 1):
+            return self.segments[self.cold]
+        return None
+
+    def archived(self, segment, cold_segment):
+        if self.cold < len(self.segments) and self.segments[self.cold] is segment:
+            self.segments[self.cold] = cold_segment
+            self.cold += 1
+            return True
+        return False
+
+    def cold_segments(self, start, end, read_ahead=0):
+        # Archived segments holding messages [start, end), followed by up to read_ahead more
+        if start >= end or not self.cold or start >= self.segments[self.cold - 1].next_index:
+            return []
+        first = bisect.bisect_right(self.segment_bases, start) - 1
+        last = bisect.bisect_left(self.segment_bases, end)
+        return self.segments[first:min(last + read_ahead, self.cold)]
+
+    def offset_for_time(self, timestamp):
+        # Index of the first message appended at or after timestamp (len(self) if none)
+        return bisect.bisect_left(self.appended_at, timestamp)
+
+    def bounds(self, start, limit=None):
+        start = min(max(start, 0), self.count)
+        end = self.count if limit is None else min(self.count, start + limit)
+        return start, end
+
+    def encoded_slices(self, start, end, cold=None):
+        # Comma-separated JSON records [start, end) as a list of memoryviews, one per segment touched.
+        # Archived segments in the range are read from `cold`, as returned by load_archived.
+        slices = []
+        i = bisect.bisect_right(self.segment_bases, start) - 1 if start < end else len(self.segments)
+        while start < end:
+            segment = self.segments[i]
+            stop = min(end, segment.next_index)
+            slices.append(segment.view(start, stop, cold))
+            start = stop
+            i += 1
+        if slices:
+            slices[0] = slices[0][1:]  # drop the separator in front of the first record
+        return slices
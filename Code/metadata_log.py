@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class MetadataLog:
+    # Write-ahead log of topic metadata changes. Each append is one line holding the list of
+    # [op, topic, peer_id] entries of a single request, so a bulk request is logged in one write
+    # and replays all or nothing. With no path the log is disabled and nothing is persisted.
+    def __init__(self, path=None, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = None
+
+    def replay(self):
+        # Yields the op lists written so far, oldest first; a torn last line is ignored
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring incomplete record at the end of %s", self.path)
+                    return
+
+    def append(self, ops):
+        if not self.path or not ops:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(json.dumps(ops).encode() + b'\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def rewrite(self, ops):
+        # Replaces the log with a single record that recreates the current state
+        if not self.path:
+            return
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            if ops:
+                f.write(json.dumps(ops).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,55 +1,113 @@
 import asyncio
+import base64
 import json
 import logging
 import os
 import sys
 import signal
 import socket
+import time
+import uuid
+from collections import deque
+from columnar import COLUMNAR, decode_columns, encode_columns
+from peer_state import PeerStateStore
+from protocol import CODECS, compress_batch, encode_frame, expand_messages, read_frame
+from transport import open_connection, transport_settings
 
 logging.basicConfig(filename='peer_node.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+def schedule_fields(delay_ms, deliver_at):
+    fields = {}
+    if delay_ms is not None:
+        fields["delay_ms"] = delay_ms
+    if deliver_at is not None:
+        fields["deliver_at"] = deliver_at
+    return fields
+
 class PeerNode:
     def __init__(self, config):
         self.peer_id = None
         self.peer_ip = config['peer_node'].get('ip', '127.0.0.1')
         self.base_port = config['peer_node']['base_port']
-        self.peer_port = self.find_available_port()
+        self.peer_port = None  # set when the listening socket is bound
+        self.listen_socket = None
         self.indexing_server_ip = config['indexing_server']['ip']
         self.indexing_server_port = config['indexing_server']['port']
+        self.transport = transport_settings(config)  # how we reach the indexing server (tcp, unix or shm)
         self.last_read_index = {}  # {topic_name: last_read_index}
         self.subscribed_topics = set()
+        self.compression = None  # batch codec agreed with the indexing server at registration
+        self.producer_id = uuid.uuid4().hex  # identifies this process's publishes for server-side deduplication
+        self.next_sequence = {}  # {topic_name: next publish sequence number}
+        self.schemas = {}  # {(topic_name, version): fields} of schemas fetched or registered
+        self.publish_attempts = config['peer_node'].get('publish_attempts', 3)
+        # With ack_delivery, pulled messages are leased and acked once printed instead of just read
+        self.ack_delivery = config['peer_node'].get('ack_delivery', False)
+        self.heartbeat_interval = config['peer_node'].get('heartbeat_interval')  # defaults to a third of the server's lease
+        self.heartbeat_task = None
+        self.request_lock = asyncio.Lock()  # the heartbeat task shares the request connection
+        self.end_to_end_latency = {}  # {topic_name: deque of publish-to-delivery seconds}
+        self.topic_catalog = set()  # local copy of the server's topic list
+        self.topic_catalog_version = None  # server topic version the catalog is synced to
         self.reader = None
         self.writer = None
+        self.push_writer = None  # separate connection the server pushes new messages on
+        self.push_task = None
         self.server_socket = None
+        # Subscriptions, read positions and the topic catalog are checkpointed under state_dir
+        # (one file per peer ID) and restored with a single resume request after a restart
+        self.state_dir = config['peer_node'].get('state_dir')
+        self.checkpoint_interval = config['peer_node'].get('checkpoint_interval', 5.0)
+        self.state_store = None
+        self.saved_state = None  # encoded state of the last checkpoint written
+        self.checkpoint_task = None
 
-    def find_available_port(self):
-        port = self.base_port
-        while True:
+    def bind_listener(self, preferred_port=None):
+        # Binds and listens on the socket other peers connect to and keeps it, so the port can't be
+        # taken between choosing it and serving it. Tries the port of our previous run, then
+        # base_port; if both are taken (or base_port is 0) the OS picks a free port, which is
+        # what gets registered with the server.
+        for port in [p for p in (preferred_port, self.base_port) if p] + [0]:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if os.name == 'posix':
+                # Lets a restarted peer take back its port from connections in TIME_WAIT. Two
+                # sockets can still bind the same port with it set, so listen at once: binding a
+                # port that another socket listens on fails.
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.bind((self.peer_ip, port))
-                return port
-            except socket.error:
-                port += 1
+                sock.bind((self.peer_ip, port))
+                sock.listen(100)
+            except OSError:
+                sock.close()
+                if port == 0:
+                    raise
+                continue
+            self.listen_socket = sock
+            self.peer_port = sock.getsockname()[1]
+            return
 
     async def start(self):
+        self.peer_id = await self.get_peer_id()
+        self.load_state()
         await self.start_server()
         if await self.connect_to_server() and await self.register():
+            await self.resume()
+            self.start_checkpoints()
             await self.main_menu()
         else:
             print("Failed to connect to the indexing server or register. Exiting.")
 
     async def start_server(self):
-        self.server_socket = await asyncio.start_server(
-            self.handle_client, self.peer_ip, self.peer_port)
+        if self.listen_socket is None:
+            self.bind_listener()
+        self.server_socket = await asyncio.start_server(self.handle_client, sock=self.listen_socket)
         logger.info(f"Peer node listening on {self.peer_ip}:{self.peer_port}")
 
     async def handle_client(self, reader, writer):
-        data = await reader.read(4096)
-        message = json.loads(data.decode())
-        if message['action'] == 'pull_messages':
+        message = await read_frame(reader)
+        if message and message['action'] == 'pull_messages':
             await self.handle_pull_messages(message, writer)
         writer.close()
         await writer.wait_closed()
@@ -57,14 +115,13 @@ class PeerNode:
     async def handle_pull_messages(self, message, writer):
         topic = message['topic']
         response = {'status': 'error', 'message': 'Topic not found'}
-        writer.write(json.dumps(response).encode())
+        writer.write(encode_frame(response))
         await writer.drain()
 
     async def connect_to_server(self):
         try:
-            self.reader, self.writer = await asyncio.open_connection(
-                self.indexing_server_ip, self.indexing_server_port)
-            logger.info(f"Connected to indexing server at {self.indexing_server_ip}:{self.indexing_server_port}")
+            self.reader, self.writer = await open_connection(self.transport, self.indexing_server_ip, self.indexing_server_port)
+            logger.info(f"Connected to indexing server at {self.indexing_server_ip}:{self.indexing_server_port} over {self.transport['type']}")
             return True
         except Exception as e:
             logger.error(f"Connection error: {e}")
@@ -72,17 +129,22 @@ class PeerNode:
 
     async def get_peer_id(self):
         while True:
-            peer_id = input("Enter your peer ID: ")
+            peer_id = await self.prompt("Enter your peer ID: ")
             if peer_id.strip():
                 return peer_id
             else:
                 print("Peer ID cannot be empty. Please try again.")
 
     async def register(self):
-        self.peer_id = await self.get_peer_id()
-        message = {"action": "register", "peer_id": self.peer_id, "ip": self.peer_ip, "port": self.peer_port}
+        if not self.peer_id:
+            self.peer_id = await self.get_peer_id()
+        if self.listen_socket is None:
+            self.bind_listener()
+        message = {"action": "register", "peer_id": self.peer_id, "ip": self.peer_ip, "port": self.peer_port, "compression": list(CODECS) + [COLUMNAR]}
         response = await self.send_message(message)
         if response['status'] in ["registered", "logged_in"]:
+            self.compression = response.get('compression')
+            self.start_heartbeats(response.get('lease_seconds'))
             logger.info(f"{response['message']}")
             print(f"{response['message']}")
             return True
@@ -103,11 +165,112 @@ class PeerNode:
             print(f"Deregistration failed: {response['message']}")
             return False
 
+    async def prompt(self, text):
+        # Reads a line on a worker thread so heartbeats keep going while the menu waits for the user
+        return await asyncio.get_running_loop().run_in_executor(None, input, text)
+
+    def start_heartbeats(self, lease_seconds):
+        if self.heartbeat_task is None and lease_seconds:
+            self.heartbeat_task = asyncio.create_task(self.send_heartbeats(self.heartbeat_interval or lease_seconds / 3))
+
+    async def send_heartbeats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                response = await self.send_message({"action": "heartbeat", "peer_id": self.peer_id})
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                logger.warning(f"Heartbeat failed: {e}")
+                continue
+            if response and self.peer_id in response.get('expired', []):
+                logger.warning("Session expired on the indexing server, logging in again")
+                await self.resume_session()
+
+    async def resume_session(self):
+        # The server dropped our subscriptions along with the session; restore them
+        message = {"action": "register", "peer_id": self.peer_id, "ip": self.peer_ip, "port": self.peer_port, "compression": list(CODECS) + [COLUMNAR]}
+        await self.send_message(message)
+        await self.resume()
+
+    def load_state(self):
+        # Restores the subscriptions, read positions, topic catalog and schemas saved by an earlier
+        # run with this peer ID; resume() then brings the server in line after registering
+        if not self.state_dir or not self.peer_id:
+            return
+        self.state_store = PeerStateStore(self.state_dir, self.peer_id)
+        state = self.state_store.load()
+        if not state:
+            return
+        self.subscribed_topics = set(state.get("subscribed_topics", []))
+        self.last_read_index = dict(state.get("last_read_index", {}))
+        self.topic_catalog = set(state.get("topic_catalog", []))
+        self.topic_catalog_version = state.get("topic_catalog_version")
+        self.schemas = {(topic, version): fields for topic, version, fields in state.get("schemas", [])}
+        if self.listen_socket is None and state.get("port"):
+            self.bind_listener(state["port"])
+        logger.info(f"Restored state of peer {self.peer_id}: {len(self.subscribed_topics)} subscriptions, "
+                    f"{len(self.topic_catalog)} catalog topics")
+
+    def encode_state(self):
+        return json.dumps({"port": self.peer_port, "subscribed_topics": list(self.subscribed_topics),
+                           "last_read_index": self.last_read_index, "topic_catalog": list(self.topic_catalog),
+                           "topic_catalog_version": self.topic_catalog_version,
+                           "schemas": [[topic, version, fields] for (topic, version), fields in self.schemas.items()]}).encode()
+
+    async def checkpoint(self):
+        # Writes our state, on a worker thread, if it changed since the last checkpoint
+        if self.state_store is None:
+            return
+        data = self.encode_state()
+        if data == self.saved_state:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.state_store.save, data)
+        self.saved_state = data
+
+    def start_checkpoints(self):
+        if self.checkpoint_task is None and self.state_store is not None:
+            self.checkpoint_task = asyncio.create_task(self.run_checkpoints())
+
+    async def run_checkpoints(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except OSError as e:
+                logger.warning(f"Checkpoint of peer state failed: {e}")
+
+    async def resume(self):
+        # Re-subscribes to all our topics and gets where to continue reading each in one request,
+        # along with the topic changes since our catalog version. Topics that no longer exist are dropped.
+        if not self.subscribed_topics and self.topic_catalog_version is None:
+            return True
+        message = {"action": "resume", "peer_id": self.peer_id, "catalog_version": self.topic_catalog_version,
+                   "topics": {topic: self.last_read_index.get(topic) for topic in self.subscribed_topics}}
+        response = await self.send_message(message)
+        if not response or response.get("status") != "resumed":
+            logger.error(f"Resume failed: {response.get('message') if response else 'connection closed'}")
+            return False
+        for topic, error in response['errors'].items():
+            logger.warning(f"Dropped subscription to topic '{topic}': {error}")
+            self.subscribed_topics.discard(topic)
+            self.last_read_index.pop(topic, None)
+        for topic, position in response['topics'].items():
+            self.last_read_index[topic] = position['last_read']
+        catalog = response.get("catalog")
+        if catalog and catalog['status'] == "topic_changes":
+            self.apply_topic_changes(catalog)
+            if catalog['more']:
+                await self.sync_topic_catalog()
+        elif catalog:
+            # Our catalog is too old for the change log; the next view lists it from scratch
+            self.topic_catalog_version = None
+        logger.info(f"Resumed {len(response['topics'])} subscriptions")
+        return True
+
     async def send_message(self, message):
-        self.writer.write(json.dumps(message).encode())
-        await self.writer.drain()
-        data = await self.reader.read(4096)
-        response = json.loads(data.decode())
+        async with self.request_lock:
+            self.writer.write(encode_frame(message))
+            await self.writer.drain()
+            response = await read_frame(self.reader)
         logger.info(f"Sent message: {message}, Received response: {response}")
         return response
 
@@ -127,14 +290,126 @@ class PeerNode:
         else:
             print(f"Error deleting topic: {response['message']}")
 
-    async def send_message_to_topic(self, topic_name, message_content):
-        message = {"action": "send_message", "topic": topic_name, "content": message_content, "peer_id": self.peer_id}
-        response = await self.send_message(message)
+    async def send_message_to_topic(self, topic_name, message_content, trace_id=None, delay_ms=None, deliver_at=None):
+        # delay_ms or deliver_at (a Unix timestamp) hold the message back on the server until then
+        message = {"action": "send_message", "topic": topic_name, "content": message_content, "peer_id": self.peer_id, "produced_at": time.time()}
+        if trace_id:
+            message["trace_id"] = trace_id
+        message.update(schedule_fields(delay_ms, deliver_at))
+        response = await self.publish(topic_name, message)
         if response['status'] == "message_sent":
             print(f"Message sent to topic '{topic_name}': {message_content}")
+        elif response['status'] == "message_scheduled":
+            print(f"Message scheduled for topic '{topic_name}' at {time.ctime(response['deliver_at'])}: {message_content}")
         else:
             print(f"Error sending message to topic: {response['message']}")
 
+    async def publish(self, topic_name, message):
+        # Publishes with a per-topic sequence number so the request can be retried safely:
+        # if the server already appended it, it answers with the original index instead of appending again.
+        message["producer_id"] = self.producer_id
+        message["sequence"] = self.next_sequence.get(topic_name, 0)
+        self.next_sequence[topic_name] = message["sequence"] + 1
+        response = await self.request_with_retry(message)
+        if response['status'] == "out_of_order_sequence":
+            # An earlier request never reached the server; continue from where the server is
+            message["sequence"] = response['expected_sequence']
+            self.next_sequence[topic_name] = message["sequence"] + 1
+            response = await self.request_with_retry(message)
+        return response
+
+    async def request_with_retry(self, message):
+        for attempt in range(1, self.publish_attempts + 1):
+            try:
+                response = await self.send_message(message)
+                if response is not None:
+                    return response
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                logger.warning(f"Request failed on attempt {attempt}: {e}")
+            if self.writer:
+                self.writer.close()
+            await asyncio.sleep(0.1 * attempt)
+            await self.connect_to_server()
+        return {"status": "error", "message": f"No response from the indexing server after {self.publish_attempts} attempts."}
+
+    async def send_batch_to_topic(self, topic_name, contents, delay_ms=None, deliver_at=None):
+        # Publishes several messages in one request, compressed with the negotiated codec if any
+        items = [[content, time.time(), None] for content in contents]
+        message = {"action": "send_batch", "topic": topic_name, "peer_id": self.peer_id, **schedule_fields(delay_ms, deliver_at)}
+        if self.compression:
+            message.update({"codec": self.compression, "count": len(items), "data": compress_batch(self.compression, items)})
+        else:
+            message["messages"] = items
+        response = await self.publish(topic_name, message)
+        if response['status'] == "batch_sent":
+            print(f"Sent {len(items)} messages to topic '{topic_name}'")
+        elif response['status'] == "batch_scheduled":
+            print(f"Scheduled {len(items)} messages for topic '{topic_name}' at {time.ctime(response['deliver_at'])}")
+        else:
+            print(f"Error sending batch to topic: {response['message']}")
+        return response
+
+    async def register_schema(self, topic_name, fields):
+        # fields: [{"name": ..., "type": "int64" | "float64" | "bool" | "string"}, ...]; returns the version
+        message = {"action": "register_schema", "topic": topic_name, "fields": fields, "peer_id": self.peer_id}
+        response = await self.send_message(message)
+        if response.get("status") != "schema_registered":
+            print(f"Error registering schema: {response.get('message')}")
+            return None
+        self.schemas[(topic_name, response['version'])] = response['fields']
+        return response['version']
+
+    async def get_schema(self, topic_name, version=None):
+        # Returns (version, fields) of the given or latest schema version, or (None, None)
+        if version and (topic_name, version) in self.schemas:
+            return version, self.schemas[(topic_name, version)]
+        response = await self.send_message({"action": "get_schema", "topic": topic_name, "version": version, "peer_id": self.peer_id})
+        if response.get("status") != "schema":
+            return None, None
+        self.schemas[(topic_name, response['version'])] = response['fields']
+        return response['version'], response['fields']
+
+    async def send_columnar_batch(self, topic_name, columns, schema_version=None):
+        # Publishes records given column-wise ({field name: values}) in one columnar batch,
+        # encoded with the given or latest schema version of the topic
+        schema_version, fields = await self.get_schema(topic_name, schema_version)
+        if not fields:
+            print(f"Error sending batch: topic '{topic_name}' has no schema.")
+            return None
+        payload = encode_columns(fields, columns, time.time())
+        message = {"action": "send_batch", "topic": topic_name, "peer_id": self.peer_id, "codec": COLUMNAR,
+                   "schema_version": schema_version, "count": len(columns[fields[0][0]]), "data": base64.b64encode(payload).decode()}
+        response = await self.publish(topic_name, message)
+        if response['status'] != "batch_sent":
+            print(f"Error sending batch to topic: {response['message']}")
+        return response
+
+    async def fetch_columns(self, topic_name):
+        # Like fetch_new_messages, but columnar batches are decoded into arrays instead of per-record
+        # messages. Returns (batches, messages): batches as (base index, schema fields, columns),
+        # messages for everything that wasn't published column-wise.
+        last_read = self.last_read_index.get(topic_name, -1)
+        batches, messages = [], []
+        while True:
+            message = {"action": "get_messages", "topic": topic_name, "peer_id": self.peer_id, "last_read": last_read}
+            response = await self.send_message(message)
+            if response.get("status") != "messages_retrieved":
+                return batches, messages
+            for entry in response['messages']:
+                if isinstance(entry, dict) and entry.get("codec") == COLUMNAR:
+                    if entry["base"] + entry["count"] - 1 > last_read:
+                        fields, count, produced_at, columns = decode_columns(base64.b64decode(entry["data"]))
+                        batches.append((entry["base"], fields, columns))
+                        last_read = entry["base"] + count - 1
+                else:
+                    fetched = expand_messages([entry], last_read)
+                    if fetched:
+                        messages.extend(fetched)
+                        last_read = fetched[-1][0]
+            self.last_read_index[topic_name] = last_read
+            if not response['messages'] or not response.get("more"):
+                return batches, messages
+
     async def subscribe_topic(self, topic_name):
         message = {"action": "subscribe", "topic": topic_name, "peer_id": self.peer_id}
         response = await self.send_message(message)
@@ -144,24 +419,31 @@ class PeerNode:
         else:
             print(f"Error subscribing to topic: {response.get('message')}")
 
+    async def bulk_topic_request(self, action, topic_names):
+        # action is bulk_create_topics, bulk_delete_topics or bulk_subscribe; returns one result per topic
+        message = {"action": action, "topics": list(topic_names), "peer_id": self.peer_id}
+        response = await self.send_message(message)
+        if response.get("status") != "bulk_result":
+            print(f"Error in {action}: {response.get('message')}")
+            return []
+        if action == "bulk_subscribe":
+            self.subscribed_topics.update(r['topic'] for r in response['results'] if r['status'] == "subscribed")
+        return response['results']
+
     async def pull_messages(self, topic_name):
         if topic_name not in self.subscribed_topics:
             print(f"Not subscribed to topic '{topic_name}'")
             return
 
-        last_read = self.last_read_index.get(topic_name, -1)
-        message = {
-            "action": "get_messages",
-            "topic": topic_name,
-            "peer_id": self.peer_id,
-            "last_read": last_read
-        }
-        response = await self.send_message(message)
+        if self.ack_delivery:
+            await self.pull_leased_messages(topic_name)
+            return
+        response, messages = await self.fetch_new_messages(topic_name)
         if response.get("status") == "messages_retrieved":
-            messages = response.get("messages", [])
             if messages:
                 print(f"New messages from topic '{topic_name}':")
-                for index, sender, content in messages:
+                self.record_end_to_end_latency(topic_name, messages)
+                for index, sender, content, produced_at, appended_at, trace_id in messages:
                     print(f"  {sender}: {content}")
                     self.last_read_index[topic_name] = index
             else:
@@ -169,25 +451,281 @@ class PeerNode:
         else:
             print(f"Error retrieving messages: {response.get('message')}")
 
+    async def pull_leased_messages(self, topic_name):
+        response = await self.lease_messages(topic_name)
+        if response.get("status") != "messages_leased":
+            print(f"Error leasing messages: {response.get('message')}")
+            return
+        if not response['messages']:
+            print(f"No new messages in topic '{topic_name}'")
+            return
+        print(f"New messages from topic '{topic_name}':")
+        for (index, sender, content, produced_at, appended_at, trace_id), deliveries in zip(response['messages'], response['deliveries']):
+            print(f"  {sender}: {content}" + (f" (delivery {deliveries})" if deliveries > 1 else ""))
+        await self.ack_messages(topic_name, indices=[m[0] for m in response['messages']])
+
+    async def lease_messages(self, topic_name, limit=None, visibility_timeout=None):
+        # Leases messages for at-least-once processing. The response lists them under "messages",
+        # with how often each has been delivered under "deliveries"; ack each one once it is
+        # processed, or it is delivered again after the visibility timeout.
+        message = {"action": "lease", "topic": topic_name, "peer_id": self.peer_id, "limit": limit,
+                   "visibility_timeout": visibility_timeout}
+        response = await self.send_message(message)
+        if response.get("status") == "messages_leased":
+            self.record_end_to_end_latency(topic_name, response['messages'])
+        return response
+
+    async def ack_messages(self, topic_name, indices=None, up_to=None):
+        # Acks leased messages by index, and/or every message leased so far up to and including up_to
+        message = {"action": "ack", "topic": topic_name, "peer_id": self.peer_id, "indices": indices or [], "up_to": up_to}
+        response = await self.send_message(message)
+        if response.get("status") != "acked":
+            logger.warning(f"Ack on topic '{topic_name}' failed: {response.get('message')}")
+        return response
+
+    async def fetch_new_messages(self, topic_name):
+        # Fetches everything after our last read index; the server caps each response, so keep
+        # asking while it reports more
+        last_read = self.last_read_index.get(topic_name, -1)
+        messages = []
+        while True:
+            message = {"action": "get_messages", "topic": topic_name, "peer_id": self.peer_id, "last_read": last_read}
+            response = await self.send_message(message)
+            if response.get("status") != "messages_retrieved":
+                return response, messages
+            batch = expand_messages(response.get("messages", []), last_read)
+            messages.extend(batch)
+            if not batch or not response.get("more"):
+                return response, messages
+            last_read = batch[-1][0]
+
+    async def consume(self, topics, limit=None, prefetch=2, poll_interval=0.5, commit_interval=5.0):
+        # Async iterator over the new messages of several topics, yielding (topic, message):
+        #     async with contextlib.aclosing(peer.consume(["a", "b"])) as messages:
+        #         async for topic, message in messages: ...
+        # All topics are read with one multi-topic fetch per batch on this connection. The next
+        # batch is fetched while the current one is processed, with at most `prefetch` batches
+        # buffered. A message counts as processed once the loop asks for the next one; processed
+        # offsets are committed every commit_interval seconds and when the iterator is closed.
+        # Topics without a local read position continue after the offset last committed.
+        topics = list(topics)
+        missing = [topic for topic in topics if topic not in self.subscribed_topics]
+        if missing:
+            await self.bulk_topic_request("bulk_subscribe", missing)
+        positions = {topic: self.last_read_index.get(topic) for topic in topics if topic in self.subscribed_topics}
+        batches = asyncio.Queue(maxsize=prefetch)
+        fetcher = asyncio.create_task(self.prefetch(positions, batches, limit, poll_interval))
+        last_commit = time.monotonic()
+        try:
+            while True:
+                batch = await batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if batch is None:
+                    return
+                for topic, messages in batch:
+                    for message in messages:
+                        yield topic, message
+                        self.last_read_index[topic] = message[0]
+                if time.monotonic() - last_commit >= commit_interval:
+                    await self.commit_offsets(topics)
+                    last_commit = time.monotonic()
+        finally:
+            fetcher.cancel()
+            await self.commit_offsets(topics)
+
+    async def prefetch(self, positions, batches, limit, poll_interval):
+        # Fetch loop behind consume(); positions maps topic -> last index fetched (None: from the
+        # committed offset). Each request is shielded so cancelling the loop never leaves an
+        # unread response on the connection.
+        while positions:
+            message = {"action": "fetch", "peer_id": self.peer_id, "topics": dict(positions), "limit": limit}
+            response = await asyncio.shield(self.send_message(message))
+            if not response or response.get("status") != "messages_fetched":
+                await batches.put(ConnectionError(f"Fetch failed: {response.get('message') if response else 'connection closed'}"))
+                return
+            for topic, error in response['errors'].items():
+                logger.warning(f"Stopped consuming topic '{topic}': {error}")
+                positions.pop(topic, None)
+            batch = []
+            more = False
+            for topic, result in response['topics'].items():
+                messages = expand_messages(result['messages'], result['last_read'])
+                positions[topic] = messages[-1][0] if messages else result['last_read']
+                more = more or result['more']
+                if messages:
+                    self.record_end_to_end_latency(topic, messages)
+                    batch.append((topic, messages))
+            if batch:
+                await batches.put(batch)
+            if not more:
+                await asyncio.sleep(poll_interval)
+            if positions:
+                # Rotate which topic the server serves first, so a busy one can't use up every fetch
+                first = next(iter(positions))
+                positions[first] = positions.pop(first)
+        await batches.put(None)
+
+    async def commit_offsets(self, topics=None):
+        offsets = {topic: self.last_read_index[topic] for topic in (topics or self.subscribed_topics) if topic in self.last_read_index}
+        if not offsets:
+            return
+        response = await self.send_message({"action": "commit_offsets", "peer_id": self.peer_id, "offsets": offsets})
+        if response and response.get("errors"):
+            logger.warning(f"Some offsets were not committed: {response['errors']}")
+
+    async def seek(self, topic_name, offset=None, timestamp=None):
+        # Moves our read position to a message offset or to the first message appended at or after
+        # a Unix timestamp; the next pull starts there
+        message = {"action": "seek", "topic": topic_name, "peer_id": self.peer_id, "offset": offset, "timestamp": timestamp}
+        response = await self.send_message(message)
+        if response.get("status") != "seek_result":
+            print(f"Error seeking topic '{topic_name}': {response.get('message')}")
+            return None
+        self.last_read_index[topic_name] = response['last_read']
+        return response['offset']
+
+    async def replay(self, topic_name, on_messages, from_offset=None, from_time=None, to_offset=None, to_time=None,
+                     rate=None, chunk_size=None):
+        # Streams a range of the topic's history, calling on_messages(topic, messages) once per
+        # chunk. The range is given by offsets or timestamps; rate caps messages per second.
+        # Returns the offset after the last message replayed, or None on error.
+        message = {"action": "replay", "topic": topic_name, "peer_id": self.peer_id, "from_offset": from_offset,
+                   "from_time": from_time, "to_offset": to_offset, "to_time": to_time, "rate": rate, "chunk_size": chunk_size}
+        async with self.request_lock:
+            self.writer.write(encode_frame(message))
+            await self.writer.drain()
+            last = -1
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None or frame.get("status") not in ("replay_chunk", "replay_done"):
+                    print(f"Error replaying topic '{topic_name}': {frame.get('message') if frame else 'connection closed'}")
+                    return None
+                if frame['status'] == "replay_done":
+                    return frame['next_offset']
+                # A compressed batch is sent whole, so drop messages an earlier chunk already covered
+                messages = [m for m in expand_messages(frame['messages'], max(last, frame['from_offset'] - 1))
+                            if m[0] < frame['to_offset']]
+                if messages:
+                    last = messages[-1][0]
+                    on_messages(topic_name, messages)
+
+    def record_end_to_end_latency(self, topic_name, messages):
+        received_at = time.time()
+        samples = self.end_to_end_latency.setdefault(topic_name, deque(maxlen=10000))
+        for index, sender, content, produced_at, appended_at, trace_id in messages:
+            # Messages from producers that don't stamp produced_at fall back to the broker's append time
+            samples.append(received_at - (produced_at or appended_at))
+
+    def end_to_end_latency_percentiles(self, topic_name, percentiles=(50, 90, 99)):
+        samples = sorted(self.end_to_end_latency.get(topic_name, ()))
+        if not samples:
+            return {}
+        return {p: samples[min(len(samples) - 1, int(p / 100 * len(samples)))] for p in percentiles}
+
     async def view_subscribed_topics(self):
         print("Subscribed Topics:", list(self.subscribed_topics))
 
+    async def sync_topic_catalog(self):
+        # Apply the server's change log since our last sync; fall back to a full paged listing
+        if self.topic_catalog_version is not None:
+            while True:
+                message = {"action": "view_created_topics", "peer_id": self.peer_id, "since_version": self.topic_catalog_version}
+                response = await self.send_message(message)
+                if response['status'] != "topic_changes":
+                    break
+                self.apply_topic_changes(response)
+                if not response['more']:
+                    return True
+            if response['status'] != "resync_required":
+                print(f"Error fetching created topics: {response['message']}")
+                return False
+        topics = set()
+        cursor = None
+        version = None
+        while True:
+            message = {"action": "view_created_topics", "peer_id": self.peer_id, "cursor": cursor}
+            response = await self.send_message(message)
+            if response['status'] != "created_topics":
+                print(f"Error fetching created topics: {response['message']}")
+                return False
+            if version is None:
+                version = response['version']
+            topics.update(response['topics'])
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        self.topic_catalog = topics
+        self.topic_catalog_version = version
+        # Catch up on anything created or deleted while we were paging
+        return await self.sync_topic_catalog()
+
+    def apply_topic_changes(self, response):
+        for version, op, topic in response['changes']:
+            if op == 'created':
+                self.topic_catalog.add(topic)
+            else:
+                self.topic_catalog.discard(topic)
+        self.topic_catalog_version = response['version']
+
     async def view_created_topics(self):
-        message = {"action": "view_created_topics", "peer_id": self.peer_id}
-        response = await self.send_message(message)
-        if response['status'] == "created_topics":
-            topics = response['topics']
-            print("Created Topics:", topics)
-        else:
-            print(f"Error fetching created topics: {response['message']}")
+        if await self.sync_topic_catalog():
+            print("Created Topics:", sorted(self.topic_catalog))
+
+    async def attach_push(self, on_messages=None):
+        # Opens a push channel: the server sends new messages of every subscribed topic as they are
+        # published. on_messages(topic, messages) is called for each batch; by default they are printed.
+        reader, writer = await open_connection(self.transport, self.indexing_server_ip, self.indexing_server_port)
+        cursors = {topic: self.last_read_index.get(topic, -1) for topic in self.subscribed_topics}
+        writer.write(encode_frame({"action": "attach_push", "peer_id": self.peer_id, "cursors": cursors}))
+        await writer.drain()
+        response = await read_frame(reader)
+        if not response or response['status'] != "push_attached":
+            writer.close()
+            print(f"Error attaching push channel: {response['message'] if response else 'connection closed'}")
+            return False
+        self.push_writer = writer
+        self.push_task = asyncio.create_task(self.receive_pushes(reader, on_messages))
+        return True
+
+    async def receive_pushes(self, reader, on_messages):
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            topic = frame['topic']
+            messages = expand_messages(frame['messages'], self.last_read_index.get(topic, -1))
+            if not messages:
+                continue
+            self.last_read_index[topic] = messages[-1][0]
+            self.record_end_to_end_latency(topic, messages)
+            if on_messages:
+                on_messages(topic, messages)
+            else:
+                for index, sender, content, produced_at, appended_at, trace_id in messages:
+                    print(f"[{topic}] {sender}: {content}")
 
     async def close(self):
+        if self.checkpoint_task:
+            self.checkpoint_task.cancel()
+        try:
+            await self.checkpoint()
+        except OSError as e:
+            logger.warning(f"Checkpoint of peer state failed: {e}")
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        if self.push_task:
+            self.push_task.cancel()
+        if self.push_writer:
+            self.push_writer.close()
         if self.writer:
             self.writer.close()
             await self.writer.wait_closed()
         if self.server_socket:
             self.server_socket.close()
             await self.server_socket.wait_closed()
+        elif self.listen_socket:
+            self.listen_socket.close()
         logger.info("Connection closed.")
 
     async def main_menu(self):
@@ -197,7 +735,7 @@ class PeerNode:
             print("2. Subscriber")
             print("3. Deregister")
             print("4. Exit")
-            choice = input("Choose an option (1-4): ")
+            choice = await self.prompt("Choose an option (1-4): ")
 
             if choice == '1':
                 await self.run_publisher()
@@ -222,17 +760,17 @@ class PeerNode:
             print("3. Send Message")
             print("4. View Created Topics")
             print("5. Back to Main Menu")
-            choice = input("Choose an option (1-5): ")
+            choice = await self.prompt("Choose an option (1-5): ")
 
             if choice == '1':
-                topic_name = input("Enter the topic name: ")
+                topic_name = await self.prompt("Enter the topic name: ")
                 await self.create_topic(topic_name)
             elif choice == '2':
-                topic_name = input("Enter the topic name to delete: ")
+                topic_name = await self.prompt("Enter the topic name to delete: ")
                 await self.delete_topic(topic_name)
             elif choice == '3':
-                topic_name = input("Enter the topic name to send a message to: ")
-                message_content = input("Enter your message: ")
+                topic_name = await self.prompt("Enter the topic name to send a message to: ")
+                message_content = await self.prompt("Enter your message: ")
                 await self.send_message_to_topic(topic_name, message_content)
             elif choice == '4':
                 await self.view_created_topics()
@@ -248,13 +786,13 @@ class PeerNode:
             print("2. Pull Messages")
             print("3. View Subscribed Topics")
             print("4. Back to Main Menu")
-            choice = input("Choose an option (1-4): ")
+            choice = await self.prompt("Choose an option (1-4): ")
 
             if choice == '1':
-                topic_name = input("Enter the topic name to subscribe to: ")
+                topic_name = await self.prompt("Enter the topic name to subscribe to: ")
                 await self.subscribe_topic(topic_name)
             elif choice == '2':
-                topic_name = input("Enter the topic name to pull messages from: ")
+                topic_name = await self.prompt("Enter the topic name to pull messages from: ")
                 await self.pull_messages(topic_name)
             elif choice == '3':
                 await self.view_subscribed_topics()
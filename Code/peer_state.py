@@ -0,0 +1,36 @@
+import json
+import logging
+import os
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+class PeerStateStore:
+    # A peer's client state kept across restarts: one JSON file per peer ID in directory. Each
+    # checkpoint writes a temporary file and renames it over the old one, so a crash leaves
+    # either the previous or the new checkpoint, never a partial one.
+    def __init__(self, directory, peer_id, fsync=False):
+        self.path = os.path.join(directory, quote(peer_id, safe='') + '.json')
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        # The last checkpoint, or {} if there is none or it can't be read
+        try:
+            with open(self.path, 'rb') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable peer state %s: %s", self.path, e)
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def save(self, data):
+        # data: the encoded state; blocking, so the peer calls this on a worker thread
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,154 @@
+import math
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+
+def collapse(frame):
+    # A frame's stack as "file:function;file:function;...", outermost first
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class RuntimeProfiler:
+    # On-demand profiling of the event loop thread, started and stopped from the admin port.
+    # While active:
+    #   - the loop thread's stack is sampled every `interval` seconds of CPU time and reported in
+    #     collapsed-stack format ("frame;frame;frame count" per line, for flame graph tools). When
+    #     the loop runs on the main thread this uses a SIGPROF timer, which interrupts it at any
+    #     bytecode; otherwise a sampler thread reads the stack, which is biased towards points
+    #     where the loop releases the GIL;
+    #   - request handling records per-action time spent decoding, in the handler, encoding and draining;
+    #   - the sampler also watches a timestamp the loop refreshes every interval, and reports a
+    #     slow callback, with the stack that was running, when it goes stale for slow_callback seconds.
+    # When inactive nothing runs; the request path only checks `active`.
+    def __init__(self):
+        self.active = False
+        self.samples = {}  # collapsed stack: count
+        self.spans = {}  # action: {phase: [count, total seconds, max seconds]}
+        self.slow_callbacks = deque(maxlen=100)
+        self.started_at = None
+        self.stopped_at = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.loop_ticked = 0.0
+        self.tick_handle = None
+        self.stop_handle = None
+        self.previous_handler = None
+
+    def start(self, loop, seconds, interval=0.005, slow_callback=0.1):
+        # Raises ValueError for a bad setting before anything changes; if starting fails part way,
+        # whatever was set up is undone and the profiler stays inactive
+        for name, value in (("seconds", seconds), ("interval", interval), ("slow_callback", slow_callback)):
+            if not math.isfinite(value) or value <= 0:
+                raise ValueError(f"'{name}' must be a positive number.")
+        self.stop()
+        self.samples = {}
+        self.spans = {}
+        self.slow_callbacks.clear()
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.stop_event = threading.Event()
+        self.loop = loop
+        self.loop_ticked = time.perf_counter()
+        try:
+            self.tick_handle = loop.call_soon(self.tick)
+            self.stop_handle = loop.call_later(seconds, self.stop)
+            use_signal = threading.current_thread() is threading.main_thread() and hasattr(signal, 'setitimer')
+            if use_signal:
+                self.previous_handler = signal.signal(signal.SIGPROF, self.on_signal)
+                signal.setitimer(signal.ITIMER_PROF, interval, interval)
+            self.thread = threading.Thread(target=self.watch, args=(threading.get_ident(), not use_signal), name='profiler', daemon=True)
+            self.thread.start()
+        except Exception:
+            self.reset()
+            raise
+        self.active = True
+
+    def reset(self):
+        # Undoes a start that failed part way
+        self.stopped_at = self.started_at
+        self.stop_event.set()
+        for handle in (self.tick_handle, self.stop_handle):
+            if handle is not None:
+                handle.cancel()
+        self.tick_handle = self.stop_handle = None
+        if self.previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.previous_handler = None
+        self.thread = None
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.stopped_at = time.time()
+        self.stop_event.set()
+        self.tick_handle.cancel()
+        self.stop_handle.cancel()
+        self.thread.join()
+        self.thread = None
+        if self.previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.previous_handler = None
+
+    def tick(self):
+        self.loop_ticked = time.perf_counter()
+        self.tick_handle = self.loop.call_later(self.interval, self.tick)
+
+    def on_signal(self, signum, frame):
+        stack = collapse(frame)
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def watch(self, loop_thread, sample_stacks):
+        # Runs on the profiler thread
+        stall = None  # (loop_ticked when the stall was seen, stack at that moment)
+        while not self.stop_event.wait(self.interval):
+            ticked = self.loop_ticked
+            if stall is not None and ticked != stall[0]:
+                self.slow_callbacks.append({"duration_ms": round((ticked - stall[0] - self.interval) * 1000, 1),
+                                            "at": time.time(), "stack": stall[1]})
+                stall = None
+            stalled = stall is None and time.perf_counter() - ticked - self.interval > self.slow_callback
+            if not (sample_stacks or stalled):
+                continue
+            frame = sys._current_frames().get(loop_thread)
+            if frame is None:
+                continue
+            stack = collapse(frame)
+            if sample_stacks:
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+            if stalled:
+                stall = (ticked, stack)
+
+    def record(self, action, phase, seconds):
+        phases = self.spans.get(action)
+        if phases is None:
+            phases = self.spans[action] = {}
+        span = phases.get(phase)
+        if span is None:
+            phases[phase] = [1, seconds, seconds]
+        else:
+            span[0] += 1
+            span[1] += seconds
+            if seconds > span[2]:
+                span[2] = seconds
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in sorted(dict(self.samples).items(), key=lambda item: -item[1]))
+
+    def report(self):
+        spans = {action: {phase: {"count": count, "avg_ms": total / count * 1000, "max_ms": peak * 1000}
+                          for phase, (count, total, peak) in phases.items()}
+                 for action, phases in self.spans.items()}
+        return {"active": self.active, "started_at": self.started_at, "stopped_at": self.stopped_at,
+                "samples": sum(self.samples.values()), "collapsed": self.collapsed(), "spans": spans,
+                "slow_callbacks": list(self.slow_callbacks)}
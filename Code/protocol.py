@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import json
+import lzma
+import struct
+import zlib
+from columnar import COLUMNAR, json_items
+
+# Every message on the wire is a 4-byte big-endian length followed by a UTF-8 JSON body
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Batch compression codecs, in order of preference: name -> (compress, decompress)
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+class FrameTooLarge(Exception):
+    pass
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = (compress, decompress)
+
+def negotiate_codec(offered):
+    # Picks the first codec in the peer's list that we also support
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return None
+
+def compress_batch(codec, items):
+    # items are [content, produced_at, trace_id]; returns the base64 text stored and sent on the wire
+    return base64.b64encode(CODECS[codec][0](json.dumps(items).encode())).decode()
+
+def expand_batch(batch):
+    # Turns a stored batch back into full [index, sender, content, produced_at, appended_at, trace_id] messages
+    if batch["codec"] == COLUMNAR:
+        items = json_items(base64.b64decode(batch["data"]))
+    else:
+        items = json.loads(CODECS[batch["codec"]][1](base64.b64decode(batch["data"])))
+    base = batch["base"]
+    return [[base + i, batch["sender"], content, produced_at, batch["appended_at"], trace_id]
+            for i, (content, produced_at, trace_id) in enumerate(items)]
+
+def check_batch(codec, data, count):
+    # Decodes a batch in full, as a consumer would; raises ValueError unless it holds exactly
+    # count [content, produced_at, trace_id] items
+    try:
+        messages = expand_batch({"codec": codec, "data": data, "base": 0, "sender": None, "appended_at": None})
+    except Exception as e:
+        raise ValueError(f"Batch can't be decoded: {e}")
+    if len(messages) != count:
+        raise ValueError(f"Batch holds {len(messages)} messages, not the {count} given in 'count'.")
+
+def expand_messages(entries, after=-1, skipped=None):
+    # Flattens a get_messages result that may mix single messages and compressed batches,
+    # dropping messages at or before `after` (a batch is always returned whole). If skipped is
+    # a list, batches that can't be decoded are left out and their (base, count) added to it.
+    messages = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            try:
+                batch = expand_batch(entry)
+            except Exception:
+                if skipped is None:
+                    raise
+                skipped.append((entry.get("base"), entry.get("count")))
+                continue
+            messages.extend(m for m in batch if m[0] > after)
+        elif entry[0] > after:
+            messages.append(entry)
+    return messages
+
+def encode_frame(message):
+    body = json.dumps(message).encode()
+    return FRAME_HEADER.pack(len(body)) + body
+
+async def read_frame(reader, decode=None):
+    # Returns None when the other side closed the connection between frames. decode, if given,
+    # is a coroutine function used instead of json.loads (e.g. to decode large bodies off the loop).
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameTooLarge(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit.")
+    body = await reader.readexactly(length)
+    if decode:
+        return await decode(body)
+    return json.loads(body)
+
+class EncodedFrame:
+    # A response whose body is already encoded, held as a list of byte chunks (typically
+    # memoryviews into the message store) that are written with writelines() without copying.
+    def __init__(self, chunks):
+        body_size = sum(len(chunk) for chunk in chunks)
+        self.chunks = [FRAME_HEADER.pack(body_size)] + chunks
+        self.size = FRAME_HEADER.size + body_size
+
+def open_object(fields, key):
+    # The encoded start of {**fields, key: ...}, up to and including the colon after key
+    return json.dumps(fields)[:-1].encode() + (b', ' if fields else b'') + json.dumps(key).encode() + b': '
+
+def encode_records_frame(fields, key, records):
+    # Builds {**fields, key: [records...]} around pre-encoded, comma-separated JSON records
+    return EncodedFrame([open_object(fields, key) + b'['] + records + [b']}'])
+
+def encode_grouped_records_frame(fields, key, groups):
+    # Builds {**fields, key: {name: {**group_fields, "messages": [records...]}, ...}}; groups is a
+    # list of (name, group_fields, records) with records pre-encoded as for encode_records_frame
+    chunks = [open_object(fields, key) + b'{']
+    for i, (name, group_fields, records) in enumerate(groups):
+        chunks.append((b', ' if i else b'') + json.dumps(name).encode() + b': ' + open_object(group_fields, "messages") + b'[')
+        chunks.extend(records)
+        chunks.append(b']}')
+    chunks.append(b'}}')
+    return EncodedFrame(chunks)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from protocol import EncodedFrame, encode_frame
+
+logger = logging.getLogger(__name__)
+
+# Cheap membership and session actions; they always run before any queued data request
+CONTROL_ACTIONS = {"register", "unregister", "heartbeat", "subscribe", "create_topic", "delete_topic", "get_topic_host"}
+
+class Connection:
+    # Request pipeline of one client connection. Up to max_in_flight requests may be queued or
+    # running at once; beyond that the connection stops reading, so the client is slowed down by
+    # TCP backpressure. Responses are written back in request order.
+    def __init__(self, writer, max_in_flight, encode=None, profiler=None):
+        self.writer = writer
+        self.encode = encode  # optional coroutine function turning a response dict into frame bytes
+        self.profiler = profiler  # records encode and drain times while active
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.responses = asyncio.Queue()  # (future, holds_slot, action), in request order
+        self.writer_task = asyncio.create_task(self.write_responses())
+
+    async def submit(self, scheduler, action, message, peer_id):
+        await self.slots.acquire()
+        self.responses.put_nowait((scheduler.submit(action, message, peer_id, self), True, action))
+
+    def respond(self, response):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        self.responses.put_nowait((future, False, None))
+
+    async def write_responses(self):
+        while True:
+            item = await self.responses.get()
+            if item is None:
+                return
+            future, holds_slot, action = item
+            try:
+                response = await future
+            except Exception as e:
+                logger.error("Request failed: %s", e)
+                response = {"status": "error", "message": "Internal server error."}
+            profiling = self.profiler is not None and self.profiler.active
+            if profiling:
+                started = time.perf_counter()
+            if isinstance(response, EncodedFrame):
+                self.writer.writelines(response.chunks)
+            elif self.encode:
+                self.writer.write(await self.encode(response))
+            else:
+                self.writer.write(encode_frame(response))
+            if profiling:
+                encoded = time.perf_counter()
+            await self.writer.drain()
+            if profiling:
+                self.profiler.record(action, 'encode', encoded - started)
+                self.profiler.record(action, 'drain', time.perf_counter() - encoded)
+            if holds_slot:
+                self.slots.release()
+
+    async def finish(self):
+        # Writes out every response still owed, then stops the writer
+        self.responses.put_nowait(None)
+        await self.writer_task
+
+    def abort(self):
+        self.writer_task.cancel()
+
+class RequestScheduler:
+    # Runs requests on a fixed pool of worker tasks. Control actions have strict priority and a
+    # worker of their own, so they never wait behind another client's long data request. Data
+    # requests are queued per peer and served by deficit round-robin, with at most
+    # max_running_per_peer of a peer's requests running at once, so each peer gets a share of the
+    # workers proportional to its weight however many requests it piles up.
+    # Priority only applies between connections: requests from one source (connection) start in
+    # the order they were sent. A request is held back while the source has unfinished requests
+    # in the other lane, or earlier requests still held.
+    def __init__(self, handler, workers=4, weights=None, default_weight=1, max_running_per_peer=1):
+        self.handler = handler
+        self.workers = workers
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        for weight in [default_weight, *self.weights.values()]:
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not math.isfinite(weight) or weight <= 0:
+                raise ValueError(f"Peer weights must be positive numbers, got {weight!r}.")
+        self.max_running_per_peer = max_running_per_peer
+        self.control = deque()
+        self.data = {}  # peer_id: deque of jobs
+        self.active = deque()  # peers with queued data requests, in round-robin order
+        self.deficit = {}
+        self.running = {}  # peer_id: data requests currently running
+        self.unfinished = {}  # source: [control jobs, data jobs] queued or running
+        self.held = {}  # source: deque of jobs waiting for the source's jobs in the other lane
+        self.control_available = asyncio.Event()
+        self.available = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.work(control_only=True))]
+            self.tasks += [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    def submit(self, action, message, peer_id, source=None):
+        future = asyncio.get_running_loop().create_future()
+        job = (action, message, peer_id, future, source)
+        if source is not None:
+            data = action not in CONTROL_ACTIONS
+            unfinished = self.unfinished.setdefault(source, [0, 0])
+            if source in self.held or unfinished[not data]:
+                self.held.setdefault(source, deque()).append(job)
+                return future
+            unfinished[data] += 1
+        self.enqueue(job)
+        return future
+
+    def enqueue(self, job):
+        action, message, peer_id, future, source = job
+        if action in CONTROL_ACTIONS:
+            self.control.append(job)
+            self.control_available.set()
+        else:
+            queue = self.data.get(peer_id)
+            if queue is None:
+                queue = self.data[peer_id] = deque()
+            if not queue:
+                self.active.append(peer_id)
+                self.deficit[peer_id] = 0
+            queue.append(job)
+        self.available.set()
+
+    def finished(self, source, data):
+        # Releases the source's held jobs that no longer wait for the other lane, in order
+        unfinished = self.unfinished[source]
+        unfinished[data] -= 1
+        held = self.held.get(source)
+        while held:
+            next_data = held[0][0] not in CONTROL_ACTIONS
+            if unfinished[not next_data]:
+                break
+            unfinished[next_data] += 1
+            self.enqueue(held.popleft())
+        if not held:
+            self.held.pop(source, None)
+            if unfinished == [0, 0]:
+                del self.unfinished[source]
+
+    def next_job(self, control_only=False):
+        if self.control:
+            return self.control.popleft()
+        if control_only:
+            return None
+        while True:
+            skipped = 0
+            short = []  # peers passed over this round only because they haven't earned a turn yet
+            while self.active and skipped < len(self.active):
+                peer_id = self.active[0]
+                queue = self.data[peer_id]
+                if self.running.get(peer_id, 0) >= self.max_running_per_peer:
+                    self.active.rotate(-1)
+                    skipped += 1
+                    continue
+                if self.deficit[peer_id] < 1:
+                    self.deficit[peer_id] += self.weight(peer_id)
+                    if self.deficit[peer_id] < 1:
+                        # Fractional weight: this peer only gets a turn every few rounds
+                        self.active.rotate(-1)
+                        skipped += 1
+                        short.append(peer_id)
+                        continue
+                job = queue.popleft()
+                self.deficit[peer_id] -= 1
+                if not queue:
+                    self.active.popleft()
+                    del self.data[peer_id]
+                    del self.deficit[peer_id]
+                elif self.deficit[peer_id] < 1:
+                    self.active.rotate(-1)
+                return job
+            if not short:
+                return None
+            # Every peer that could run is short of a turn: credit them at once with the rounds it
+            # takes until one of them has earned it, instead of going round that many times
+            rounds = min(math.ceil((1 - self.deficit[peer_id]) / self.weight(peer_id)) for peer_id in short)
+            for peer_id in short:
+                self.deficit[peer_id] += (rounds - 1) * self.weight(peer_id)
+
+    def weight(self, peer_id):
+        return self.weights.get(peer_id, self.default_weight)
+
+    async def work(self, control_only=False):
+        available = self.control_available if control_only else self.available
+        while True:
+            job = self.next_job(control_only)
+            if job is None:
+                available.clear()
+                await available.wait()
+                continue
+            action, message, peer_id, future, source = job
+            data = action not in CONTROL_ACTIONS
+            if data:
+                self.running[peer_id] = self.running.get(peer_id, 0) + 1
+            try:
+                result = await self.handler(action, message, peer_id)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                if data:
+                    self.running[peer_id] -= 1
+                    if not self.running[peer_id]:
+                        del self.running[peer_id]
+                    self.available.set()
+                if source is not None:
+                    self.finished(source, data)
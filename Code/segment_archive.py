@@ -0,0 +1,123 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class SegmentArchive:
+    # Cold tier for closed log segments: a directory of zlib-compressed segment files standing in
+    # for object storage, plus a size-bounded LRU of decompressed segments. Compression, writes,
+    # reads and deletes all run on a small I/O thread pool of the archive's own, never on the
+    # event loop. Messages aren't persisted across restarts, so segment files left by an earlier
+    # run are deleted at startup.
+    def __init__(self, directory, cache_bytes, compression_level=6, io_threads=2):
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.compression_level = compression_level
+        self.io = concurrent.futures.ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='archive-io')
+        self.lock = threading.Lock()  # guards the cache, loading and the counters
+        self.cache = OrderedDict()  # path: decompressed segment bytes, least recently used first
+        self.cache_size = 0
+        self.loading = {}  # path: concurrent Future of a read in progress
+        self.ids = itertools.count()
+        self.segments = 0  # totals of every segment archived so far
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.seg'):
+                os.unlink(os.path.join(directory, name))
+
+    def store(self, data):
+        # Compresses and writes one segment (on an I/O thread); returns its path
+        path = os.path.join(self.directory, f'{next(self.ids)}.seg')
+        compressed = zlib.compress(data, self.compression_level)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self.segments += 1
+            self.raw_bytes += len(data)
+            self.stored_bytes += len(compressed)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return zlib.decompress(f.read())
+
+    async def load(self, path):
+        # The decompressed segment; a miss is read on an I/O thread while the caller waits
+        with self.lock:
+            data = self.cache.get(path)
+            if data is not None:
+                self.cache.move_to_end(path)
+                self.hits += 1
+                return data
+            future = self.reading(path)
+        return await asyncio.wrap_future(future)
+
+    def prefetch(self, path):
+        # Starts reading a segment into the cache on an I/O thread unless it is cached already
+        with self.lock:
+            if path not in self.cache:
+                self.reading(path)
+
+    def reading(self, path):
+        # The Future of the read of path in progress, started if there is none; call with the lock held
+        future = self.loading.get(path)
+        if future is None:
+            self.misses += 1
+            future = self.loading[path] = self.io.submit(self.fill, path)
+        return future
+
+    def fill(self, path):
+        try:
+            data = self.read(path)
+            self.put(path, data)
+            return data
+        finally:
+            with self.lock:
+                self.loading.pop(path, None)
+
+    def put(self, path, data):
+        with self.lock:
+            if len(data) > self.cache_bytes or path in self.cache:
+                return
+            self.cache[path] = data
+            self.cache_size += len(data)
+            while self.cache_size > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_size -= len(evicted)
+
+    def remove(self, paths):
+        # Drops segments from the cache and deletes their files on an I/O thread
+        with self.lock:
+            for path in paths:
+                data = self.cache.pop(path, None)
+                if data is not None:
+                    self.cache_size -= len(data)
+        self.io.submit(self.unlink, paths)
+
+    def unlink(self, paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Error deleting archived segment %s: %s", path, e)
+
+    def stats(self):
+        with self.lock:
+            return {"segments": self.segments, "raw_bytes": self.raw_bytes, "stored_bytes": self.stored_bytes,
+                    "cached_bytes": self.cache_size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.io.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,552 @@
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import selectors
+import sys
+import tempfile
+import time
+from collections import deque
+from benchmark import LatencyRecorder, git_commit, load_config, write_results
+from indexing_server import IndexingServer
+from protocol import encode_frame, expand_messages, read_frame
+
+# Scale simulator: runs an IndexingServer and thousands of virtual peers in one process, over an
+# in-memory transport and a virtual clock, and reports how the server-side cost of each action
+# grows with the number of peers and topics.
+#
+# The clock only moves when every task is waiting: the loop then jumps straight to the next timer,
+# so a minute of simulated heartbeats, think times and lease expiries takes as long as the work
+# in it. time.time() and time.monotonic() follow the virtual clock while a step runs; handler costs
+# are measured with time.perf_counter(), which stays real. With the same seed a run makes the
+# same requests in the same order (the script pins PYTHONHASHSEED so set ordering repeats too).
+
+EPOCH = 1_700_000_000.0  # what time.time() returns at virtual time 0
+ACTIONS = {  # steady-state mix: action: relative weight
+    "send_message": 30,
+    "get_messages": 25,
+    "fetch": 10,
+    "commit_offsets": 5,
+    "heartbeat": 5,
+    "subscribe": 5,
+    "view_subscribed_topics": 5,
+    "view_created_topics": 5,
+    "get_topic_host": 5,
+    "get_lag_stats": 1,
+}
+
+class VirtualSelector(selectors.BaseSelector):
+    # Nothing in the simulation waits on a real file descriptor, so waiting for I/O just moves
+    # the loop's clock forward to the next scheduled callback
+    def __init__(self, loop):
+        self.loop = loop
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        key = selectors.SelectorKey(fileobj, fileobj if isinstance(fileobj, int) else fileobj.fileno(), events, data)
+        self.keys[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self.keys.pop(fileobj)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulation stalled: every task is waiting and no timer is scheduled.")
+        # Rounded up, so the timer the loop is waiting for is never still a hair in the future
+        self.loop.now = math.nextafter(self.loop.now + timeout, math.inf)
+        return []
+
+    def get_map(self):
+        return self.keys
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+class virtual_time:
+    # Points time.time() and time.monotonic() at the loop's clock for the duration of a step
+    def __init__(self, loop):
+        self.loop = loop
+
+    def __enter__(self):
+        self.saved = time.time, time.monotonic
+        time.time = lambda: EPOCH + self.loop.now
+        time.monotonic = lambda: self.loop.now
+        return self
+
+    def __exit__(self, *exc):
+        time.time, time.monotonic = self.saved
+
+class MemoryConnection:
+    # Both directions of one in-memory connection. A reset (an injected drop or a peer crash)
+    # ends both sides at once and discards whatever is still in flight.
+    def __init__(self):
+        self.reset = False
+        self.readers = []
+
+    def break_off(self):
+        if self.reset:
+            return
+        self.reset = True
+        for reader in self.readers:
+            reader.feed_eof()
+
+class MemoryWriter:
+    # The sending end of one direction, standing in for asyncio.StreamWriter. Each write reaches
+    # the other side's reader after the network's latency, in the order written. There is no
+    # send buffer, so drain() never waits.
+    def __init__(self, network, connection, reader, peername, drop_rate=0.0):
+        self.network = network
+        self.connection = connection
+        self.reader = reader
+        self.peername = peername
+        self.drop_rate = drop_rate
+        self.in_flight = deque()  # (arrival time, bytes or None for end of stream), oldest first
+        self.last_arrival = 0.0
+        self.closing = False
+        self.transport = self
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == 'peername' else default
+
+    def write(self, data):
+        self.writelines([data])
+
+    def writelines(self, chunks):
+        if self.closing or self.connection.reset:
+            return
+        if self.drop_rate and self.network.rng.random() < self.drop_rate:
+            # The request is lost; the sender finds out the way it would over TCP, by a reset
+            self.network.drops += 1
+            self.connection.break_off()
+            return
+        self.send(b''.join(chunks))
+
+    def send(self, data):
+        loop = asyncio.get_running_loop()
+        arrival = max(loop.time() + self.network.delay(), self.last_arrival)
+        self.last_arrival = arrival
+        self.in_flight.append((arrival, data))
+        loop.call_at(arrival, self.deliver)
+
+    def deliver(self):
+        # One callback per write. Callbacks due at the same time may run in any order, so each
+        # hands over the oldest write rather than its own.
+        _, data = self.in_flight.popleft()
+        if not self.connection.reset:
+            if data is None:
+                self.reader.feed_eof()
+            else:
+                self.network.bytes_sent += len(data)
+                self.reader.feed_data(data)
+
+    async def drain(self):
+        if self.connection.reset:
+            raise ConnectionResetError("Connection reset by the simulated network")
+
+    def close(self):
+        if not self.closing and not self.connection.reset:
+            self.send(None)
+        self.closing = True
+
+    def is_closing(self):
+        return self.closing or self.connection.reset
+
+    async def wait_closed(self):
+        pass
+
+class Network:
+    # Opens in-memory connections to the server's connection handler. One-way latency is
+    # latency +/- jitter seconds; drop_rate is the chance that a client write is lost.
+    def __init__(self, rng, handler, latency, jitter, drop_rate):
+        self.rng = rng
+        self.handler = handler
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.connections = 0
+        self.drops = 0
+        self.bytes_sent = 0
+        self.handlers = set()
+
+    def delay(self):
+        return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)) if self.jitter else self.latency
+
+    def connect(self, name):
+        self.connections += 1
+        connection = MemoryConnection()
+        client_reader, server_reader = asyncio.StreamReader(), asyncio.StreamReader()
+        connection.readers = [client_reader, server_reader]
+        client_writer = MemoryWriter(self, connection, server_reader, (name, self.connections), self.drop_rate)
+        server_writer = MemoryWriter(self, connection, client_reader, (name, self.connections))
+        task = asyncio.create_task(self.handler(server_reader, server_writer))
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+        return connection, client_reader, client_writer
+
+class SimulatedServer(IndexingServer):
+    # The real server with per-action accounting of real (CPU) time spent in request handlers and
+    # in session teardown. With charge_cpu, that time is also added to the virtual clock, so a
+    # saturated server shows up as queueing in the peers' latencies.
+    def __init__(self, config, workdir, charge_cpu=False):
+        super().__init__(config)
+        self.registered_peers_file = os.path.join(workdir, 'registered_peers.json')
+        self.charge_cpu = charge_cpu
+        self.costs = {}  # action: [count, total seconds, max seconds]
+
+    def load_registered_peers(self):
+        # Every step starts with no peers on record
+        self.peers = {}
+
+    def charge(self, action, seconds):
+        cost = self.costs.get(action)
+        if cost is None:
+            self.costs[action] = [1, seconds, seconds]
+        else:
+            cost[0] += 1
+            cost[1] += seconds
+            cost[2] = max(cost[2], seconds)
+        if self.charge_cpu:
+            asyncio.get_running_loop().now += seconds
+
+    async def process_action(self, action, message, peer_id):
+        started = time.perf_counter()
+        try:
+            return await super().process_action(action, message, peer_id)
+        finally:
+            self.charge(action, time.perf_counter() - started)
+
+    def end_session(self, peer_id):
+        started = time.perf_counter()
+        try:
+            super().end_session(peer_id)
+        finally:
+            self.charge("end_session", time.perf_counter() - started)
+
+class VirtualPeer:
+    # One simulated peer with its own connection and one request outstanding at a time. A reset
+    # connection is reopened and the request sent again, as PeerNode's publish retries do.
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.peer_id = f"peer{index}"
+        self.index = index
+        self.connection = None
+        self.reader = None
+        self.writer = None
+        self.subscriptions = {}  # topic: last read index
+        self.task = None
+        self.crashed = False
+
+    async def request(self, message):
+        message["peer_id"] = self.peer_id
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.writer is None:
+                self.connection, self.reader, self.writer = self.sim.network.connect(self.peer_id)
+            started = loop.time()
+            self.writer.write(encode_frame(message))
+            response = await read_frame(self.reader)
+            if response is not None:
+                self.sim.latency.setdefault(message["action"], LatencyRecorder()).record(loop.time() - started)
+                return response
+            self.sim.resets += 1
+            self.writer = None
+            await asyncio.sleep(self.sim.reconnect_delay)
+
+    async def register(self):
+        await self.request({"action": "register", "ip": "127.0.0.1", "port": 20000 + self.index})
+
+    async def create_topics(self, topics):
+        for topic in topics:
+            await self.request({"action": "create_topic", "topic": topic})
+
+    async def subscribe(self, *topics):
+        for topic in topics:
+            response = await self.request({"action": "subscribe", "topic": topic})
+            if response.get("status") == "subscribed":
+                self.subscriptions.setdefault(topic, -1)
+
+    async def resume(self):
+        # After a crash: log in again and restore the subscriptions in one request
+        await self.register()
+        response = await self.request({"action": "resume", "topics": dict(self.subscriptions)})
+        if response.get("status") == "resumed":
+            for topic in response["errors"]:
+                self.subscriptions.pop(topic, None)
+            for topic, position in response["topics"].items():
+                self.subscriptions[topic] = position["last_read"]
+
+    async def act(self, action, rng):
+        sim = self.sim
+        topics = list(self.subscriptions)
+        topic = rng.choice(topics) if topics else sim.random_topic(rng)
+        if action == "send_message":
+            await self.request({"action": "send_message", "topic": topic, "content": sim.payload, "produced_at": time.time()})
+        elif action == "get_messages" and topics:
+            response = await self.request({"action": "get_messages", "topic": topic, "last_read": self.subscriptions[topic],
+                                           "limit": sim.fetch_limit})
+            messages = expand_messages(response.get("messages", []), self.subscriptions[topic])
+            if messages:
+                self.subscriptions[topic] = messages[-1][0]
+        elif action == "fetch" and topics:
+            response = await self.request({"action": "fetch", "topics": dict(self.subscriptions), "limit": sim.fetch_limit})
+            if response.get("status") == "messages_fetched":
+                for name, result in response["topics"].items():
+                    messages = expand_messages(result["messages"], result["last_read"])
+                    if messages:
+                        self.subscriptions[name] = messages[-1][0]
+                for name in response["errors"]:
+                    self.subscriptions.pop(name, None)
+        elif action == "commit_offsets" and topics:
+            await self.request({"action": "commit_offsets", "offsets": dict(self.subscriptions)})
+        elif action == "subscribe":
+            await self.subscribe(sim.random_topic(rng))
+        elif action == "view_created_topics":
+            await self.request({"action": "view_created_topics", "cursor": sim.random_topic(rng)})
+        elif action in ("get_topic_host", "get_lag_stats"):
+            await self.request({"action": action, "topic": topic})
+        elif action in ("heartbeat", "view_subscribed_topics"):
+            await self.request({"action": action})
+
+    async def run(self, until):
+        rng = random.Random(f"{self.sim.seed}:{self.peer_id}:{self.sim.crashes}")
+        names, weights = list(ACTIONS), list(ACTIONS.values())
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(min(rng.expovariate(1 / self.sim.think_time), max(0.0, until - loop.time())))
+            if loop.time() >= until:
+                return
+            await self.act(rng.choices(names, weights)[0], rng)
+
+    async def keep_alive(self, interval, until):
+        loop = asyncio.get_running_loop()
+        while loop.time() + interval < until:
+            await asyncio.sleep(interval)
+            await self.request({"action": "heartbeat"})
+        await asyncio.sleep(until - loop.time())
+
+    def crash(self):
+        # Vanishes without unregistering; the server finds out when the session lease runs out
+        self.crashed = True
+        if self.task:
+            self.task.cancel()
+        if self.connection:
+            self.connection.break_off()
+        self.writer = None
+
+class Simulation:
+    def __init__(self, config, peers, topics_per_peer, subscriptions, duration, think_time, latency, jitter,
+                 drop_rate, crash_rate, restart_after, leave_fraction, message_size, seed, charge_cpu):
+        self.config = config
+        self.peer_count = peers
+        self.topic_count = peers * topics_per_peer
+        self.subscription_count = subscriptions
+        self.duration = duration
+        self.think_time = think_time
+        self.latency_settings = (latency, jitter, drop_rate)
+        self.crash_rate = crash_rate
+        self.restart_after = restart_after
+        self.leave_fraction = leave_fraction
+        self.payload = 'x' * message_size
+        self.seed = seed
+        self.charge_cpu = charge_cpu
+        self.fetch_limit = 100
+        self.reconnect_delay = 0.1
+        self.latency = {}  # action: LatencyRecorder of virtual request-response seconds
+        self.resets = 0
+        self.crashes = 0
+        self.restarts = 0
+
+    def random_topic(self, rng):
+        return f"topic{rng.randrange(self.topic_count)}"
+
+    async def run(self, workdir):
+        loop = asyncio.get_running_loop()
+        rng = random.Random(self.seed)
+        self.server = SimulatedServer(self.config, workdir, self.charge_cpu)
+        self.network = Network(random.Random(f"{self.seed}:network"), self.server.handle_client, *self.latency_settings)
+        self.peers = [VirtualPeer(self, i) for i in range(self.peer_count)]
+        phases = {}
+
+        async def phase(name, jobs):
+            started, wall = loop.time(), time.perf_counter()
+            await asyncio.gather(*jobs)
+            phases[name] = {"virtual_seconds": round(loop.time() - started, 3), "wall_seconds": round(time.perf_counter() - wall, 3)}
+
+        await phase("register", [peer.register() for peer in self.peers])
+        await phase("create_topics", [peer.create_topics([f"topic{i}" for i in range(peer.index, self.topic_count, self.peer_count)])
+                                      for peer in self.peers])
+        await phase("subscribe", [peer.subscribe(*(self.random_topic(rng) for _ in range(self.subscription_count)))
+                                  for peer in self.peers])
+        until = loop.time() + self.duration
+        chaos = asyncio.create_task(self.inject_crashes(rng, until))
+        for peer in self.peers:
+            peer.task = asyncio.create_task(peer.run(until))
+        wall = time.perf_counter()
+        started = loop.time()
+        # Crashed peers that restart get new tasks; the chaos task waits for those
+        await asyncio.gather(chaos, *(peer.task for peer in self.peers), return_exceptions=True)
+        phases["steady"] = {"virtual_seconds": round(loop.time() - started, 3), "wall_seconds": round(time.perf_counter() - wall, 3)}
+        # Let the leases of peers that are still down run out, so their teardown is measured too;
+        # the others keep theirs alive meanwhile
+        if any(peer.crashed for peer in self.peers):
+            until = loop.time() + self.server.lease_seconds + 1
+            await phase("expire", [peer.keep_alive(self.server.lease_seconds / 3, until) for peer in self.peers if not peer.crashed])
+        leaving = [peer for peer in self.peers if not peer.crashed][:int(self.peer_count * self.leave_fraction)]
+        await phase("unregister", [peer.request({"action": "unregister"}) for peer in leaving])
+        return phases
+
+    async def inject_crashes(self, rng, until):
+        # Crashes peers at crash_rate per peer per virtual second; each comes back restart_after
+        # seconds later (if set) and resumes its subscriptions
+        loop = asyncio.get_running_loop()
+        if not self.crash_rate:
+            return
+        restarts = []
+        while True:
+            await asyncio.sleep(min(rng.expovariate(self.crash_rate * self.peer_count), max(0.0, until - loop.time())))
+            if loop.time() >= until:
+                break
+            peer = rng.choice(self.peers)
+            if peer.crashed:
+                continue
+            peer.crash()
+            self.crashes += 1
+            if self.restart_after is not None:
+                restarts.append(asyncio.create_task(self.restart(peer, self.restart_after, until)))
+        await asyncio.gather(*restarts, return_exceptions=True)
+
+    async def restart(self, peer, delay, until):
+        await asyncio.sleep(delay)
+        peer.crashed = False
+        peer.writer = None
+        await peer.resume()
+        self.restarts += 1
+        peer.task = asyncio.create_task(peer.run(until))
+        await peer.task
+
+    def report(self, phases, wall_seconds):
+        server = self.server
+        actions = {}
+        for action, (count, total, peak) in sorted(server.costs.items()):
+            actions[action] = {"count": count, "mean_us": round(total / count * 1e6, 2), "max_us": round(peak * 1e6, 1)}
+            if action in self.latency:
+                latency = self.latency[action].summary()
+                actions[action].update({"p50_ms": round(latency["p50_ms"], 3), "p99_ms": round(latency["p99_ms"], 3)})
+        hosted = [len(topics) for topics in server.hosted_topics.values()]
+        return {
+            "peers": self.peer_count, "topics": self.topic_count, "phases": phases, "wall_seconds": round(wall_seconds, 3),
+            "actions": actions,
+            "network": {"connections": self.network.connections, "drops": self.network.drops, "resets": self.resets,
+                        "bytes": self.network.bytes_sent},
+            "churn": {"crashes": self.crashes, "restarts": self.restarts},
+            "server": {"registered_peers": len(server.peers), "sessions": len(server.sessions), "topics": len(server.topics),
+                       "max_topics_per_host": max(hosted, default=0)},
+        }
+
+def run_step(config, args, peers):
+    # One simulation at one scale, on a fresh event loop, server and temporary directory
+    loop = VirtualEventLoop()
+    simulation = Simulation(config, peers, args.topics_per_peer, args.subscriptions, args.duration, args.think_time,
+                            args.latency_ms / 1000, args.jitter_ms / 1000, args.drop_rate, args.crash_rate,
+                            args.restart_after, args.leave_fraction, args.message_size, args.seed, args.charge_cpu)
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as workdir, virtual_time(loop):
+        try:
+            phases = loop.run_until_complete(simulation.run(workdir))
+            return simulation.report(phases, time.perf_counter() - started)
+        finally:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+def scaling(steps):
+    # Growth exponent of each action's mean cost between the smallest and largest step:
+    # about 0 for constant cost, 1 for cost proportional to the number of peers
+    first, last = steps[0], steps[-1]
+    exponents = {}
+    for action, cost in last["actions"].items():
+        before = first["actions"].get(action)
+        if before and before["mean_us"] > 0 and last["peers"] > first["peers"]:
+            exponents[action] = round(math.log(cost["mean_us"] / before["mean_us"]) / math.log(last["peers"] / first["peers"]), 2)
+    return exponents
+
+def print_table(steps, exponents, threshold):
+    actions = sorted({action for step in steps for action in step["actions"]})
+    header = f"{'action':<24}" + ''.join(f"{step['peers']:>12}" for step in steps) + f"{'exponent':>10}"
+    print("Mean handler time (us) by number of peers")
+    print(header)
+    for action in actions:
+        cells = ''.join(f"{step['actions'][action]['mean_us']:>12.1f}" if action in step["actions"] else f"{'-':>12}" for step in steps)
+        exponent = exponents.get(action)
+        flag = "  <- grows with scale" if exponent is not None and exponent >= threshold else ""
+        print(f"{action:<24}{cells}{exponent if exponent is not None else '-':>10}{flag}")
+
+def simulation_config(config, args):
+    # Everything runs on the simulation's loop: no executor, admin port, archive or files the
+    # real server would share with this tree
+    server = dict(config['indexing_server'], executor='none', admin_port=None, archive_dir=None, delayed_dir=None,
+                  metadata_wal=None, session_lease_seconds=args.lease_seconds)
+    return dict(config, indexing_server=server)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates the indexing server with many virtual peers on a virtual clock.")
+    parser.add_argument('--peers', default='250,500,1000,2000', help="comma-separated numbers of peers, one simulation each")
+    parser.add_argument('--topics-per-peer', type=int, default=2, help="topics created per peer")
+    parser.add_argument('--subscriptions', type=int, default=4, help="topics each peer subscribes to at startup")
+    parser.add_argument('--duration', type=float, default=60.0, help="virtual seconds of steady-state traffic")
+    parser.add_argument('--think-time', type=float, default=1.0, help="mean virtual seconds between a peer's requests")
+    parser.add_argument('--latency-ms', type=float, default=1.0, help="one-way network latency")
+    parser.add_argument('--jitter-ms', type=float, default=0.5, help="latency varies uniformly by up to this much")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="chance that a request is lost with its connection")
+    parser.add_argument('--crash-rate', type=float, default=0.0, help="crashes per peer per virtual second")
+    parser.add_argument('--restart-after', type=float, help="virtual seconds after which a crashed peer comes back")
+    parser.add_argument('--lease-seconds', type=float, default=30.0, help="server session lease")
+    parser.add_argument('--leave-fraction', type=float, default=0.1, help="share of peers that unregister at the end")
+    parser.add_argument('--message-size', type=int, default=100, help="payload size in bytes")
+    parser.add_argument('--charge-cpu', action='store_true', help="advance the virtual clock by the real time spent in handlers")
+    parser.add_argument('--threshold', type=float, default=0.5, help="flag actions whose growth exponent reaches this")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='', help="free-form label stored with the results")
+    parser.add_argument('--json', help="write results to this JSON file")
+    parser.add_argument('--csv', help="append one row per step to this CSV file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.disable(logging.WARNING)  # expired sessions and resets are expected here
+    config = simulation_config(load_config(), args)
+    steps = []
+    for peers in sorted(int(n) for n in args.peers.split(',')):
+        step = run_step(config, args, peers)
+        print(f"{peers} peers, {step['topics']} topics: {step['wall_seconds']} s wall, "
+              f"{sum(a['count'] for a in step['actions'].values())} requests", file=sys.stderr)
+        steps.append(step)
+    exponents = scaling(steps)
+    params = {key: value for key, value in vars(args).items() if key not in ('json', 'csv', 'label')}
+    meta = {"label": args.label, "commit": git_commit(), "timestamp": time.time()}
+    write_results([dict(step, params=params, **meta) for step in steps], None, args.csv)
+    result = {"params": params, "steps": steps, "scaling": exponents, **meta}
+    if args.json:
+        write_results(result, args.json)
+    print_table(steps, exponents, args.threshold)
+    return result
+
+if __name__ == '__main__':
+    if os.environ.get('PYTHONHASHSEED') != '0':
+        # Make set and dict ordering of strings repeatable, so the same seed gives the same run
+        os.environ['PYTHONHASHSEED'] = '0'
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    main()
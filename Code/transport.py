@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import stat
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from protocol import encode_frame, read_frame
+
+logger = logging.getLogger(__name__)
+
+# How clients reach the indexing server, from the "transport" section of config.json:
+#   tcp   the indexing server's ip and port
+#   unix  a Unix domain socket at unix_path, for peers on the same host
+#   shm   a Unix domain socket at shm_path for control, with bulk data passed through a pair of
+#         shared-memory rings of shm_ring_bytes; writes of at least shm_min_bytes go through the ring
+# The server always listens on TCP. It also listens on unix_path and shm_path when they are set;
+# neither is set by default, so local socket listeners are opt-in.
+TRANSPORTS = ('tcp', 'unix', 'shm')
+DEFAULT_SETTINGS = {
+    "type": "tcp",
+    "unix_path": None,
+    "shm_path": None,
+    "shm_ring_bytes": 4 * 1024 * 1024,
+    "shm_min_bytes": 4096,
+}
+
+# Record sent on the socket of an shm connection: kind, ring position, length. Inline records are
+# followed by their bytes; ring records point at bytes already copied into the sender's ring.
+RECORD = struct.Struct('!BQI')
+INLINE = 0
+RING = 1
+
+created_blocks = set()  # names of shared memory blocks this process created and will unlink
+
+def transport_settings(config):
+    return dict(DEFAULT_SETTINGS, **config.get('transport', {}))
+
+class ShmRing:
+    # Single-producer, single-consumer byte ring in a shared memory block. The block starts with
+    # the producer's and the consumer's running positions; each side only ever writes its own.
+    POSITIONS = struct.Struct('!QQ')
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.capacity = shm.size - self.POSITIONS.size
+
+    def positions(self):
+        return self.POSITIONS.unpack_from(self.shm.buf, 0)
+
+    def write(self, chunks, size):
+        # Copies chunks into the ring and returns their position, or None if there is no room
+        head, tail = self.positions()
+        if size > self.capacity - (head - tail):
+            return None
+        buf = self.shm.buf
+        offset = head % self.capacity
+        for chunk in chunks:
+            chunk = memoryview(chunk).cast('B')
+            first = min(len(chunk), self.capacity - offset)
+            base = self.POSITIONS.size
+            buf[base + offset:base + offset + first] = chunk[:first]
+            if first < len(chunk):
+                buf[base:base + len(chunk) - first] = chunk[first:]
+            offset = (offset + len(chunk)) % self.capacity
+        struct.pack_into('!Q', buf, 0, head + size)
+        return head
+
+    def read(self, position, size):
+        # Copies size bytes out of the ring and hands the space back to the producer
+        buf = self.shm.buf
+        base = self.POSITIONS.size
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        data = bytes(buf[base + offset:base + offset + first])
+        if first < size:
+            data += bytes(buf[base:base + size - first])
+        struct.pack_into('!Q', buf, 8, position + size)
+        return data
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError as e:
+            logger.warning("Error releasing shared memory ring %s: %s", self.shm.name, e)
+
+def attach_shared_memory(name):
+    # The client unlinks the block once both sides have it mapped; keep our resource tracker out of it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in created_blocks:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def create_shared_memory(size):
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    created_blocks.add(shm.name)
+    return shm
+
+class ShmWriter:
+    # Stands in for the StreamWriter of an shm connection. Writes of at least min_bytes are
+    # copied into the outgoing ring and announced with a small record on the socket; smaller
+    # writes, and any the ring has no room for, are sent inline.
+    def __init__(self, writer, ring, min_bytes, pump, rings):
+        self.writer = writer
+        self.ring = ring
+        self.min_bytes = min_bytes
+        self.pump = pump
+        self.rings = rings  # both rings of the connection, released on close
+        self.closed = False
+
+    @property
+    def transport(self):
+        return self.writer.transport
+
+    def write(self, data):
+        self.writelines([data])
+
+    def writelines(self, chunks):
+        size = sum(len(chunk) for chunk in chunks)
+        if size >= self.min_bytes:
+            position = self.ring.write(chunks, size)
+            if position is not None:
+                self.writer.write(RECORD.pack(RING, position, size))
+                return
+        self.writer.writelines([RECORD.pack(INLINE, 0, size)] + list(chunks))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pump.cancel()
+            self.writer.close()
+            for ring in self.rings:
+                ring.close()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+async def pump_records(reader, ring, stream):
+    # Turns the records of an shm connection back into one byte stream
+    try:
+        while True:
+            kind, position, size = RECORD.unpack(await reader.readexactly(RECORD.size))
+            if kind == RING:
+                stream.feed_data(ring.read(position, size))
+            else:
+                stream.feed_data(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        stream.feed_eof()
+    except Exception as e:
+        stream.set_exception(e)
+
+def shm_streams(reader, writer, incoming, outgoing, min_bytes):
+    stream = asyncio.StreamReader()
+    pump = asyncio.create_task(pump_records(reader, incoming, stream))
+    return stream, ShmWriter(writer, outgoing, min_bytes, pump, [incoming, outgoing])
+
+async def start_servers(settings, client_connected_cb, host, port):
+    servers = [await asyncio.start_server(client_connected_cb, host, port)]
+    if settings.get('unix_path'):
+        servers.append(await start_unix_server(client_connected_cb, settings['unix_path']))
+    if settings.get('shm_path'):
+        async def accept_shm(reader, writer):
+            # The client creates both rings and sends their names first
+            try:
+                hello = await read_frame(reader)
+                incoming, outgoing = (ShmRing(attach_shared_memory(name)) for name in hello['rings'])
+                writer.write(encode_frame({"status": "shm_attached"}))
+                await writer.drain()
+            except asyncio.CancelledError:
+                # Shut down before the handshake finished
+                writer.close()
+                return
+            stream, shm_writer = shm_streams(reader, writer, incoming, outgoing, settings['shm_min_bytes'])
+            await client_connected_cb(stream, shm_writer)
+        servers.append(await start_unix_server(accept_shm, settings['shm_path']))
+    return servers
+
+async def start_unix_server(client_connected_cb, path):
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        # Only remove a socket left behind by a server that didn't shut down cleanly: refuse to
+        # start if the path isn't a socket or something still answers on it
+        if not stat.S_ISSOCK(mode):
+            raise OSError(f"{path} exists and is not a socket.")
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            writer.close()
+            raise OSError(f"Another server is already listening on {path}.")
+    return await asyncio.start_unix_server(client_connected_cb, path)
+
+def socket_path(settings, key):
+    if not settings.get(key):
+        raise ValueError(f"The {settings['type']} transport needs '{key}' set in the transport section of config.json.")
+    return settings[key]
+
+async def open_connection(settings, host, port):
+    kind = settings.get('type', 'tcp')
+    if kind == 'tcp':
+        return await asyncio.open_connection(host, port)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(socket_path(settings, 'unix_path'))
+    if kind == 'shm':
+        reader, writer = await asyncio.open_unix_connection(socket_path(settings, 'shm_path'))
+        outgoing = ShmRing(create_shared_memory(settings['shm_ring_bytes']))
+        incoming = ShmRing(create_shared_memory(settings['shm_ring_bytes']))
+        writer.write(encode_frame({"rings": [outgoing.shm.name, incoming.shm.name]}))
+        await writer.drain()
+        response = await read_frame(reader)
+        for ring in (outgoing, incoming):
+            # Both processes have the blocks mapped now (or never will); unlinking the names
+            # means the memory is freed even if one side crashes
+            ring.shm.unlink()
+            created_blocks.discard(ring.shm.name)
+        if not response or response.get("status") != "shm_attached":
+            writer.close()
+            outgoing.close()
+            incoming.close()
+            raise ConnectionError("The indexing server did not attach the shared memory rings.")
+        return shm_streams(reader, writer, incoming, outgoing, settings['shm_min_bytes'])
+    raise ValueError(f"Unknown transport '{kind}'; expected one of {', '.join(TRANSPORTS)}.")